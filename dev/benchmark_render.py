@@ -0,0 +1,73 @@
+"""
+Benchmark of the ac2350 render paths on the boxes of a JSON/NDJSON corpus
+
+Usage: python dev/benchmark_render.py boxes.json [-n 20]
+
+builders: the UCI object graph is built for every unet
+templates: the unet fragments are filled from the compiled templates
+fragment cache: every unet is a hit, only the box is assembled
+"""
+
+import argparse
+import statistics
+import time
+
+from pydantic import ValidationError
+
+from hermes.fleet.documents import load_box, read_documents
+from hermes.rendering import ac2350
+from hermes.rendering.ac2350_templates import compiled_templates
+
+
+def bench(name: str, render, boxes, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for box in boxes:
+            render(box)
+        timings.append((time.perf_counter() - start) / len(boxes))
+    print(
+        f"{name:>15}: {statistics.median(timings) * 1e6:9.1f} us/box "
+        f"(min {min(timings) * 1e6:.1f})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-n", "--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    boxes = []
+    for document in read_documents(args.paths):
+        try:
+            box = load_box(document)
+            ac2350.render_configfile(box, use_templates=False)
+        except (ValidationError, ValueError):
+            continue
+        boxes.append(box)
+    templates = compiled_templates()
+    if templates is None:
+        # The "templates" round then measures the builders again
+        print(f"{len(boxes)} boxes, templates disabled, falling back to the builders")
+    else:
+        print(f"{len(boxes)} boxes, templates {templates.version}")
+
+    fragment_cache = ac2350.fragment_cache
+    ac2350.fragment_cache = ac2350.FragmentCache(0)
+    bench(
+        "builders",
+        lambda box: ac2350.render_configfile(box, use_templates=False),
+        boxes,
+        args.rounds,
+    )
+    bench("templates", ac2350.render_configfile, boxes, args.rounds)
+
+    ac2350.fragment_cache = fragment_cache
+    for box in boxes:
+        ac2350.render_configfile(box)
+    bench("fragment cache", ac2350.render_configfile, boxes, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
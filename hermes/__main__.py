@@ -0,0 +1,5 @@
+"""Command line entry point: python -m hermes <command>"""
+
+from hermes.cli import main
+
+main()
@@ -1,9 +1,11 @@
 from typing import Annotated
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from pydantic import HttpUrl
 from hermes.env import ENV
 from rezel_vault_jwt.jwt_transit_manager import JwtTransitManager
 from hermes.utils.K8sVaultTokenProcessing import K8sVaultTokenProcessing
+from hermes.utils.server_timing import timed
 from common_models.base import validate_mac
 
 
@@ -11,26 +13,43 @@ def verify_jwt(token: str):
     if ENV.deploy_env == "local":
         return {"mac": "00:00:00:00:00:00", "mac_fc": "00-00-00-00-00-00"}
 
-    k8s_token_processing = K8sVaultTokenProcessing(
-        vault_url=ENV.vault_url,
-        vault_role_name=ENV.vault_role_name,
-    )
-    jwt_manager = JwtTransitManager(
-        vault_token=k8s_token_processing.get_vault_token(),
-        vault_base_url=ENV.vault_url,
-        transit_mount=ENV.vault_transit_mount,
-        transit_key=ENV.vault_transit_key,
-    )
-    is_valid = jwt_manager.verify_jwt(token)
-    if not is_valid:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or expired token",
-            headers={"WWW-Authenticate": "Bearer"},
+    with timed("auth"):
+        k8s_token_processing = K8sVaultTokenProcessing(
+            vault_url=ENV.vault_url,
+            vault_role_name=ENV.vault_role_name,
         )
-    # Decode the JWT token to extract payload
-    payload = JwtTransitManager.decode_jwt(token)
-    return payload
+        jwt_manager = JwtTransitManager(
+            vault_token=k8s_token_processing.get_vault_token(),
+            vault_base_url=ENV.vault_url,
+            transit_mount=ENV.vault_transit_mount,
+            transit_key=ENV.vault_transit_key,
+        )
+        is_valid = jwt_manager.verify_jwt(token)
+        if not is_valid:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid or expired token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        # Decode the JWT token to extract payload
+        payload = JwtTransitManager.decode_jwt(token)
+        return payload
+
+
+def issue_box_credentials(mac: str) -> str:
+    """JWT of a box, for the calls made to Ptah on its behalf"""
+    with timed("auth"):
+        k8s_token_processing = K8sVaultTokenProcessing(
+            vault_url=ENV.vault_url,
+            vault_role_name=ENV.vault_role_name,
+        )
+        jwt_manager = JwtTransitManager(
+            vault_token=k8s_token_processing.get_vault_token(),
+            vault_base_url=HttpUrl(ENV.vault_url),
+            transit_mount=ENV.vault_transit_mount,
+            transit_key=ENV.vault_transit_key,
+        )
+        return jwt_manager.issue_jwt({"mac": mac})
 
 
 # Define a dependency using HTTPBearer
@@ -43,6 +62,19 @@ def jwt_required(
     return verify_jwt(credentials.credentials)
 
 
+def admin_required(payload: Annotated[dict, Depends(jwt_required)]) -> dict:
+    if ENV.deploy_env == "local":
+        return payload
+
+    if payload.get("role") != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin role required",
+        )
+
+    return payload
+
+
 def get_credentials(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
 ):
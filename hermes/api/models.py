@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
 
 
 class PtahVersionResponse(BaseModel):
@@ -6,3 +8,40 @@ class PtahVersionResponse(BaseModel):
     mac: str
     ptah_version_hash: str
     download_url: str
+
+
+class ProfileRequest(BaseModel):
+    mode: Literal["cpu", "alloc"] = "cpu"
+    format: Literal["collapsed", "speedscope"] = "collapsed"
+    duration: float = Field(default=30, gt=0, le=300)
+    requests: Optional[int] = Field(default=None, gt=0)
+    route: Optional[str] = None
+    mac: Optional[str] = None
+    interval_ms: float = Field(default=5, ge=1, le=1000)
+    alloc_view: Literal["diff", "held"] = "diff"
+    nframes: int = Field(default=25, ge=1, le=100)
+
+
+class BatchRenderRequest(BaseModel):
+    macs: Optional[list[str]] = None
+    filter: Optional[dict] = None
+    format: Literal["ndjson", "tar"] = "ndjson"
+    concurrency: int = Field(default=4, ge=1, le=64)
+
+
+class FirmwareEvent(BaseModel):
+    version: str
+    macs: Optional[list[str]] = None
+    profile: Optional[str] = None
+
+
+class RolloutWave(BaseModel):
+    percent: Optional[int] = Field(default=None, ge=0, le=100)
+    macs: Optional[list[str]] = None
+
+
+class RolloutRequest(BaseModel):
+    waves: list[RolloutWave] = Field(min_length=1)
+    current_wave: int = Field(default=0, ge=0)
+    max_builds: int = Field(default=4, ge=0)
+    max_downloads: int = Field(default=20, ge=0)
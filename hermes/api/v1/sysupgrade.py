@@ -4,18 +4,25 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, Request, HTTPException
 import ipaddress
 
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from pydantic import HttpUrl
-import requests
-from hermes.api.dependencies import get_credentials
+from starlette.concurrency import run_in_threadpool
+
+from hermes.api.dependencies import get_credentials, issue_box_credentials
 from hermes.env import ENV
+from hermes.firmware.artifacts import artifact_response
+from hermes.firmware.jobs import BuildJobs, get_build_jobs
+from hermes.firmware.rollout import (
+    RolloutCapacityError,
+    RolloutClosedError,
+    get_rollout_scheduler,
+)
+from hermes.utils.admission import jittered_retry_after
+from hermes.utils.server_timing import timed
 
 from common_models.base import validate_mac
 
 from hermes.mongodb.db import get_box_by_mac, get_db
-from hermes.utils.K8sVaultTokenProcessing import K8sVaultTokenProcessing
-from rezel_vault_jwt.jwt_transit_manager import JwtTransitManager
 
 router = APIRouter()
 
@@ -40,6 +47,7 @@ async def sysupgrade_to_version(
     box: str,
     version: str,
     db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    build_jobs: Annotated[BuildJobs, Depends(get_build_jobs)],
 ):
     client_ip = request.headers.get("X-Forwarded-For", request.client.host)
 
@@ -60,55 +68,54 @@ async def sysupgrade_to_version(
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
-    if not box_obj.ptah_profile == "ac2350-canary":
+    rollout_scheduler = get_rollout_scheduler()
+    try:
+        await rollout_scheduler.check(box_obj)
+    except RolloutClosedError as e:
         raise HTTPException(
             status_code=400,
-            detail={
-                "error": "Unsupported profile",
-                "message": "Sysupgrade is only supported for ac2350-canary profile.",
-            },
-        )
+            detail={"error": "Unsupported profile", "message": str(e)},
+        ) from e
 
-    k8s_token_processing = K8sVaultTokenProcessing(
-        vault_url=ENV.vault_url,
-        vault_role_name=ENV.vault_role_name,
-    )
-
-    vault_token = k8s_token_processing.get_vault_token()
-
-    jwt_manager = JwtTransitManager(
-        vault_token=vault_token,
-        vault_base_url=HttpUrl(ENV.vault_url),
-        transit_mount=ENV.vault_transit_mount,
-        transit_key=ENV.vault_transit_key,
-    )
-    credentials = jwt_manager.issue_jwt({"mac": str(mac_box)})
-
-    ptah_prepare_url = f"{ENV.ptah_base_url}/v1/build/prepare/{str(mac_box)}"
-    response = requests.post(
-        ptah_prepare_url,
-        headers={"Authorization": f"Bearer {credentials}"},
-        json={"profile": box_obj.ptah_profile},
-        timeout=180,
-    )
-    response.raise_for_status()
-
-    ptah_download_url = f"{ENV.ptah_base_url}/v1/build/{str(mac_box)}"
-    response = requests.post(
-        ptah_download_url,
-        headers={"Authorization": f"Bearer {credentials}"},
-        stream=True,
-        timeout=180,
-    )
-
-    response.raise_for_status()
-
-    filename = "ptah.bin"
+    # Ptah builds and downloads of the profile are capped by the rollout, a
+    # build slot is only taken when this box starts a job
+    try:
+        version = build_jobs.ready_artifact(str(mac_box), box_obj.ptah_profile)
+        if version is None:
+            with timed("upstream"):
+                credentials = await run_in_threadpool(
+                    issue_box_credentials, str(mac_box)
+                )
+                job = await build_jobs.build(
+                    str(mac_box),
+                    box_obj.ptah_profile,
+                    credentials,
+                    rollout_scheduler,
+                )
+            if job.state != "done":
+                raise HTTPException(
+                    status_code=502,
+                    detail={"error": "Build failed", "message": job.error},
+                )
+            version = job.version
+        download_slot = await rollout_scheduler.acquire(
+            box_obj.ptah_profile, "download", str(mac_box)
+        )
+    except RolloutCapacityError as e:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "Rollout at capacity", "message": str(e)},
+            headers={
+                "Retry-After": jittered_retry_after(
+                    ENV.admission_retry_after, ENV.admission_retry_jitter
+                )
+            },
+        ) from e
 
-    return StreamingResponse(
-        response.iter_content(chunk_size=8192),
-        media_type=response.headers.get("Content-Type", "application/octet-stream"),
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    # The slot is released once the firmware is sent or the box went away,
+    # or when its lease expires
+    return rollout_scheduler.releasing(
+        artifact_response(build_jobs.store, version), download_slot
     )
 
 
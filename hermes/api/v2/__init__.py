@@ -1,8 +1,16 @@
 from fastapi import APIRouter
 
+from .admin import router as admin_router
 from .config import router as config_router
+from .events import router as events_router
+from .firmware import router as firmware_router
 from .ptah import router as ptah_router
+from .sync import router as sync_router
 
 router = APIRouter(prefix="/v2")
 router.include_router(ptah_router)
 router.include_router(config_router)
+router.include_router(events_router)
+router.include_router(sync_router)
+router.include_router(firmware_router)
+router.include_router(admin_router)
@@ -0,0 +1,20 @@
+from fastapi import APIRouter, Depends
+
+from hermes.api.dependencies import admin_required
+
+from .boxes import router as boxes_router
+from .configs import router as configs_router
+from .conflicts import router as conflicts_router
+from .events import router as events_router
+from .polls import router as polls_router
+from .profiling import router as profiling_router
+from .rollouts import router as rollouts_router
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(admin_required)])
+router.include_router(boxes_router)
+router.include_router(configs_router)
+router.include_router(conflicts_router)
+router.include_router(events_router)
+router.include_router(polls_router)
+router.include_router(profiling_router)
+router.include_router(rollouts_router)
@@ -0,0 +1,30 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.mongodb.watcher import get_box_watcher
+from hermes.rendering.configs import prerender_box
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/boxes")
+
+
+@router.post("/{mac}/changed", status_code=202)
+async def box_changed(mac: str, db: Annotated[AsyncIOMotorDatabase, Depends(get_db)]):
+    """
+    Webhook of the box-management service, called after a box document changed.
+    The box config is rendered again right away, so its next poll is a cache hit.
+    """
+    mac_box = validate_mac(mac)
+    try:
+        box = await get_box_by_mac(db, mac_box)
+    except ValueError as e:
+        raise HTTPException(404, {"Erreur": str(e)}) from e
+
+    # Only this worker is called, whether it holds the prerender lease or not
+    await prerender_box(box.mac, box)
+    box_watcher = get_box_watcher()
+    if box_watcher is not None:
+        await box_watcher.publish(box.mac, box)
+    return {"mac": box.mac}
@@ -0,0 +1,87 @@
+import json
+import time
+from typing import Annotated, AsyncIterator
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import ValidationError
+from common_models.hermes_models import Box
+
+from hermes.api.models import BatchRenderRequest
+from hermes.mongodb.db import get_db, parse_box
+from hermes.rendering.batch import BatchResult, render_boxes
+from hermes.utils.tarstream import TAR_END, tar_member
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/configs")
+
+# Box documents fetched from Mongo per round trip
+CURSOR_BATCH_SIZE = 100
+
+
+async def find_boxes(
+    db: AsyncIOMotorDatabase, query: dict, macs: list[str] | None
+) -> AsyncIterator[Box | BatchResult]:
+    """Boxes matching the query, then a not found result per missing MAC"""
+    missing = set(macs or [])
+    async for document in db.boxes.find(query).batch_size(CURSOR_BATCH_SIZE):
+        mac = document.get("mac")
+        missing.discard(mac)
+        try:
+            yield parse_box(document)
+        except ValidationError as e:
+            yield BatchResult(mac, error=f"Invalid box document: {e}")
+    for mac in sorted(missing):
+        yield BatchResult(mac, error=f"Box with MAC address {mac} not found")
+
+
+async def ndjson_stream(results: AsyncIterator[BatchResult]) -> AsyncIterator[bytes]:
+    async for result in results:
+        line = {"mac": result.mac}
+        if result.error is None:
+            line["configfile"] = result.configfile
+        else:
+            line["error"] = result.error
+        yield json.dumps(line).encode() + b"\n"
+
+
+async def tar_stream(results: AsyncIterator[BatchResult]) -> AsyncIterator[bytes]:
+    """One <mac>.txt member per box, or <mac>.error.txt if it failed"""
+    now = time.time()
+    async for result in results:
+        if result.error is None:
+            yield tar_member(f"{result.mac}.txt", result.configfile.encode(), now)
+        else:
+            yield tar_member(f"{result.mac}.error.txt", result.error.encode(), now)
+    yield TAR_END
+
+
+@router.post("/render")
+async def render_configs(
+    request: BatchRenderRequest,
+    db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+):
+    """
+    Render the configs of many boxes, given by `macs` or by a Mongo `filter`
+    (every box if neither is given), streamed as they complete:
+    NDJSON lines {"mac", "configfile"} or {"mac", "error"}, or a tar archive.
+    Configs missing from the render cache are rendered without filling it,
+    the cache is kept for the boxes polling.
+    """
+    if request.macs is not None and request.filter is not None:
+        raise HTTPException(400, {"Erreur": "Give either macs or filter, not both"})
+
+    macs = None
+    query = request.filter or {}
+    if request.macs is not None:
+        macs = [str(validate_mac(mac)) for mac in request.macs]
+        query = {"mac": {"$in": macs}}
+
+    results = render_boxes(find_boxes(db, query, macs), request.concurrency)
+    if request.format == "tar":
+        return StreamingResponse(
+            tar_stream(results),
+            media_type="application/x-tar",
+            headers={"Content-Disposition": 'attachment; filename="configs.tar"'},
+        )
+    return StreamingResponse(ndjson_stream(results), media_type="application/x-ndjson")
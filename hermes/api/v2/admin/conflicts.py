@@ -0,0 +1,46 @@
+from typing import Annotated, Optional
+from fastapi import APIRouter, Depends, HTTPException
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from starlette.concurrency import run_in_threadpool
+
+from hermes.fleet.conflicts import INDEXED_FIELDS, Conflict, FleetIndex
+from hermes.mongodb.db import get_db
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/conflicts")
+
+# Box documents fetched from Mongo per round trip
+CURSOR_BATCH_SIZE = 500
+
+
+def scan(documents: list[dict], mac: Optional[str]) -> tuple[int, list[Conflict]]:
+    """Index the boxes and find the conflicts, blocking"""
+    index = FleetIndex(documents)
+    if mac is None:
+        return len(index.documents), index.conflicts()
+    if mac not in index.documents:
+        raise HTTPException(404, {"Erreur": f"Box with MAC address {mac} not found"})
+    return len(index.documents), index.box_conflicts(index.documents[mac])
+
+
+@router.get("")
+async def get_conflicts(
+    db: Annotated[AsyncIOMotorDatabase, Depends(get_db)], mac: Optional[str] = None
+):
+    """
+    Address and VLAN conflicts across the fleet,
+    or only those of the box `mac` if given.
+    The index is built and scanned in the threadpool, off the event loop.
+    """
+    mac_box = None if mac is None else str(validate_mac(mac))
+    documents = [
+        document
+        async for document in db.boxes.find({}, INDEXED_FIELDS).batch_size(
+            CURSOR_BATCH_SIZE
+        )
+    ]
+    boxes, conflicts = await run_in_threadpool(scan, documents, mac_box)
+    return {
+        "boxes": boxes,
+        "conflicts": [conflict.to_dict() for conflict in conflicts],
+    }
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, HTTPException
+
+from hermes.api.models import FirmwareEvent
+from hermes.utils.events import announce_firmware as announce
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/events")
+
+
+@router.post("/firmware", status_code=202)
+async def announce_firmware(event: FirmwareEvent):
+    """
+    Tell the connected boxes, by MAC or by ptah profile, that a firmware
+    version is available. The announcement goes through Mongo (`box_events`)
+    to every worker of every replica, or only to the connections of this
+    worker when the box change stream is not open (`fan_out` false).
+    """
+    if event.macs is None and event.profile is None:
+        raise HTTPException(400, {"Erreur": "Give the macs or the profile to notify"})
+
+    macs = (
+        None if event.macs is None else [str(validate_mac(mac)) for mac in event.macs]
+    )
+    return {"fan_out": await announce(event.version, macs, event.profile)}
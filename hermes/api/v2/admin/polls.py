@@ -0,0 +1,21 @@
+from fastapi import APIRouter, HTTPException
+
+from hermes.mongodb.lease import worker_id
+from hermes.utils.poll_hints import get_poll_advisor
+
+router = APIRouter(prefix="/polls")
+
+
+@router.get("")
+async def get_poll_stats():
+    """
+    Poll hints of this worker: its request rate and load, and for each
+    route template the intervals observed between two polls of a box
+    against the intervals advertised to it in X-Poll-After. The figures only
+    cover the requests received by this worker (`worker`), a box whose polls
+    are spread over several workers shows longer intervals.
+    """
+    poll_advisor = get_poll_advisor()
+    if poll_advisor is None:
+        raise HTTPException(404, {"Erreur": "Poll hints are disabled"})
+    return {"worker": worker_id(), **poll_advisor.to_dict()}
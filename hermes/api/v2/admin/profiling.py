@@ -0,0 +1,46 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from hermes.api.models import ProfileRequest
+from hermes.utils.profiling import ProfilerBusyError, ProfileSession
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/profile")
+
+
+@router.post("")
+async def profile_worker(request: ProfileRequest):
+    """
+    Profile the next requests handled by this worker.
+    Returns when `requests` matching requests completed or after `duration` seconds.
+    cpu mode samples every thread stack, alloc mode diffs tracemalloc snapshots.
+    """
+    session = ProfileSession(
+        mode=request.mode,
+        route=request.route,
+        mac=validate_mac(request.mac) if request.mac is not None else None,
+        max_requests=request.requests,
+        interval=request.interval_ms / 1000,
+        nframes=request.nframes,
+    )
+    try:
+        await session.run(request.duration)
+    except ProfilerBusyError as e:
+        raise HTTPException(409, {"Erreur": str(e)}) from e
+
+    headers = {
+        "X-Profile-Requests": str(session.completed_requests),
+        "X-Profile-Elapsed": f"{session.elapsed:.3f}",
+    }
+    if request.format == "speedscope":
+        return JSONResponse(
+            content=session.to_speedscope(request.alloc_view),
+            headers={
+                **headers,
+                "Content-Disposition": 'attachment; filename="profile.speedscope.json"',
+            },
+        )
+    return PlainTextResponse(
+        session.to_collapsed(request.alloc_view),
+        headers=headers,
+    )
@@ -0,0 +1,73 @@
+from fastapi import APIRouter, HTTPException
+from netaddr import AddrFormatError
+
+from hermes.api.models import RolloutRequest
+from hermes.firmware.rollout import get_rollout_scheduler
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/rollouts")
+
+
+def _scheduler():
+    scheduler = get_rollout_scheduler()
+    if scheduler is None:
+        raise HTTPException(503, {"Erreur": "Rollout scheduler not initialized"})
+    return scheduler
+
+
+@router.get("")
+async def get_rollouts():
+    """
+    Firmware rollouts, those of the default profiles included, with the
+    Ptah builds and firmware downloads in progress.
+    """
+    return await _scheduler().status()
+
+
+@router.put("/{profile}")
+async def put_rollout(profile: str, rollout: RolloutRequest):
+    """
+    Create or replace the rollout of a ptah profile. Its waves are either a
+    percentage of the boxes of the profile, cumulative, or a list of MACs.
+    Only the waves up to current_wave are open.
+    """
+    waves = []
+    for wave in rollout.waves:
+        if (wave.percent is None) == (wave.macs is None):
+            raise HTTPException(
+                400, {"Erreur": "Each wave has either a percent or macs"}
+            )
+        try:
+            macs = (
+                None
+                if wave.macs is None
+                else [str(validate_mac(mac)) for mac in wave.macs]
+            )
+        except (AddrFormatError, ValueError) as e:
+            raise HTTPException(400, {"Erreur": f"Invalid MAC: {e}"}) from e
+        waves.append({"percent": wave.percent, "macs": macs})
+
+    return await _scheduler().save_rollout(
+        profile,
+        waves,
+        max_builds=rollout.max_builds,
+        max_downloads=rollout.max_downloads,
+        current_wave=rollout.current_wave,
+    )
+
+
+@router.post("/{profile}/advance")
+async def advance_rollout(profile: str):
+    """Open the next wave of a rollout"""
+    rollout = await _scheduler().advance(profile)
+    if rollout is None:
+        raise HTTPException(404, {"Erreur": f"No rollout for {profile}"})
+    return rollout
+
+
+@router.delete("/{profile}")
+async def delete_rollout(profile: str):
+    """Delete a rollout, the profile is no longer upgraded unless it is a default one"""
+    if not await _scheduler().delete(profile):
+        raise HTTPException(404, {"Erreur": f"No rollout for {profile}"})
+    return {"deleted": profile}
@@ -1,45 +1,205 @@
+import asyncio
+import functools
 import logging
-from typing import Annotated
-from fastapi.responses import FileResponse
+from contextlib import contextmanager
+from typing import Annotated, Awaitable, Callable, Iterator, Optional
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from common_models.hermes_models import Box
 
 from hermes.api.dependencies import jwt_required
 from hermes.env import ENV
 from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.mongodb.watcher import get_box_watcher
+from hermes.rendering.configs import (
+    get_renderer,
+    get_streaming_renderer,
+    get_subsystem_renderer,
+    render_box,
+    render_box_subsystems,
+    stream_box,
+)
+from hermes.rendering.pool import RenderQueueFullError
+from hermes.utils.admission import jittered_retry_after
+from hermes.utils.etag import etag_matches, strong_etag
 from common_models.base import validate_mac
 
 router = APIRouter(prefix="/config", dependencies=[Depends(jwt_required)])
 
 
-@router.get("/{mac}")
-async def get_file_config_by_mac(
-    mac: str, db: Annotated[AsyncIOMotorDatabase, Depends(get_db)]
-):
-    """
-    Download the configuration file for the box with the mac address mac
-    args:
-        mac: str: mac address of the box
-    """
+def configfile_response(
+    configfile: str, filename: str, if_none_match: Optional[str] = None
+) -> Response:
+    """Send a config with its ETag, or 304 if the box already has it"""
+    etag = strong_etag(configfile)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(
+        configfile,
+        media_type="text/plain",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "ETag": etag,
+        },
+    )
+
+
+async def get_box_or_404(db: AsyncIOMotorDatabase, mac: str) -> Box:
     mac_box = validate_mac(mac)
-    box = await get_box_by_mac(db, mac_box)
+    try:
+        box = await get_box_by_mac(db, mac_box)
+    except ValueError as e:
+        raise HTTPException(404, {"Erreur": str(e)}) from e
     if box is None:
         raise HTTPException(404, {"Erreur": f"Box with mac {str(mac_box)}not found"})
+    return box
 
-    match box.type:
-        case "ac2350":
-            from hermes.api.v2.config.ac2350 import create_configfile
-        case _:
-            raise HTTPException(400, {"Erreur": f"Box type {box.type} not supported"})
+
+@contextmanager
+def render_errors() -> Iterator[None]:
+    """Turn render errors into HTTP errors"""
     try:
-        create_configfile(box)
+        yield
+    except RenderQueueFullError as e:
+        raise HTTPException(
+            503,
+            {"Erreur": str(e)},
+            headers={
+                "Retry-After": jittered_retry_after(
+                    ENV.render_retry_after, ENV.render_retry_after
+                )
+            },
+        ) from e
     except ValueError as e:
         logging.error("Error: %s", str(e))
         raise HTTPException(404, {"Erreur": str(e)}) from e
-    return FileResponse(
-        f"{ENV.temp_generated_box_configs_dir}configfile_" + str(mac_box) + ".txt",
-        filename="configfile.txt",
-    )
+
+
+async def subsystems_response(
+    box: Box, subsystems: list[str], filename: str, if_none_match: Optional[str]
+) -> Response:
+    renderer = get_subsystem_renderer(box.type)
+    if renderer is None:
+        raise HTTPException(400, {"Erreur": f"Box type {box.type} not supported"})
+    unknown = [
+        subsystem for subsystem in subsystems if subsystem not in renderer.subsystems
+    ]
+    if unknown:
+        raise HTTPException(404, {"Erreur": f"Unknown subsystem {', '.join(unknown)}"})
+
+    with render_errors():
+        blocks = await render_box_subsystems(renderer, box, tuple(subsystems))
+    return configfile_response(blocks, filename, if_none_match)
+
+
+async def config_response(
+    box: Box, subsystems: Optional[list[str]], if_none_match: Optional[str]
+) -> Response:
+    """The config of a box (or some of its blocks) with its ETag, or 304"""
+    if subsystems:
+        names = [name for value in subsystems for name in value.split(",") if name]
+        return await subsystems_response(box, names, "configfile.txt", if_none_match)
+
+    render = get_renderer(box.type)
+    if render is None:
+        raise HTTPException(400, {"Erreur": f"Box type {box.type} not supported"})
+
+    with render_errors():
+        configfile = await render_box(render, box)
+
+    return configfile_response(configfile, "configfile.txt", if_none_match)
+
+
+async def long_poll_config_response(
+    db: AsyncIOMotorDatabase,
+    mac: str,
+    respond: Callable[[Box], Awaitable[Response]],
+    wait: float,
+) -> Response:
+    """
+    Answer once the config of the box differs from the one it has, which is
+    checked again on each change of the box notified by the box watcher,
+    or with a 304 after wait seconds
+    """
+    box_watcher = get_box_watcher()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    with box_watcher.wait_for_changes(str(validate_mac(mac))) as changes:
+        box = await get_box_or_404(db, mac)
+        while True:
+            response = await respond(box)
+            if response.status_code != 304:
+                return response
+            try:
+                changed_box = await changes.next_change(deadline - loop.time())
+            except asyncio.TimeoutError:
+                return response
+            # An invalid document keeps the box on its current config
+            if changed_box is not None:
+                box = changed_box
+
+
+@router.get("/{mac}")
+async def get_file_config_by_mac(
+    mac: str,
+    db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    subsystems: Annotated[
+        Optional[list[str]],
+        Query(description="Only these config blocks, repeated or comma separated"),
+    ] = None,
+    wait: Annotated[
+        float,
+        Query(ge=0, description="Seconds to wait for a config change (long-poll)"),
+    ] = 0,
+    config_hash: Annotated[
+        Optional[str],
+        Query(alias="hash", description="ETag of the config the box has, unquoted"),
+    ] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Download the configuration file for the box with the mac address mac.
+    With the hash of the config the box has (hash or If-None-Match) and a
+    wait, the request is held until the config changes, else a 304 is sent.
+    args:
+        mac: str: mac address of the box
+        subsystems: list[str]: only send these config blocks (network, firewall...)
+        wait: float: long-poll timeout, capped to CONFIG_LONG_POLL_MAX_WAIT
+        hash: str: ETag of the config of the box, without its quotes
+    """
+    if if_none_match is None and config_hash is not None:
+        if_none_match = f'"{config_hash}"'
+
+    if if_none_match is not None and wait > 0 and get_box_watcher() is not None:
+        return await long_poll_config_response(
+            db,
+            mac,
+            functools.partial(
+                config_response, subsystems=subsystems, if_none_match=if_none_match
+            ),
+            min(wait, ENV.config_long_poll_max_wait),
+        )
+
+    box = await get_box_or_404(db, mac)
+
+    # Streamed configs have no ETag, boxes sending theirs get a buffered one
+    streaming_render = get_streaming_renderer(box.type)
+    if (
+        ENV.render_streaming_enabled
+        and streaming_render is not None
+        and not subsystems
+        and if_none_match is None
+    ):
+        with render_errors():
+            chunks = await stream_box(streaming_render, box)
+        return StreamingResponse(
+            chunks,
+            media_type="text/plain",
+            headers={"Content-Disposition": 'attachment; filename="configfile.txt"'},
+        )
+
+    return await config_response(box, subsystems, if_none_match)
 
 
 @router.get("/{mac}/default")
@@ -49,17 +209,49 @@ async def get_default_config_by_mac(
     """
     Download the default configuration file
     """
-    mac_box = validate_mac(mac)
-    box = await get_box_by_mac(db, mac_box)
-    if box is None:
-        raise HTTPException(404, {"Erreur": f"Box with mac {str(mac_box)}not found"})
+    box = await get_box_or_404(db, mac)
     match box.type:
         case "ac2350":
-            from hermes.api.v2.config.ac2350 import create_default_configfile
+            from hermes.rendering.ac2350 import render_default_configfile
         case _:
             raise HTTPException(400, {"Erreur": f"Box type {box.type} not supported"})
-    create_default_configfile()
-    return FileResponse(
-        f"{ENV.temp_generated_box_configs_dir}{box.type}_defaultConfigfile.txt",
-        filename="defaultConfigfile.txt",
+    return configfile_response(render_default_configfile(), "defaultConfigfile.txt")
+
+
+@router.get("/{mac}/{subsystem}")
+async def get_subsystem_config_by_mac(
+    mac: str,
+    subsystem: str,
+    db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    wait: Annotated[
+        float,
+        Query(ge=0, description="Seconds to wait for a block change (long-poll)"),
+    ] = 0,
+    block_hash: Annotated[
+        Optional[str],
+        Query(alias="hash", description="ETag of the block the box has, unquoted"),
+    ] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Download one config block of the box with the mac address mac,
+    only this block is rendered. Long-polls like the whole configuration file.
+    args:
+        mac: str: mac address of the box
+        subsystem: str: network, firewall, dhcp, wireless or dropbear
+    """
+    if if_none_match is None and block_hash is not None:
+        if_none_match = f'"{block_hash}"'
+    respond = functools.partial(
+        subsystems_response,
+        subsystems=[subsystem],
+        filename=f"{subsystem}.txt",
+        if_none_match=if_none_match,
     )
+
+    if if_none_match is not None and wait > 0 and get_box_watcher() is not None:
+        return await long_poll_config_response(
+            db, mac, respond, min(wait, ENV.config_long_poll_max_wait)
+        )
+
+    return await respond(await get_box_or_404(db, mac))
@@ -0,0 +1,60 @@
+import logging
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from hermes.api.dependencies import check_mac_matches_payload
+from hermes.env import ENV
+from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.rendering.configs import config_hash
+from hermes.rendering.pool import RenderQueueFullError
+from hermes.utils.events import EventHubFullError, EventStreamResponse, get_event_hub
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/events", dependencies=[Depends(check_mac_matches_payload)])
+
+
+@router.get("/{mac}")
+async def get_box_events(
+    mac: str, db: Annotated[AsyncIOMotorDatabase, Depends(get_db)]
+):
+    """
+    Stream the events of a box (Server-Sent Events), sent as they happen:
+        config: {"hash": ...}, ETag of its new config (null: pull it anyway)
+        firmware: {"version": ...}, a firmware is available for the box
+            (null: per box, ask /v2/sync)
+    The hash of the current config is sent on connection.
+    """
+    event_hub = get_event_hub()
+    if event_hub is None:
+        raise HTTPException(404, {"Erreur": "Events are disabled"})
+
+    mac_box = validate_mac(mac)
+    try:
+        box = await get_box_by_mac(db, mac_box)
+    except ValueError as e:
+        raise HTTPException(404, {"Erreur": str(e)}) from e
+
+    try:
+        slot = event_hub.connect(box.mac, box.ptah_profile)
+    except EventHubFullError as e:
+        raise HTTPException(
+            503,
+            {"Erreur": str(e)},
+            headers={"Retry-After": str(ENV.events_heartbeat)},
+        ) from e
+
+    # Connected first, so a change during the render is not missed,
+    # and its event is not replaced by the hash of the previous box
+    try:
+        current_hash = await config_hash(box)
+    except RenderQueueFullError:
+        current_hash = None
+    except ValueError as e:
+        # The box still gets its firmware events
+        logging.warning("No config event for %s: %s", box.mac, str(e))
+        return EventStreamResponse(event_hub, slot)
+    if "config" not in slot.pending:
+        slot.push("config", {"hash": current_hash})
+
+    return EventStreamResponse(event_hub, slot)
@@ -0,0 +1,69 @@
+from typing import Annotated, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from hermes.firmware.artifacts import artifact_etag, not_modified_response
+from hermes.firmware.deltas import stored_response
+from hermes.firmware.jobs import BuildJobs, get_build_jobs
+from hermes.firmware.rollout import (
+    RolloutCapacityError,
+    RolloutScheduler,
+    get_rollout_scheduler,
+)
+from hermes.firmware.urls import FirmwareUrlSigner, get_firmware_url_signer
+from hermes.env import ENV
+from hermes.utils.admission import jittered_retry_after
+from hermes.utils.etag import etag_matches
+
+router = APIRouter(prefix="/firmware")
+
+
+@router.get("/{name}")
+async def get_firmware(
+    name: str,
+    profile: str,
+    expires: int,
+    token: str,
+    build_jobs: Annotated[BuildJobs, Depends(get_build_jobs)],
+    rollout_scheduler: Annotated[RolloutScheduler, Depends(get_rollout_scheduler)],
+    url_signer: Annotated[
+        Optional[FirmwareUrlSigner], Depends(get_firmware_url_signer)
+    ],
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Content-addressed firmware image `<version>` or delta `<source>~<version>`,
+    boxes are redirected here by /v2/ptah/download/{mac}. Its content never
+    changes, so it is cacheable by any proxy until the token expires.
+
+    The image or delta holds a download slot of the profile while it is
+    sent, a box finding them all taken gets a 503 with a Retry-After.
+    """
+    if url_signer is None:
+        raise HTTPException(404, {"Erreur": "Firmware URLs are disabled"})
+    remaining = url_signer.verify(name, profile, expires, token)
+    if remaining is None:
+        raise HTTPException(403, {"Erreur": "Invalid or expired firmware URL"})
+
+    cache_control = f"public, max-age={remaining}, immutable"
+    if etag_matches(if_none_match, artifact_etag(name)):
+        response = not_modified_response(artifact_etag(name))
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    response = stored_response(build_jobs.store, name)
+    if response is None:
+        raise HTTPException(404, {"Erreur": "Unknown firmware"})
+    response.headers["Cache-Control"] = cache_control
+    try:
+        slot = await rollout_scheduler.acquire(profile, "download", name)
+    except RolloutCapacityError as e:
+        raise HTTPException(
+            503,
+            {"Erreur": str(e)},
+            headers={
+                "Retry-After": jittered_retry_after(
+                    ENV.admission_retry_after, ENV.admission_retry_jitter
+                )
+            },
+        ) from e
+    return rollout_scheduler.releasing(response, slot)
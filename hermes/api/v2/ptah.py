@@ -1,16 +1,37 @@
-from typing import Annotated
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Annotated, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from motor.motor_asyncio import AsyncIOMotorDatabase
-import requests
 
 from hermes.api.dependencies import (
     check_mac_matches_payload,
     get_credentials,
 )
-from hermes.api.models import PtahVersionResponse
-from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.firmware.artifacts import (
+    artifact_etag,
+    artifact_response,
+    not_modified_response,
+)
+from hermes.firmware.deltas import (
+    DeltaBuilder,
+    delta_response,
+    get_delta_builder,
+    resumed_response,
+)
+from hermes.firmware.jobs import BuildJob, BuildJobs, get_build_jobs
+from hermes.firmware.ptah import PtahClient, get_ptah_client
+from hermes.firmware.rollout import (
+    RolloutCapacityError,
+    RolloutClosedError,
+    RolloutScheduler,
+    get_rollout_scheduler,
+)
+from hermes.firmware.urls import FirmwareUrlSigner, get_firmware_url_signer
 from hermes.env import ENV
+from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.utils.admission import jittered_retry_after
+from hermes.utils.etag import etag_matches
+from hermes.utils.server_timing import timed
 from common_models.base import validate_mac
 
 router = APIRouter(prefix="/ptah", dependencies=[Depends(check_mac_matches_payload)])
@@ -21,6 +42,7 @@ async def get_ptah_version(
     mac: str,
     credentials: Annotated[str, Depends(get_credentials)],
     db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    ptah_client: Annotated[PtahClient, Depends(get_ptah_client)],
 ):
     """
     Get the Ptah version for a specific MAC address.
@@ -29,19 +51,24 @@ async def get_ptah_version(
 
     box = await get_box_by_mac(db, mac_box)
 
-    ptah_prepare_url = f"{ENV.ptah_base_url}/v1/build/prepare/{str(mac_box)}"
-    response = requests.post(
-        ptah_prepare_url,
-        headers={"Authorization": f"Bearer {credentials}"},
-        json={"profile": box.ptah_profile},
+    with timed("upstream"):
+        version = await ptah_client.version(str(mac_box), box.ptah_profile, credentials)
+
+    return JSONResponse(
+        content={
+            "version": version,
+        },
     )
-    response.raise_for_status()
 
-    ptah_response = PtahVersionResponse.model_validate_json(response.content)
 
+def job_accepted_response(mac: str, job: BuildJob, retry_after: int) -> JSONResponse:
+    """202 telling the box to come back for its firmware"""
     return JSONResponse(
-        content={
-            "version": ptah_response.ptah_version_hash,
+        status_code=202,
+        content={**job.to_dict(), "retry_after": retry_after},
+        headers={
+            "Retry-After": str(retry_after),
+            "Location": f"/v2/ptah/jobs/{mac}/{job.id}",
         },
     )
 
@@ -51,9 +78,40 @@ async def get_ptah_download(
     mac: str,
     credentials: Annotated[str, Depends(get_credentials)],
     db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    build_jobs: Annotated[BuildJobs, Depends(get_build_jobs)],
+    rollout_scheduler: Annotated[RolloutScheduler, Depends(get_rollout_scheduler)],
+    delta_builder: Annotated[Optional[DeltaBuilder], Depends(get_delta_builder)],
+    url_signer: Annotated[
+        Optional[FirmwareUrlSigner], Depends(get_firmware_url_signer)
+    ],
+    prefer: Annotated[Optional[str], Header()] = None,
+    range_: Annotated[Optional[str], Header(alias="Range")] = None,
+    if_range: Annotated[Optional[str], Header()] = None,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    from_version: Annotated[
+        Optional[str],
+        Query(alias="from", description="Firmware version hash the box runs"),
+    ] = None,
 ):
     """
-    Download and stream the file associated with the given MAC address.
+    Download the firmware of the box, once an open wave of the rollout of
+    its profile contains it. When it is not built yet, a build job starts;
+    with a `Prefer: respond-async` header the box gets a 202 with the job
+    and a Retry-After instead of waiting for it.
+
+    A box sending the version it runs may get a bsdiff delta from it
+    (X-Firmware-Delta-From header) instead of the whole image. Either way
+    X-Firmware-SHA256 is the checksum of the target image.
+
+    The ETags are the version hashes. A Range request with the If-Range of
+    the stored image or delta to the version of the box resumes it right
+    away, without looking for a delta again.
+
+    When firmware URLs are enabled, the box is redirected to the signed
+    content-addressed URL of the image or delta (/v2/firmware/{name}).
+
+    The builds and downloads hold the slots of the rollout, a box finding
+    them all taken gets a 503 with a Retry-After.
     """
     mac_box = validate_mac(mac)
     try:
@@ -63,29 +121,106 @@ async def get_ptah_download(
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
-    ptah_prepare_url = f"{ENV.ptah_base_url}/v1/build/prepare/{str(mac_box)}"
-    response = requests.post(
-        ptah_prepare_url,
-        headers={"Authorization": f"Bearer {credentials}"},
-        json={"profile": box.ptah_profile},
-        timeout=180,
-    )
-    response.raise_for_status()
-
-    ptah_download_url = f"{ENV.ptah_base_url}/v1/build/{str(mac_box)}"
-    response = requests.post(
-        ptah_download_url,
-        headers={"Authorization": f"Bearer {credentials}"},
-        stream=True,
-        timeout=180,
-    )
+    try:
+        await rollout_scheduler.check(box, open_without_rollout=True)
+    except RolloutClosedError as e:
+        raise HTTPException(403, {"Erreur": str(e)}) from e
 
-    response.raise_for_status()
+    try:
+        version = build_jobs.ready_artifact(str(mac_box), box.ptah_profile)
+        if version is not None and range_ is not None and if_range is not None:
+            resumed = resumed_response(
+                build_jobs.store, if_range, version, from_version
+            )
+            if resumed is not None:
+                return await _holding_download_slot(
+                    rollout_scheduler, box.ptah_profile, str(mac_box), resumed
+                )
 
-    filename = "ptah.bin"
+        if version is None:
+            with timed("upstream"):
+                if prefer is not None and "respond-async" in prefer:
+                    job = await build_jobs.start(
+                        str(mac_box), box.ptah_profile, credentials, rollout_scheduler
+                    )
+                    if not job.finished:
+                        return job_accepted_response(
+                            str(mac_box), job, build_jobs.retry_after
+                        )
+                    job = await build_jobs.wait(job)
+                else:
+                    job = await build_jobs.build(
+                        str(mac_box), box.ptah_profile, credentials, rollout_scheduler
+                    )
+            if job.state != "done":
+                raise HTTPException(
+                    502, {"Erreur": f"Firmware build failed: {job.error}"}
+                )
+            version = job.version
 
-    return StreamingResponse(
-        response.iter_content(chunk_size=8192),
-        media_type=response.headers.get("Content-Type", "application/octet-stream"),
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
+        delta = (
+            from_version is not None
+            and delta_builder is not None
+            and delta_builder.delta(from_version, version) is not None
+        )
+        etag = artifact_etag(version, from_version if delta else None)
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+        if url_signer is not None:
+            # /v2/firmware holds the download slot when the caches miss
+            return RedirectResponse(
+                url_signer.url(etag.strip('"'), box.ptah_profile), status_code=302
+            )
+        return await _holding_download_slot(
+            rollout_scheduler,
+            box.ptah_profile,
+            str(mac_box),
+            (
+                delta_response(build_jobs.store, from_version, version)
+                if delta
+                else artifact_response(build_jobs.store, version)
+            ),
+        )
+    except RolloutCapacityError as e:
+        raise HTTPException(
+            503,
+            {"Erreur": str(e)},
+            headers={
+                "Retry-After": jittered_retry_after(
+                    ENV.admission_retry_after, ENV.admission_retry_jitter
+                )
+            },
+        ) from e
+
+
+async def _holding_download_slot(
+    rollout_scheduler: RolloutScheduler, profile: str, mac: str, response: Response
+) -> Response:
+    """
+    The response holding a download slot until it is sent
+
+    Raises:
+        RolloutCapacityError: if every download slot is taken
+    """
+    slot = await rollout_scheduler.acquire(profile, "download", mac)
+    return rollout_scheduler.releasing(response, slot)
+
+
+@router.get("/jobs/{mac}/{job_id}")
+async def get_ptah_job(
+    mac: str,
+    job_id: str,
+    build_jobs: Annotated[BuildJobs, Depends(get_build_jobs)],
+):
+    """
+    State of a firmware build job of the box, or of its profile, whichever
+    worker runs it. Once done, the firmware is downloaded from
+    /v2/ptah/download/{mac}.
+    """
+    mac_box = str(validate_mac(mac))
+    job = await build_jobs.get(job_id)
+    if job is None or (job.key[0] is not None and job.mac != mac_box):
+        raise HTTPException(404, {"Erreur": "Unknown build job"})
+    if not job.finished:
+        return job_accepted_response(mac_box, job, build_jobs.retry_after)
+    return job.to_dict()
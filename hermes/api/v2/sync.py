@@ -0,0 +1,85 @@
+import logging
+from urllib.parse import quote
+from typing import Annotated, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from hermes.api.dependencies import check_mac_matches_payload, get_credentials
+from hermes.env import ENV
+from hermes.firmware.jobs import BuildJobs, get_build_jobs
+from hermes.firmware.rollout import (
+    RolloutClosedError,
+    RolloutScheduler,
+    get_rollout_scheduler,
+)
+from hermes.mongodb.db import get_box_by_mac, get_db
+from hermes.rendering.configs import config_hash
+from hermes.rendering.pool import RenderQueueFullError
+from hermes.utils.poll_hints import current_poll_hint
+from common_models.base import validate_mac
+
+router = APIRouter(prefix="/sync", dependencies=[Depends(check_mac_matches_payload)])
+
+
+@router.get("/{mac}")
+async def sync_box(
+    mac: str,
+    credentials: Annotated[str, Depends(get_credentials)],
+    db: Annotated[AsyncIOMotorDatabase, Depends(get_db)],
+    build_jobs: Annotated[BuildJobs, Depends(get_build_jobs)],
+    rollout_scheduler: Annotated[RolloutScheduler, Depends(get_rollout_scheduler)],
+    config: Annotated[
+        Optional[str], Query(description="Hash of the config the box has")
+    ] = None,
+    firmware: Annotated[
+        Optional[str], Query(description="Firmware version hash the box runs")
+    ] = None,
+):
+    """
+    Everything a box checks on each cycle, in one call: the hash of its
+    config (the ETag of /v2/config/{mac}), its target firmware version and
+    when to sync again (the X-Poll-After hint). `urls` lists where to fetch
+    what differs from the config and firmware sent by the box (everything
+    if it sent nothing). A null hash or version could not be computed, the
+    box keeps its own.
+
+    Sync never waits on Ptah: the firmware version is null until the image
+    of the box is built and stored, by a job started in the background. It
+    stays null while no open wave of the rollout of its profile contains
+    the box.
+    """
+    mac_box = validate_mac(mac)
+    try:
+        box = await get_box_by_mac(db, mac_box)
+    except ValueError as e:
+        raise HTTPException(404, {"Erreur": str(e)}) from e
+
+    try:
+        current_config = await config_hash(box)
+    except (RenderQueueFullError, ValueError) as e:
+        logging.warning("No config hash for %s: %s", box.mac, str(e))
+        current_config = None
+
+    try:
+        await rollout_scheduler.check(box, open_without_rollout=True)
+    except RolloutClosedError:
+        # Not upgraded yet, no build started for it either
+        target_firmware = None
+    else:
+        target_firmware = await build_jobs.refresh(
+            box.mac, box.ptah_profile, credentials, rollout_scheduler
+        )
+
+    urls = {}
+    if current_config is not None and current_config != config:
+        urls["config"] = f"/v2/config/{box.mac}"
+    if target_firmware is not None and target_firmware != firmware:
+        urls["firmware"] = f"/v2/ptah/download/{box.mac}"
+        if firmware is not None:
+            urls["firmware"] += f"?from={quote(firmware)}"
+
+    return {
+        "config": current_config,
+        "firmware": target_firmware,
+        "poll_after": current_poll_hint() or ENV.sync_poll_interval,
+        "urls": urls,
+    }
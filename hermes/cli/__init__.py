@@ -0,0 +1,25 @@
+"""
+Offline commands, run with `python -m hermes <command>`.
+
+They must not import hermes.env (directly or through hermes.api or
+hermes.mongodb), so that they run without Mongo, Vault or any environment
+variable, e.g. in CI.
+"""
+
+import argparse
+import logging
+import sys
+
+from . import conflicts, render, validate
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="hermes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    conflicts.add_parser(subparsers)
+    render.add_parser(subparsers)
+    validate.add_parser(subparsers)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    sys.exit(args.run(args))
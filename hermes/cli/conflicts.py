@@ -0,0 +1,74 @@
+"""
+`hermes conflicts`: find address and VLAN conflicts across the fleet:
+duplicate WAN addresses, overlapping IPv6 prefixes, colliding LAN VLANs.
+
+Boxes are read from Mongo (--mongo-uri, or the DB_URI and DB_NAME variables)
+or from JSON/NDJSON files and directories, as for `hermes render`.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from hermes.fleet.conflicts import INDEXED_FIELDS, FleetIndex
+from hermes.fleet.documents import mongo_documents, read_documents
+
+
+def add_parser(subparsers: argparse._SubParsersAction):
+    parser = subparsers.add_parser(
+        "conflicts",
+        help="Find address and VLAN conflicts between boxes",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="JSON/NDJSON files or directories, '-' for NDJSON on stdin",
+    )
+    parser.add_argument("--mongo-uri", default=os.getenv("DB_URI"))
+    parser.add_argument("--db", default=os.getenv("DB_NAME"))
+    parser.add_argument("--collection", default="boxes")
+    parser.add_argument("--mac", help="Only report the conflicts of this box")
+    parser.add_argument("--report", help="Write the conflicts as JSON to this file")
+    parser.set_defaults(run=run)
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.paths:
+        documents = read_documents(args.paths)
+    elif args.mongo_uri and args.db:
+        documents = mongo_documents(
+            args.mongo_uri, args.db, args.collection, projection=INDEXED_FIELDS
+        )
+    else:
+        logging.error("Give files or directories, or a Mongo URI and database")
+        return 2
+
+    start = time.perf_counter()
+    index = FleetIndex(documents)
+    if args.mac is not None:
+        if args.mac not in index.documents:
+            logging.error("Box %s not found", args.mac)
+            return 2
+        conflicts = index.box_conflicts(index.documents[args.mac])
+    else:
+        conflicts = index.conflicts()
+    logging.info(
+        "%d boxes checked in %.2fs", len(index.documents), time.perf_counter() - start
+    )
+
+    for conflict in conflicts:
+        print(
+            f"[{conflict.kind}] {conflict.owner.mac} {conflict.owner.unet_id} "
+            f"{conflict.value} <-> {conflict.other_owner.mac} "
+            f"{conflict.other_owner.unet_id} {conflict.other_value}"
+        )
+    print(f"{len(conflicts)} conflicts found.")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump([conflict.to_dict() for conflict in conflicts], f, indent=2)
+    return 1 if conflicts else 0
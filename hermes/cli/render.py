@@ -0,0 +1,125 @@
+"""
+`hermes render`: render box configs from Box JSON documents.
+
+Documents are read from .json files (one document or a list of documents,
+as exported by mongoexport --jsonArray), .ndjson files, directories of
+those, or NDJSON on stdin.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from pydantic import ValidationError
+
+from hermes.fleet.documents import load_box, process_map, read_documents
+from hermes.rendering.cache import box_hash
+from hermes.rendering.configs import get_renderer
+from hermes.rendering.pool import cpu_limit
+
+
+@dataclass
+class RenderOutput:
+    mac: Optional[str]
+    box_hash: Optional[str] = None
+    sha256: Optional[str] = None
+    configfile: Optional[str] = None
+    error: Optional[str] = None
+
+
+def render_document(document: dict) -> RenderOutput:
+    mac = document.get("mac")
+    try:
+        box = load_box(document)
+    except ValidationError as e:
+        return RenderOutput(mac, error=f"Invalid box document: {e}")
+
+    render = get_renderer(box.type)
+    if render is None:
+        return RenderOutput(mac, error=f"Box type {box.type} not supported")
+    try:
+        configfile = render(box)
+    except ValueError as e:
+        return RenderOutput(mac, error=str(e))
+    return RenderOutput(
+        mac,
+        box_hash=box_hash(box),
+        sha256=hashlib.sha256(configfile.encode()).hexdigest(),
+        configfile=configfile,
+    )
+
+
+def add_parser(subparsers: argparse._SubParsersAction):
+    parser = subparsers.add_parser(
+        "render",
+        help="Render box configs from Box JSON documents",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="JSON/NDJSON files or directories, '-' or nothing for NDJSON on stdin",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_limit(),
+        help="Worker processes (default: available CPUs)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Directory of the <mac>.txt configs and of hashes.txt "
+        "(default: NDJSON on stdout)",
+    )
+    parser.add_argument(
+        "--hashes-only",
+        action="store_true",
+        help="Only output the box and config hashes",
+    )
+    parser.set_defaults(run=run)
+
+
+def run(args: argparse.Namespace) -> int:
+    output = Path(args.output) if args.output else None
+    hashes = None
+    if output is not None:
+        output.mkdir(parents=True, exist_ok=True)
+        hashes = open(output / "hashes.txt", "w", encoding="utf-8")
+
+    rendered = failed = 0
+    try:
+        for result in process_map(
+            render_document, read_documents(args.paths), args.jobs
+        ):
+            if result.error is not None:
+                failed += 1
+                logging.error("%s: %s", result.mac, result.error)
+            else:
+                rendered += 1
+            if args.hashes_only:
+                result.configfile = None
+
+            if output is None:
+                line = {k: v for k, v in asdict(result).items() if v is not None}
+                print(json.dumps(line))
+                continue
+            if result.error is not None:
+                continue
+            hashes.write(f"{result.mac} {result.box_hash} {result.sha256}\n")
+            if result.configfile is not None:
+                (output / f"{result.mac}.txt").write_text(
+                    result.configfile, encoding="utf-8"
+                )
+    finally:
+        if hashes is not None:
+            hashes.close()
+
+    logging.info("%d configs rendered, %d failed", rendered, failed)
+    return 1 if failed else 0
@@ -0,0 +1,76 @@
+"""
+`hermes validate`: validate the box documents of the fleet against the Box
+model and try to render each of them.
+
+Boxes are read from Mongo (--mongo-uri, or the DB_URI and DB_NAME variables)
+or from JSON/NDJSON files and directories, as for `hermes render`.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+
+from hermes.fleet.documents import mongo_documents, process_map, read_documents
+from hermes.fleet.validation import build_report, validate_document
+from hermes.rendering.pool import cpu_limit
+
+
+def add_parser(subparsers: argparse._SubParsersAction):
+    parser = subparsers.add_parser(
+        "validate",
+        help="Validate and try to render box documents",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="JSON/NDJSON files or directories, '-' for NDJSON on stdin",
+    )
+    parser.add_argument("--mongo-uri", default=os.getenv("DB_URI"))
+    parser.add_argument("--db", default=os.getenv("DB_NAME"))
+    parser.add_argument("--collection", default="boxes")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Documents fetched per Mongo round trip",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_limit(),
+        help="Worker processes (default: available CPUs)",
+    )
+    parser.add_argument(
+        "--no-render",
+        action="store_true",
+        help="Only validate the documents against the Box model",
+    )
+    parser.add_argument("--report", help="Write a JSON report to this file")
+    parser.set_defaults(run=run)
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.paths:
+        documents = read_documents(args.paths)
+    elif args.mongo_uri and args.db:
+        documents = mongo_documents(
+            args.mongo_uri, args.db, args.collection, batch_size=args.batch_size
+        )
+    else:
+        logging.error("Give files or directories, or a Mongo URI and database")
+        return 2
+
+    validate = functools.partial(validate_document, render=not args.no_render)
+    report = build_report(process_map(validate, documents, args.jobs))
+    print(report.summary())
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report.to_dict(), f, indent=2)
+        logging.info("Report written to %s", args.report)
+    return 1 if report.invalid else 0
@@ -42,6 +42,22 @@ def get_or_default(key: str, default: str) -> str:
     return value
 
 
+def get_int_or_default(key: str, default: int) -> int:
+    """Get integer value from environment or return default."""
+    value = getenv(key)
+    if not value:
+        return default
+    return int(value)
+
+
+def get_bool_or_default(key: str, default: bool) -> bool:
+    """Get boolean value from environment or return default."""
+    value = getenv(key)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 class Env:  # pylint: disable=too-many-instance-attributes
     """Check environment variables types and constraints."""
 
@@ -51,6 +67,22 @@ class Env:  # pylint: disable=too-many-instance-attributes
     db_name: str
 
     ptah_base_url: str
+    ptah_version_ttl: int
+    firmware_share_profiles: bool
+    firmware_cache_dir: str
+    firmware_cache_max_artifacts: int
+    firmware_deltas_enabled: bool
+    firmware_delta_max_percent: int
+    firmware_delta_max_image_bytes: int
+    firmware_job_retry_after: int
+    firmware_job_ttl: int
+    firmware_job_lease: int
+    firmware_prebuild_enabled: bool
+    firmware_prebuild_interval: int
+    firmware_fetch_interval: int
+    firmware_redirect_enabled: bool
+    firmware_url_secret: str | None
+    firmware_url_ttl: int
 
     temp_generated_box_configs_dir: str
 
@@ -59,6 +91,52 @@ class Env:  # pylint: disable=too-many-instance-attributes
     vault_transit_mount: str
     vault_transit_key: str
 
+    server_timing_enabled: bool
+
+    render_pool_enabled: bool
+    render_pool_workers: int
+    render_pool_max_queue: int
+    render_inline_max_ms: int
+    render_retry_after: int
+    render_batch_max_in_flight: int
+
+    render_cache_enabled: bool
+    render_cache_dir: str
+    render_cache_max_bytes: int
+    render_cache_backend: str
+    render_streaming_enabled: bool
+
+    box_watch_enabled: bool
+    prerender_lease: int
+    config_long_poll_max_wait: int
+
+    events_enabled: bool
+    events_heartbeat: int
+    events_max_connections: int
+
+    sync_poll_interval: int
+    poll_min_interval: int
+    poll_max_interval: int
+    poll_target_rate: int
+    poll_jitter_percent: int
+    poll_recent_change_window: int
+
+    admission_enabled: bool
+    admission_render_limit: int
+    admission_firmware_limit: int
+    admission_long_poll_limit: int
+    admission_max_queue: int
+    admission_queue_timeout: int
+    admission_retry_after: int
+    admission_retry_jitter: int
+    admission_mac_rate_per_minute: int
+    admission_mac_burst: int
+
+    rollout_default_profiles: tuple[str, ...]
+    rollout_max_builds: int
+    rollout_max_downloads: int
+    rollout_slot_lease: int
+
     def __init__(self) -> None:
         """Load all variables."""
 
@@ -77,12 +155,158 @@ class Env:  # pylint: disable=too-many-instance-attributes
             "TEMP_GENERATED_BOX_CONFIGS_DIR"
         )
         self.ptah_base_url = get_or_raise("PTAH_BASE_URL")
+        # Seconds a firmware version from Ptah is cached
+        self.ptah_version_ttl = get_int_or_default("PTAH_VERSION_TTL", 300)
+        # One firmware build per profile while its boxes get the same version
+        self.firmware_share_profiles = get_bool_or_default(
+            "FIRMWARE_SHARE_PROFILES", True
+        )
+        # Firmware images downloaded from Ptah, shared by the workers of the pod
+        self.firmware_cache_dir = get_or_default(
+            "FIRMWARE_CACHE_DIR", "/tmp/hermes-firmware"
+        )
+        self.firmware_cache_max_artifacts = get_int_or_default(
+            "FIRMWARE_CACHE_MAX_ARTIFACTS", 16
+        )
+        # bsdiff deltas between the stored images, sent when under the max size
+        self.firmware_deltas_enabled = get_bool_or_default(
+            "FIRMWARE_DELTAS_ENABLED", True
+        )
+        self.firmware_delta_max_percent = get_int_or_default(
+            "FIRMWARE_DELTA_MAX_PERCENT", 50
+        )
+        # bsdiff takes about ten times the images in memory, one delta per pod
+        self.firmware_delta_max_image_bytes = get_int_or_default(
+            "FIRMWARE_DELTA_MAX_IMAGE_BYTES", 32 * 1024 * 1024
+        )
+        # Retry-After of the 202s of running builds, and how long jobs are kept
+        self.firmware_job_retry_after = get_int_or_default(
+            "FIRMWARE_JOB_RETRY_AFTER", 15
+        )
+        self.firmware_job_ttl = get_int_or_default("FIRMWARE_JOB_TTL", 3600)
+        # Seconds a job is claimed by its worker, above a Ptah prepare and download
+        self.firmware_job_lease = get_int_or_default("FIRMWARE_JOB_LEASE", 600)
+        # Build the firmware of every ptah profile in use, on one replica
+        self.firmware_prebuild_enabled = get_bool_or_default(
+            "FIRMWARE_PREBUILD_ENABLED", True
+        )
+        self.firmware_prebuild_interval = get_int_or_default(
+            "FIRMWARE_PREBUILD_INTERVAL", 3600
+        )
+        # Every worker loads the pre-built versions, its pod downloads their images
+        self.firmware_fetch_interval = get_int_or_default(
+            "FIRMWARE_FETCH_INTERVAL", 120
+        )
+        # Redirect the boxes to signed content-addressed firmware URLs
+        self.firmware_redirect_enabled = get_bool_or_default(
+            "FIRMWARE_REDIRECT_ENABLED", False
+        )
+        self.firmware_url_secret = (
+            get_or_raise("FIRMWARE_URL_SECRET")
+            if self.firmware_redirect_enabled
+            else None
+        )
+        self.firmware_url_ttl = get_int_or_default("FIRMWARE_URL_TTL", 3600)
 
         self.vault_url = get_or_raise("VAULT_URL")
         self.vault_role_name = get_or_raise("VAULT_ROLE_NAME")
         self.vault_transit_mount = get_or_raise("VAULT_TRANSIT_MOUNT")
         self.vault_transit_key = get_or_raise("VAULT_TRANSIT_KEY")
 
+        self.server_timing_enabled = get_bool_or_default("SERVER_TIMING_ENABLED", True)
+
+        # Worker processes for config renders, 0 means sized to the CPU limit
+        self.render_pool_enabled = get_bool_or_default("RENDER_POOL_ENABLED", True)
+        self.render_pool_workers = get_int_or_default("RENDER_POOL_WORKERS", 0)
+        self.render_pool_max_queue = get_int_or_default("RENDER_POOL_MAX_QUEUE", 32)
+        self.render_inline_max_ms = get_int_or_default("RENDER_INLINE_MAX_MS", 0)
+        self.render_retry_after = get_int_or_default("RENDER_RETRY_AFTER", 2)
+        # Batch renders in flight in a worker, all batches together, kept well
+        # under the pool queue which the polls share
+        self.render_batch_max_in_flight = get_int_or_default(
+            "RENDER_BATCH_MAX_IN_FLIGHT", max(1, self.render_pool_max_queue // 4)
+        )
+
+        # Rendered configs shared by all the workers of the pod
+        self.render_cache_enabled = get_bool_or_default("RENDER_CACHE_ENABLED", True)
+        self.render_cache_dir = get_or_default(
+            "RENDER_CACHE_DIR", "/dev/shm/hermes-render-cache"
+        )
+        # Counts against the pod memory, under the 64 MiB /dev/shm of a container
+        self.render_cache_max_bytes = get_int_or_default(
+            "RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024
+        )
+        # shm, mongo (shared by the replicas) or memory
+        self.render_cache_backend = get_or_default("RENDER_CACHE_BACKEND", "shm")
+        # Stream rendered configs a unet at a time instead of buffering them
+        self.render_streaming_enabled = get_bool_or_default(
+            "RENDER_STREAMING_ENABLED", False
+        )
+
+        # Change stream on the boxes, needs a replica set
+        self.box_watch_enabled = get_bool_or_default("BOX_WATCH_ENABLED", True)
+        # Seconds of the lease of the worker prerendering the changed boxes
+        self.prerender_lease = get_int_or_default("PRERENDER_LEASE", 30)
+        # Longest wait of a config long-poll, in seconds, under the proxy timeouts
+        self.config_long_poll_max_wait = get_int_or_default(
+            "CONFIG_LONG_POLL_MAX_WAIT", 45
+        )
+
+        # Server-sent events, heartbeats under the proxy timeouts
+        self.events_enabled = get_bool_or_default("EVENTS_ENABLED", True)
+        self.events_heartbeat = get_int_or_default("EVENTS_HEARTBEAT", 25)
+        self.events_max_connections = get_int_or_default(
+            "EVENTS_MAX_CONNECTIONS", 20000
+        )
+
+        # Seconds between two polls of a box at the target request rate,
+        # advertised in X-Poll-After between the min and max intervals
+        self.sync_poll_interval = get_int_or_default("SYNC_POLL_INTERVAL", 300)
+        self.poll_min_interval = get_int_or_default("POLL_MIN_INTERVAL", 60)
+        self.poll_max_interval = get_int_or_default("POLL_MAX_INTERVAL", 3600)
+        # Requests per second per worker above which the boxes are slowed down
+        self.poll_target_rate = get_int_or_default("POLL_TARGET_RATE", 50)
+        self.poll_jitter_percent = get_int_or_default("POLL_JITTER_PERCENT", 20)
+        # Boxes whose config changed since less than this poll more often
+        self.poll_recent_change_window = get_int_or_default(
+            "POLL_RECENT_CHANGE_WINDOW", 3600
+        )
+
+        # Concurrent requests per route class, the others wait in a bounded queue
+        self.admission_enabled = get_bool_or_default("ADMISSION_ENABLED", True)
+        self.admission_render_limit = get_int_or_default("ADMISSION_RENDER_LIMIT", 64)
+        self.admission_firmware_limit = get_int_or_default(
+            "ADMISSION_FIRMWARE_LIMIT", 8
+        )
+        self.admission_long_poll_limit = get_int_or_default(
+            "ADMISSION_LONG_POLL_LIMIT", 10000
+        )
+        self.admission_max_queue = get_int_or_default("ADMISSION_MAX_QUEUE", 256)
+        self.admission_queue_timeout = get_int_or_default("ADMISSION_QUEUE_TIMEOUT", 10)
+        # Refused requests retry after RETRY_AFTER to RETRY_AFTER + RETRY_JITTER s
+        self.admission_retry_after = get_int_or_default("ADMISSION_RETRY_AFTER", 5)
+        self.admission_retry_jitter = get_int_or_default("ADMISSION_RETRY_JITTER", 25)
+        # Requests per minute and per box, 0 to disable the limit
+        self.admission_mac_rate_per_minute = get_int_or_default(
+            "ADMISSION_MAC_RATE_PER_MINUTE", 0
+        )
+        self.admission_mac_burst = get_int_or_default("ADMISSION_MAC_BURST", 10)
+
+        # Profiles fully rolled out on v1 without a rollout document,
+        # comma-separated, "*" for all (v2 upgrades them all by default)
+        self.rollout_default_profiles = tuple(
+            profile.strip()
+            for profile in get_or_default(
+                "ROLLOUT_DEFAULT_PROFILES", "ac2350-canary"
+            ).split(",")
+            if profile.strip()
+        )
+        # Concurrent Ptah builds and firmware downloads of a default profile
+        self.rollout_max_builds = get_int_or_default("ROLLOUT_MAX_BUILDS", 4)
+        self.rollout_max_downloads = get_int_or_default("ROLLOUT_MAX_DOWNLOADS", 20)
+        # Seconds a slot is held at most, when its worker died holding it
+        self.rollout_slot_lease = get_int_or_default("ROLLOUT_SLOT_LEASE", 1800)
+
         if self.temp_generated_box_configs_dir[-1] != "/":
             self.temp_generated_box_configs_dir += "/"
 
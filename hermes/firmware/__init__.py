@@ -0,0 +1,4 @@
+"""
+Firmware of the boxes: the Ptah client and the firmware versions served to
+the boxes.
+"""
@@ -0,0 +1,194 @@
+"""
+Firmware images downloaded from Ptah, stored by version hash.
+
+The directory is shared by the workers of the pod: an image downloaded by
+one worker is served by all of them. Files are written to a temporary file
+and renamed, so a reader never sees a partial one, and the least recently
+written images are removed above `max_artifacts`, with the deltas from or
+to them.
+
+Next to each image `<version>.bin` are its SHA-256 `<version>.sha256`, and
+the deltas from other versions `<source>~<version>.bsdiff`. The `.lock`
+files keep the workers of the pod from downloading or computing the same
+file twice. Version hashes
+identify the images, so they are their strong ETags too: downloads can be
+resumed with Range and If-Range.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, Response
+
+_VERSION_RE = re.compile(r"^[0-9A-Za-z._-]{1,128}$")
+
+
+class ArtifactStore:
+    """Firmware images of a directory, one file per version hash"""
+
+    directory: str
+    max_artifacts: int
+
+    def __init__(self, directory: str, max_artifacts: int):
+        """
+        Args:
+            directory (str): Directory of the images, created if needed
+            max_artifacts (int): Images kept, the oldest are removed above
+        """
+        self.directory = directory
+        self.max_artifacts = max_artifacts
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, name: str, *versions: str) -> str:
+        for version in versions:
+            if not _VERSION_RE.match(version):
+                raise ValueError(f"Invalid firmware version {version!r}")
+        return os.path.join(self.directory, name)
+
+    def path(self, version: str) -> str:
+        """
+        Raises:
+            ValueError: if the version hash cannot be a file name
+        """
+        return self._file(f"{version}.bin", version)
+
+    def delta_path(self, source: str, target: str) -> str:
+        """
+        Raises:
+            ValueError: if a version hash cannot be a file name
+        """
+        return self._file(f"{source}~{target}.bsdiff", source, target)
+
+    def has(self, version: str) -> bool:
+        return os.path.isfile(self.path(version))
+
+    @contextmanager
+    def lock(self, *versions: str) -> Iterator[bool]:
+        """
+        Try to lock an image, the delta between two, or a task named like a
+        version, for the workers of the pod without waiting: tells whether
+        this worker got the lock
+
+        Raises:
+            ValueError: if a version hash cannot be a file name
+        """
+        path = self._file(f"{'~'.join(versions)}.lock", *versions)
+        with open(path, "a", encoding="ascii") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write(self, path: str, write: Callable[[str], None]):
+        """Write a file of the store through a temporary path, blocking"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, version: str, chunks: Iterable[bytes]) -> str:
+        """Write an image from its chunks, blocking, and return its path"""
+        path = self.path(version)
+        sha256 = hashlib.sha256()
+
+        def write(tmp_path: str):
+            with open(tmp_path, "wb") as tmp:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+
+        self.write(path, write)
+        self._write_checksum(version, sha256.hexdigest())
+        self._evict()
+        return path
+
+    def _write_checksum(self, version: str, checksum: str):
+        def write(tmp_path: str):
+            with open(tmp_path, "w", encoding="ascii") as tmp:
+                tmp.write(checksum)
+
+        self.write(self._file(f"{version}.sha256", version), write)
+
+    def checksum(self, version: str) -> str:
+        """SHA-256 of an image, computed if the store does not have it yet"""
+        try:
+            with open(
+                self._file(f"{version}.sha256", version), encoding="ascii"
+            ) as checksum_file:
+                return checksum_file.read().strip()
+        except FileNotFoundError:
+            sha256 = hashlib.sha256()
+            with open(self.path(version), "rb") as image:
+                for chunk in iter(lambda: image.read(1 << 20), b""):
+                    sha256.update(chunk)
+            self._write_checksum(version, sha256.hexdigest())
+            return sha256.hexdigest()
+
+    def _evict(self):
+        artifacts = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bin"):
+                try:
+                    artifacts.append((entry.stat().st_mtime, entry.name[:-4]))
+                except FileNotFoundError:
+                    continue
+        artifacts.sort()
+        evicted = {
+            version
+            for _, version in artifacts[: max(0, len(artifacts) - self.max_artifacts)]
+        }
+        if not evicted:
+            return
+        for entry in os.scandir(self.directory):
+            name, _, extension = entry.name.rpartition(".")
+            if (extension in ("bin", "sha256", "lock") and name in evicted) or (
+                extension in ("bsdiff", "lock")
+                and evicted.intersection(name.split("~"))
+            ):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    continue
+        logging.info("Firmware artifacts %s evicted", sorted(evicted))
+
+
+def artifact_etag(version: str, source: Optional[str] = None) -> str:
+    """Strong ETag of an image, or of the delta to it from source"""
+    return f'"{version}"' if source is None else f'"{source}~{version}"'
+
+
+def artifact_response(
+    store: ArtifactStore, version: str, background: Optional[BackgroundTask] = None
+) -> FileResponse:
+    """Send an image of the store as the ptah.bin attachment"""
+    return FileResponse(
+        store.path(version),
+        media_type="application/octet-stream",
+        filename="ptah.bin",
+        headers={
+            "ETag": artifact_etag(version),
+            "X-Firmware-Version": version,
+            "X-Firmware-SHA256": store.checksum(version),
+        },
+        background=background,
+    )
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
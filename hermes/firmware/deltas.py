@@ -0,0 +1,199 @@
+"""
+Binary deltas (bsdiff4) between the firmware images of the store.
+
+A box telling the version it runs gets the delta from it to its target
+version, with the SHA-256 of the target image to check the patched
+result, instead of the whole image. Deltas are computed in the background
+the first time they are asked for, and cached in the store; until one is
+ready, or when it would not save enough, the full image is sent.
+
+bsdiff takes about ten times the size of the images in memory: a single
+delta is computed at a time in the pod, under a lock file of the store,
+and none between images above `max_image_bytes`.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import bsdiff4
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse
+
+from hermes.firmware.artifacts import (
+    ArtifactStore,
+    artifact_etag,
+    artifact_response,
+)
+
+# Lock of the store held by the worker of the pod computing a delta
+_POD_LOCK = "bsdiff"
+
+
+class DeltaBuilder:
+    """Compute and cache the deltas between the images of a store"""
+
+    max_ratio: float
+    max_image_bytes: int
+
+    def __init__(self, store: ArtifactStore, max_ratio: float, max_image_bytes: int):
+        """
+        Args:
+            store (ArtifactStore): Images the deltas are computed between
+            max_ratio (float): Deltas above this fraction of the target image
+                are not worth sending
+            max_image_bytes (int): Images above this size get no delta
+        """
+        self.store = store
+        self.max_ratio = max_ratio
+        self.max_image_bytes = max_image_bytes
+        self._building: dict[tuple[str, str], asyncio.Task] = {}
+
+    def delta(self, source: str, target: str) -> Optional[str]:
+        """
+        The path of the delta from source to target if it is ready and worth
+        it, else None, starting to compute it when both images are stored
+        """
+        if source == target:
+            return None
+        try:
+            path = self.store.delta_path(source, target)
+            if not (self.store.has(source) and self.store.has(target)):
+                return None
+        except ValueError:
+            return None
+
+        try:
+            delta_size = os.path.getsize(path)
+        except FileNotFoundError:
+            if (
+                max(
+                    os.path.getsize(self.store.path(source)),
+                    os.path.getsize(self.store.path(target)),
+                )
+                <= self.max_image_bytes
+            ):
+                self._build(source, target, path)
+            return None
+        if delta_size > self.max_ratio * os.path.getsize(self.store.path(target)):
+            return None
+        return path
+
+    def _build(self, source: str, target: str, path: str):
+        if (source, target) in self._building:
+            return
+        task = asyncio.create_task(self._compute(source, target, path))
+        self._building[(source, target)] = task
+        task.add_done_callback(lambda _: self._building.pop((source, target), None))
+
+    def _compute_in_pod(self, source: str, target: str, path: str) -> bool:
+        """Compute a delta unless another worker of the pod computes one, blocking"""
+        with self.store.lock(_POD_LOCK) as locked:
+            if not locked:
+                return False
+            if not os.path.isfile(path):
+                self.store.write(
+                    path,
+                    lambda tmp_path: bsdiff4.file_diff(
+                        self.store.path(source), self.store.path(target), tmp_path
+                    ),
+                )
+            return True
+
+    async def _compute(self, source: str, target: str, path: str):
+        try:
+            computed = await run_in_threadpool(
+                self._compute_in_pod, source, target, path
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("No firmware delta %s~%s: %s", source, target, str(e))
+            return
+        if computed:
+            logging.info("Firmware delta %s~%s computed", source, target)
+
+    async def stop(self):
+        tasks = list(self._building.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def delta_response(
+    store: ArtifactStore,
+    source: str,
+    target: str,
+    background: Optional[BackgroundTask] = None,
+) -> FileResponse:
+    """Send the delta from source to target, to apply with bspatch"""
+    return FileResponse(
+        store.delta_path(source, target),
+        media_type="application/x-bsdiff",
+        filename="ptah.bin.bsdiff",
+        headers={
+            "ETag": artifact_etag(target, source),
+            "X-Firmware-Version": target,
+            "X-Firmware-Delta-From": source,
+            "X-Firmware-SHA256": store.checksum(target),
+        },
+        background=background,
+    )
+
+
+def stored_response(store: ArtifactStore, name: str) -> Optional[FileResponse]:
+    """
+    The image `<version>` or the delta `<source>~<version>` if it is stored,
+    the name being its ETag without the quotes
+    """
+    source, _, target = name.rpartition("~")
+    try:
+        if source:
+            if os.path.isfile(store.delta_path(source, target)):
+                return delta_response(store, source, target)
+        elif store.has(target):
+            return artifact_response(store, target)
+    except ValueError:
+        pass
+    return None
+
+
+def resumed_response(
+    store: ArtifactStore,
+    if_range: str,
+    version: str,
+    from_version: Optional[str] = None,
+) -> Optional[FileResponse]:
+    """
+    The image or delta to the version of the box an If-Range ETag names, if
+    it is stored, to resume its download without looking for a delta again.
+    Any other ETag, of an older image or of another box, resumes nothing.
+    """
+    targets = {artifact_etag(version)}
+    if from_version is not None:
+        targets.add(artifact_etag(version, from_version))
+    if if_range not in targets:
+        return None
+    return stored_response(store, if_range[1:-1])
+
+
+delta_builder: Optional[DeltaBuilder] = None
+
+
+def get_delta_builder() -> Optional[DeltaBuilder]:
+    return delta_builder
+
+
+def init_delta_builder(
+    store: ArtifactStore, max_ratio: float, max_image_bytes: int
+) -> DeltaBuilder:
+    global delta_builder
+    delta_builder = DeltaBuilder(store, max_ratio, max_image_bytes)
+    return delta_builder
+
+
+async def close_delta_builder():
+    global delta_builder
+    if delta_builder is not None:
+        await delta_builder.stop()
+        delta_builder = None
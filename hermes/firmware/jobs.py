@@ -0,0 +1,520 @@
+"""
+Firmware builds run as background jobs instead of inside a box request.
+
+A job asks Ptah to prepare the firmware of a box, then downloads the image
+into the artifact store, where the requests of every worker of the pod
+stream it from. Boxes are answered right away (202 with the job) or wait
+for the job without holding a thread.
+
+Jobs are documents of the `build_jobs` collection, one per build key: the
+box, or its profile when its boxes share their firmware. A worker runs a
+job once it claimed the key with find_one_and_update; the other workers
+and replicas follow the document instead of asking Ptah again, and answer
+for the job by its id. A replica without the image downloads it once the
+job is done, an image is downloaded once per version and pod. The claim of
+a worker which died expires after `lease` seconds.
+
+Given a rollout scheduler, a worker holds a build slot of the profile for
+the job it runs, the boxes joining or following it hold none.
+
+A job done with a new version announces it to the connected boxes (SSE
+firmware event): its box, or the boxes of the profile that may upgrade.
+"""
+
+import asyncio
+import dataclasses
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from starlette.concurrency import run_in_threadpool
+
+from hermes.firmware.artifacts import ArtifactStore
+from hermes.firmware.ptah import PtahClient
+from hermes.firmware.rollout import (
+    RolloutCapacityError,
+    RolloutScheduler,
+    RolloutSlot,
+)
+from hermes.mongodb.lease import worker_id
+from hermes.utils.events import announce_firmware
+
+# Seconds between two looks at a job of another worker, or at a download
+# of another worker of the pod
+_POLL_INTERVAL = 1
+
+
+@dataclass
+class BuildJob:
+    id: str
+    mac: str
+    profile: str
+    # Builds of the box, or of its profile when its boxes share them
+    key: tuple[Optional[str], str]
+    # building, downloading, done or failed
+    state: str = "building"
+    version: Optional[str] = None
+    error: Optional[str] = None
+    # Epoch seconds, shared by the workers
+    finished_at: Optional[float] = None
+    expires_at: Optional[float] = None
+    # Only set in the worker running the job
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("done", "failed")
+
+    @property
+    def key_id(self) -> str:
+        return key_id(self.key)
+
+    def to_dict(self) -> dict:
+        return {
+            "job": self.id,
+            "state": self.state,
+            "version": self.version,
+            "error": self.error,
+        }
+
+    def to_document(self) -> dict:
+        return {
+            "job": self.id,
+            "mac": self.mac,
+            "profile": self.profile,
+            "shared": self.key[0] is None,
+            "state": self.state,
+            "version": self.version,
+            "error": self.error,
+            "finished_at": self.finished_at,
+            "expires_at": self.expires_at,
+            "worker": worker_id(),
+        }
+
+    @classmethod
+    def from_document(cls, document: dict) -> "BuildJob":
+        return cls(
+            id=document["job"],
+            mac=document["mac"],
+            profile=document["profile"],
+            key=(None if document["shared"] else document["mac"], document["profile"]),
+            state=document["state"],
+            version=document.get("version"),
+            error=document.get("error"),
+            finished_at=document.get("finished_at"),
+            expires_at=document.get("expires_at"),
+        )
+
+
+def key_id(key: tuple[Optional[str], str]) -> str:
+    """_id of the job document of a build key"""
+    mac, profile = key
+    return f"profile/{profile}" if mac is None else f"box/{mac}/{profile}"
+
+
+class BuildJobs:
+    """The build jobs of the `build_jobs` collection, run by the worker or followed"""
+
+    retry_after: int
+    job_ttl: float
+    lease: float
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        ptah_client: PtahClient,
+        store: ArtifactStore,
+        issue_credentials: Callable[[str], str],
+        retry_after: int,
+        job_ttl: float,
+        lease: float,
+    ):
+        """
+        Args:
+            db (AsyncIOMotorDatabase): Database of the jobs
+            ptah_client (PtahClient): Client of Ptah
+            store (ArtifactStore): Where the images are downloaded
+            issue_credentials (Callable): JWT of a box from its MAC, blocking,
+                to download the image of a job run by another replica
+            retry_after (int): Seconds a box should wait before asking again,
+                and before a failed job is run again
+            job_ttl (float): Seconds a finished job is kept by the worker
+            lease (float): Seconds a job is claimed for, above its longest run
+        """
+        self.documents = db.build_jobs
+        self.ptah_client = ptah_client
+        self.store = store
+        self.issue_credentials = issue_credentials
+        self.retry_after = retry_after
+        self.job_ttl = job_ttl
+        self.lease = lease
+        self.jobs: dict[str, BuildJob] = {}
+        self._latest: dict[tuple[Optional[str], str], BuildJob] = {}
+        self._followers: dict[str, asyncio.Task] = {}
+        self._startup: Optional[asyncio.Task] = None
+
+    @property
+    def fresh_for(self) -> float:
+        """Seconds the version of a done job is served, as long as a cached version"""
+        return self.ptah_client.version_ttl or self.job_ttl
+
+    async def get(self, job_id: str) -> Optional[BuildJob]:
+        """A job by its id, whichever worker runs it"""
+        job = self.jobs.get(job_id)
+        if job is not None and job.task is not None:
+            return job
+        document = await self.documents.find_one({"job": job_id})
+        return None if document is None else BuildJob.from_document(document)
+
+    def ready_artifact(self, mac: str, profile: str) -> Optional[str]:
+        """The version of the box if its image is in the store"""
+        job = self._latest.get(self.ptah_client.build_key(mac, profile))
+        version = (
+            job.version
+            if job is not None
+            and job.state == "done"
+            and time.time() - job.finished_at < self.fresh_for
+            else self.ptah_client.cached_version(mac, profile)
+        )
+        if version is not None and self.store.has(version):
+            return version
+        return None
+
+    def _reusable(self, document: dict, now: float) -> bool:
+        """Tell whether a job document is followed rather than run again"""
+        if document["state"] == "done":
+            return now - document["finished_at"] < self.fresh_for
+        if document["state"] == "failed":
+            return now - document["finished_at"] < self.retry_after
+        return document["expires_at"] >= now
+
+    async def start(
+        self,
+        mac: str,
+        profile: str,
+        credentials: str,
+        rollout_scheduler: Optional[RolloutScheduler] = None,
+    ) -> BuildJob:
+        """
+        Start a job for a box, or return the job of its build key: running,
+        done a short while ago, or failed less than retry_after seconds ago
+
+        Raises:
+            RolloutCapacityError: if a job would start without a build slot
+        """
+        key = self.ptah_client.build_key(mac, profile)
+        job = self._latest.get(key)
+        if job is not None and not job.finished:
+            return job
+
+        now = time.time()
+        document = await self.documents.find_one({"_id": key_id(key)})
+        if document is not None and self._reusable(document, now):
+            return BuildJob.from_document(document)
+
+        job = BuildJob(uuid.uuid4().hex, mac, profile, key, expires_at=now + self.lease)
+        slot = (
+            None
+            if rollout_scheduler is None
+            else await rollout_scheduler.acquire(profile, "build", job.id)
+        )
+        try:
+            claimed = await self.documents.find_one_and_update(
+                {
+                    "_id": job.key_id,
+                    "$or": [
+                        {
+                            "state": "done",
+                            "finished_at": {"$lt": now - self.fresh_for},
+                        },
+                        {
+                            "state": "failed",
+                            "finished_at": {"$lt": now - self.retry_after},
+                        },
+                        {
+                            "state": {"$in": ["building", "downloading"]},
+                            "expires_at": {"$lt": now},
+                        },
+                    ],
+                },
+                {"$set": job.to_document()},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Claimed by another worker since, the upsert collided with it
+            claimed = None
+        except BaseException:
+            if slot is not None:
+                await rollout_scheduler.release_quietly(slot)
+            raise
+        if claimed is None or claimed["job"] != job.id:
+            if slot is not None:
+                await rollout_scheduler.release_quietly(slot)
+            document = await self.documents.find_one({"_id": job.key_id})
+            if document is None:
+                raise PyMongoError(f"Build job {job.key_id} vanished")
+            return BuildJob.from_document(document)
+
+        self._prune()
+        self.jobs[job.id] = job
+        self._latest[key] = job
+        previous_version = None if document is None else document.get("version")
+        job.task = asyncio.create_task(
+            self._run(job, credentials, rollout_scheduler, slot, previous_version)
+        )
+        return job
+
+    async def refresh(
+        self,
+        mac: str,
+        profile: str,
+        credentials: str,
+        rollout_scheduler: Optional[RolloutScheduler] = None,
+    ) -> Optional[str]:
+        """
+        The version of the box if its image is in the store, else None with
+        its job started or followed in the background, unless every build
+        slot is taken
+        """
+        version = self.ready_artifact(mac, profile)
+        if version is not None:
+            return version
+        try:
+            job = await self.start(mac, profile, credentials, rollout_scheduler)
+        except RolloutCapacityError:
+            return None
+        if job.state == "done" and self.store.has(job.version):
+            self._remember(job)
+            return job.version
+        if job.task is None and job.state != "failed":
+            self._follow_in_background(job)
+        return None
+
+    async def wait(self, job: BuildJob) -> BuildJob:
+        """
+        Wait for a job, then for its image in the store, downloaded here if
+        the job ran on another replica
+        """
+        if job.task is not None:
+            # Shielded, a box going away does not cancel the build
+            await asyncio.shield(job.task)
+            return job
+        job = await self._follow(job)
+        if job.state == "done":
+            job = await self._fetch(job)
+        return job
+
+    async def build(
+        self,
+        mac: str,
+        profile: str,
+        credentials: str,
+        rollout_scheduler: Optional[RolloutScheduler] = None,
+    ) -> BuildJob:
+        """
+        Start or join the job of a box and wait for it. A box which joined the
+        job of its profile, when the profile turned out not to share its
+        firmware any more, then waits for a job of its own.
+
+        Raises:
+            RolloutCapacityError: if a job would start without a build slot
+        """
+        job = await self.wait(
+            await self.start(mac, profile, credentials, rollout_scheduler)
+        )
+        if job.mac != mac and job.key != self.ptah_client.build_key(mac, profile):
+            job = await self.wait(
+                await self.start(mac, profile, credentials, rollout_scheduler)
+            )
+        return job
+
+    async def _run(
+        self,
+        job: BuildJob,
+        credentials: str,
+        rollout_scheduler: Optional[RolloutScheduler],
+        slot: Optional[RolloutSlot],
+        previous_version: Optional[str] = None,
+    ):
+        try:
+            prepared = await self.ptah_client.prepare(job.mac, job.profile, credentials)
+            job.version = prepared.ptah_version_hash
+            if not self.store.has(job.version):
+                job.state = "downloading"
+                await self._save(job)
+                await self._download(job.mac, credentials, job.version)
+            job.state = "done"
+        except asyncio.CancelledError:
+            job.state = "failed"
+            job.error = "Worker stopped"
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("Firmware build of %s failed: %s", job.mac, str(e))
+            job.state = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            await self._save(job)
+            if slot is not None:
+                await rollout_scheduler.release_quietly(slot)
+        if job.state == "done" and job.version != previous_version:
+            await self._announce(job, rollout_scheduler)
+
+    async def _announce(
+        self, job: BuildJob, rollout_scheduler: Optional[RolloutScheduler]
+    ):
+        """
+        Tell the connected boxes that the new version of a job is available:
+        its box, or the boxes of its profile in the open waves of the rollout
+        """
+        mac, profile = job.key
+        try:
+            if mac is not None:
+                await announce_firmware(job.version, macs=[mac])
+            elif rollout_scheduler is not None:
+                rollout = await rollout_scheduler.get_rollout(profile)
+                await announce_firmware(job.version, profile=profile, rollout=rollout)
+        except PyMongoError as e:
+            logging.warning("Firmware %s not announced: %s", job.version, str(e))
+
+    async def _save(self, job: BuildJob):
+        """Publish the state of a job run by this worker, renewing its claim"""
+        if not job.finished:
+            job.expires_at = time.time() + self.lease
+        try:
+            await self.documents.update_one(
+                {"_id": job.key_id, "job": job.id}, {"$set": job.to_document()}
+            )
+        except PyMongoError as e:
+            logging.warning("Build job %s not saved: %s", job.id, str(e))
+
+    async def _follow(self, job: BuildJob) -> BuildJob:
+        """Wait for a job run by another worker"""
+        while not job.finished:
+            await asyncio.sleep(_POLL_INTERVAL)
+            document = await self.documents.find_one({"_id": job.key_id})
+            if (
+                document is None
+                or document["job"] != job.id
+                or (
+                    document["state"] in ("building", "downloading")
+                    and document["expires_at"] < time.time()
+                )
+            ):
+                return dataclasses.replace(
+                    job, state="failed", error="Build job lost by its worker"
+                )
+            job = BuildJob.from_document(document)
+        return job
+
+    async def fetch(self, mac: str, version: str):
+        """
+        Download an image Ptah prepared for a box, unless the store has it
+
+        Raises:
+            requests.RequestException: if Ptah cannot be reached or fails
+        """
+        if not self.store.has(version):
+            credentials = await run_in_threadpool(self.issue_credentials, mac)
+            await self._download(mac, credentials, version)
+
+    async def _fetch(self, job: BuildJob) -> BuildJob:
+        """Download the image of a done job of another replica, if needed"""
+        try:
+            await self.fetch(job.mac, job.version)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("Firmware %s not downloaded: %s", job.version, str(e))
+            return dataclasses.replace(job, state="failed", error=str(e))
+        self._remember(job)
+        return job
+
+    def _follow_in_background(self, job: BuildJob):
+        if job.id in self._followers:
+            return
+        follower = asyncio.create_task(self.wait(job))
+        self._followers[job.id] = follower
+        follower.add_done_callback(lambda _: self._followers.pop(job.id, None))
+
+    def _remember(self, job: BuildJob):
+        """Keep a done job of another worker, to serve its version locally"""
+        latest = self._latest.get(job.key)
+        if latest is None or latest.finished:
+            self._prune()
+            self.jobs[job.id] = job
+            self._latest[job.key] = job
+
+    async def _download(self, mac: str, credentials: str, version: str):
+        """Download an image into the store, once per pod"""
+        while True:
+            with self.store.lock(version) as locked:
+                if locked:
+                    if not self.store.has(version):
+                        await self.ptah_client.download(
+                            mac, credentials, self.store, version
+                        )
+                    return
+            await asyncio.sleep(_POLL_INTERVAL)
+
+    def _prune(self):
+        expired_before = time.time() - self.job_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished_at < expired_before:
+                del self.jobs[job_id]
+                if self._latest.get(job.key) is job:
+                    del self._latest[job.key]
+
+    def ensure_indexes(self):
+        # In the background, the worker starts even when Mongo is unreachable
+        self._startup = asyncio.create_task(self._ensure_indexes())
+
+    async def _ensure_indexes(self):
+        try:
+            await self.documents.create_index("job")
+        except PyMongoError as e:
+            logging.error("Cannot index the build jobs: %s", str(e))
+
+    async def stop(self):
+        tasks = [job.task for job in self.jobs.values() if not job.finished]
+        tasks += list(self._followers.values())
+        if self._startup is not None:
+            tasks.append(self._startup)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+build_jobs: Optional[BuildJobs] = None
+
+
+def get_build_jobs() -> BuildJobs:
+    return build_jobs
+
+
+def init_build_jobs(
+    db: AsyncIOMotorDatabase,
+    ptah_client: PtahClient,
+    store: ArtifactStore,
+    issue_credentials: Callable[[str], str],
+    retry_after: int,
+    job_ttl: float,
+    lease: float,
+) -> BuildJobs:
+    global build_jobs
+    build_jobs = BuildJobs(
+        db, ptah_client, store, issue_credentials, retry_after, job_ttl, lease
+    )
+    build_jobs.ensure_indexes()
+    return build_jobs
+
+
+async def close_build_jobs():
+    global build_jobs
+    if build_jobs is not None:
+        await build_jobs.stop()
+        build_jobs = None
@@ -0,0 +1,186 @@
+"""
+Periodic pre-build of the firmware of every ptah profile in use.
+
+Every `interval` seconds, the distinct `ptah_profile` of the boxes are
+built through the build jobs, for one box of each profile in an open wave
+of its rollout, so that Ptah and the artifact store already have the image
+when the boxes ask for it. The builds hold the build slots of the rollout,
+and a profile none of whose boxes may upgrade is skipped. A Mongo lease
+makes a single worker of a single replica drive the builds.
+
+Every `fetch_interval` seconds, each worker loads the versions shared by
+the profiles from `firmware_versions`, whichever worker recorded them, and
+downloads their images into the store of its pod when missing: every
+replica serves the pre-built images without waiting on Ptah.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import PyMongoError
+from starlette.concurrency import run_in_threadpool
+
+from hermes.firmware.jobs import BuildJobs
+from hermes.firmware.rollout import (
+    RolloutCapacityError,
+    RolloutScheduler,
+    in_open_wave,
+)
+from hermes.mongodb.lease import MongoLease
+
+
+class FirmwarePrebuilder:
+    """Build the firmware of each profile in the background"""
+
+    interval: float
+    fetch_interval: float
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        build_jobs: BuildJobs,
+        rollout_scheduler: RolloutScheduler,
+        issue_credentials: Callable[[str], str],
+        interval: float,
+        fetch_interval: float,
+    ):
+        """
+        Args:
+            db (AsyncIOMotorDatabase): Database of the boxes and the lease
+            build_jobs (BuildJobs): Jobs the builds run as
+            rollout_scheduler (RolloutScheduler): Rollouts gating the builds
+            issue_credentials (Callable): JWT of a box from its MAC, blocking
+            interval (float): Seconds between two pre-builds
+            fetch_interval (float): Seconds between two refreshes of the
+                versions and images of the worker
+        """
+        self.boxes = db.boxes
+        self.build_jobs = build_jobs
+        self.rollout_scheduler = rollout_scheduler
+        self.issue_credentials = issue_credentials
+        self.interval = interval
+        self.fetch_interval = fetch_interval
+        # Outlives a run, renewed at the start of the next one
+        self.lease = MongoLease(db, "firmware_prebuild", 2 * interval)
+        self._task: Optional[asyncio.Task] = None
+
+    async def prebuild(self) -> dict[str, Optional[str]]:
+        """Build each profile in turn, return the versions (None if failed)"""
+        versions = {}
+        for profile in await self.boxes.distinct("ptah_profile"):
+            if not profile:
+                continue
+            mac = await self._upgradable_box(profile)
+            if mac is None:
+                continue
+            try:
+                credentials = await run_in_threadpool(self.issue_credentials, mac)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning("No credentials to pre-build %s: %s", profile, str(e))
+                versions[profile] = None
+                continue
+            try:
+                job = await self.build_jobs.build(
+                    mac, profile, credentials, self.rollout_scheduler
+                )
+            except RolloutCapacityError as e:
+                logging.warning("Pre-build of %s postponed: %s", profile, str(e))
+                versions[profile] = None
+                continue
+            versions[profile] = job.version if job.state == "done" else None
+        return versions
+
+    async def _upgradable_box(self, profile: str) -> Optional[str]:
+        """
+        MAC of a box of the profile in an open wave of its rollout, a profile
+        without rollout being fully rolled out (as on v2), None if none is
+        """
+        rollout = await self.rollout_scheduler.get_rollout(profile)
+        if rollout is None:
+            rollout = self.rollout_scheduler.default_rollout(profile)
+        async for box in self.boxes.find({"ptah_profile": profile}, {"mac": 1}):
+            if in_open_wave(rollout, str(box["mac"])):
+                return str(box["mac"])
+        return None
+
+    async def fetch(self) -> dict[str, Optional[str]]:
+        """
+        Refresh the shared versions of the worker, download their missing
+        images, return the versions downloaded (None if failed)
+        """
+        versions = self.build_jobs.ptah_client.versions
+        if versions is None:
+            return {}
+        fetched = {}
+        for profile, (version, mac) in (await versions.refresh()).items():
+            if self.build_jobs.store.has(version):
+                continue
+            try:
+                await self.build_jobs.fetch(mac, version)
+                fetched[profile] = version
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning("Pre-built %s not downloaded: %s", profile, str(e))
+                fetched[profile] = None
+        return fetched
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                await self.lease.release()
+            except PyMongoError:
+                pass
+
+    async def _run(self):
+        next_prebuild = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() >= next_prebuild:
+                    next_prebuild = time.monotonic() + self.interval
+                    if await self.lease.acquire():
+                        versions = await self.prebuild()
+                        logging.info("Firmware pre-built: %s", versions)
+                fetched = await self.fetch()
+                if fetched:
+                    logging.info("Pre-built firmware downloaded: %s", fetched)
+            except Exception:  # pylint: disable=broad-except
+                # Logged, the next run tries again
+                logging.exception("Firmware pre-build failed")
+            await asyncio.sleep(self.fetch_interval)
+
+
+firmware_prebuilder: Optional[FirmwarePrebuilder] = None
+
+
+def init_firmware_prebuilder(
+    db: AsyncIOMotorDatabase,
+    build_jobs: BuildJobs,
+    rollout_scheduler: RolloutScheduler,
+    issue_credentials: Callable[[str], str],
+    interval: float,
+    fetch_interval: float,
+) -> FirmwarePrebuilder:
+    global firmware_prebuilder
+    firmware_prebuilder = FirmwarePrebuilder(
+        db, build_jobs, rollout_scheduler, issue_credentials, interval, fetch_interval
+    )
+    firmware_prebuilder.start()
+    return firmware_prebuilder
+
+
+async def close_firmware_prebuilder():
+    global firmware_prebuilder
+    if firmware_prebuilder is not None:
+        await firmware_prebuilder.stop()
+        firmware_prebuilder = None
@@ -0,0 +1,169 @@
+"""
+Client of the Ptah firmware builder.
+
+The blocking requests calls run in the threadpool, so that a slow Ptah never
+stalls the event loop. Firmware versions are cached for `version_ttl`
+seconds, and concurrent lookups of the same version share one request.
+When the boxes of a profile share their version, it is looked up once for
+the whole profile.
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+import requests
+from starlette.concurrency import run_in_threadpool
+
+from hermes.api.models import PtahVersionResponse
+from hermes.firmware.artifacts import ArtifactStore
+from hermes.firmware.versions import FirmwareVersions
+
+# Versions cached above this count are dropped, the oldest first
+_MAX_VERSIONS = 100000
+
+
+class PtahClient:
+    """Calls to Ptah with the JWT of the box they are made for"""
+
+    base_url: str
+    version_ttl: float
+
+    def __init__(
+        self,
+        base_url: str,
+        version_ttl: float,
+        versions: Optional[FirmwareVersions] = None,
+    ):
+        """
+        Args:
+            base_url (str): Base URL of Ptah
+            version_ttl (float): Seconds a firmware version is cached, 0 to disable
+            versions (FirmwareVersions, optional): Versions of the boxes and
+                profiles, to share them by profile
+        """
+        self.base_url = base_url
+        self.version_ttl = version_ttl
+        self.versions = versions
+        self._versions: dict[tuple[str, str], tuple[float, str]] = {}
+        self._fetching: dict[tuple[Optional[str], str], asyncio.Future] = {}
+
+    def build_key(self, mac: str, profile: str) -> tuple[Optional[str], str]:
+        """Key of the builds of a box, the profile alone if its boxes share them"""
+        if self.versions is not None and self.versions.is_shared(profile):
+            return (None, profile)
+        return (mac, profile)
+
+    def _prepare(self, mac: str, profile: str, credentials: str) -> PtahVersionResponse:
+        response = requests.post(
+            f"{self.base_url}/v1/build/prepare/{mac}",
+            headers={"Authorization": f"Bearer {credentials}"},
+            json={"profile": profile},
+            timeout=180,
+        )
+        response.raise_for_status()
+        return PtahVersionResponse.model_validate_json(response.content)
+
+    async def prepare(
+        self, mac: str, profile: str, credentials: str
+    ) -> PtahVersionResponse:
+        """
+        Ask Ptah to prepare the firmware of a box
+
+        Raises:
+            requests.RequestException: if Ptah cannot be reached or fails
+        """
+        prepared = await run_in_threadpool(self._prepare, mac, profile, credentials)
+        self._remember(mac, profile, prepared.ptah_version_hash)
+        if self.versions is not None:
+            await self.versions.record(mac, profile, prepared.ptah_version_hash)
+        return prepared
+
+    def _download(
+        self, mac: str, credentials: str, store: ArtifactStore, version: str
+    ) -> str:
+        with requests.post(
+            f"{self.base_url}/v1/build/{mac}",
+            headers={"Authorization": f"Bearer {credentials}"},
+            stream=True,
+            timeout=180,
+        ) as response:
+            response.raise_for_status()
+            return store.put(version, response.iter_content(chunk_size=65536))
+
+    async def download(
+        self, mac: str, credentials: str, store: ArtifactStore, version: str
+    ) -> str:
+        """
+        Download the prepared firmware of a box into the store
+
+        Raises:
+            requests.RequestException: if Ptah cannot be reached or fails
+        """
+        return await run_in_threadpool(self._download, mac, credentials, store, version)
+
+    def cached_version(self, mac: str, profile: str) -> Optional[str]:
+        """Firmware version hash of a box, or of its profile, if it is cached and fresh"""
+        if self.versions is not None:
+            shared = self.versions.shared_version(profile)
+            if shared is not None:
+                return shared
+        cached = self._versions.get((mac, profile))
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    async def version(self, mac: str, profile: str, credentials: str) -> str:
+        """
+        Firmware version hash of a box, from the cache if it is fresh
+
+        Raises:
+            requests.RequestException: if Ptah cannot be reached or fails
+        """
+        cached = self.cached_version(mac, profile)
+        if cached is not None:
+            return cached
+
+        key = self.build_key(mac, profile)
+        fetching = self._fetching.get(key)
+        if fetching is not None:
+            return await asyncio.shield(fetching)
+
+        fetching = asyncio.get_running_loop().create_future()
+        self._fetching[key] = fetching
+        try:
+            prepared = await self.prepare(mac, profile, credentials)
+        except Exception as e:
+            fetching.set_exception(e)
+            # Retrieved by the waiters if any, not an unretrieved exception
+            fetching.exception()
+            raise
+        else:
+            fetching.set_result(prepared.ptah_version_hash)
+            return prepared.ptah_version_hash
+        finally:
+            del self._fetching[key]
+
+    def _remember(self, mac: str, profile: str, version: str):
+        if self.version_ttl <= 0:
+            return
+        key = (mac, profile)
+        self._versions.pop(key, None)
+        self._versions[key] = (time.monotonic() + self.version_ttl, version)
+        if len(self._versions) > _MAX_VERSIONS:
+            del self._versions[next(iter(self._versions))]
+
+
+ptah_client: Optional[PtahClient] = None
+
+
+def get_ptah_client() -> PtahClient:
+    return ptah_client
+
+
+def init_ptah_client(
+    base_url: str, version_ttl: float, versions: Optional[FirmwareVersions] = None
+) -> PtahClient:
+    global ptah_client
+    ptah_client = PtahClient(base_url, version_ttl, versions)
+    return ptah_client
@@ -0,0 +1,428 @@
+"""
+Staged firmware rollouts, persisted in Mongo.
+
+A rollout targets a ptah profile with a list of waves, each either a
+percentage of the boxes of the profile or an explicit list of MACs. Waves
+are opened one after the other (`current_wave`) and a box may upgrade once
+an open wave contains it. Percentages are cumulative and stable: a box is
+in the first p% when the hash of its MAC falls there, so opening the next
+wave only adds boxes.
+
+The Ptah builds and firmware downloads of each profile are capped by slots:
+documents of `rollout_slots` leased to a build job or a box. The caps hold
+across workers and replicas, and the slot of a crashed worker is freed when
+its lease expires.
+
+A rollout does not pin a version: Ptah builds per box, the waves only gate
+which boxes upgrade to what Ptah builds for them.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Literal, NamedTuple, Optional
+
+from common_models.hermes_models import Box
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from hermes.firmware.versions import FirmwareVersions
+from hermes.utils.events import announce_firmware
+
+SlotKind = Literal["build", "download"]
+
+
+class RolloutSlot(NamedTuple):
+    """A slot leased to one build job or one request of a box"""
+
+    id: str
+    holder: str
+
+
+class RolloutClosedError(RuntimeError):
+    """The box is in no open wave of a rollout."""
+
+
+class RolloutCapacityError(RuntimeError):
+    """Every slot of the profile is taken."""
+
+
+def wave_bucket(profile: str, mac: str) -> int:
+    """Stable bucket (0-99) of a box in the rollouts of a profile"""
+    digest = hashlib.sha256(f"{profile}:{mac}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % 100
+
+
+def in_open_wave(rollout: dict, mac: str) -> bool:
+    """Tell whether a box is in one of the open waves of a rollout"""
+    open_waves = rollout["waves"][: rollout["current_wave"] + 1]
+    percent = sum(wave.get("percent") or 0 for wave in open_waves)
+    if wave_bucket(rollout["_id"], mac) < percent:
+        return True
+    return any(mac in (wave.get("macs") or ()) for wave in open_waves)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class RolloutScheduler:
+    """The rollouts of the `rollouts` collection and their slots"""
+
+    default_profiles: tuple[str, ...]
+    max_builds: int
+    max_downloads: int
+    lease: datetime.timedelta
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        default_profiles: tuple[str, ...],
+        max_builds: int,
+        max_downloads: int,
+        lease: float,
+        versions: Optional[FirmwareVersions] = None,
+    ):
+        """
+        Args:
+            db (AsyncIOMotorDatabase): Database of the rollouts and their slots
+            default_profiles (tuple): Profiles fully rolled out without a rollout
+            max_builds (int): Concurrent Ptah builds of a default profile
+            max_downloads (int): Concurrent firmware downloads of a default profile
+            lease (float): Seconds a slot is held at most
+            versions (FirmwareVersions): Versions shared by the boxes of a profile
+        """
+        self.rollouts = db.rollouts
+        self.slots = db.rollout_slots
+        self.default_profiles = default_profiles
+        self.max_builds = max_builds
+        self.max_downloads = max_downloads
+        self.lease = datetime.timedelta(seconds=lease)
+        self.versions = versions
+        self._startup: Optional[asyncio.Task] = None
+
+    def default_rollout(self, profile: str) -> dict:
+        return {
+            "_id": profile,
+            "waves": [{"percent": 100}],
+            "current_wave": 0,
+            "max_builds": self.max_builds,
+            "max_downloads": self.max_downloads,
+        }
+
+    def is_default(self, profile: str) -> bool:
+        """Tell whether a profile is rolled out without a rollout document"""
+        return "*" in self.default_profiles or profile in self.default_profiles
+
+    async def get_rollout(self, profile: str) -> Optional[dict]:
+        """The rollout of a profile, the default one for the default profiles"""
+        rollout = await self.rollouts.find_one({"_id": profile})
+        if rollout is None and self.is_default(profile):
+            return self.default_rollout(profile)
+        return rollout
+
+    async def check(self, box: Box, open_without_rollout: bool = False) -> dict:
+        """
+        Get the rollout a box may upgrade with
+
+        Args:
+            box (Box): The box to upgrade
+            open_without_rollout (bool): Let the boxes of a profile without
+                rollout document upgrade, with the default caps
+
+        Raises:
+            RolloutClosedError: if the box is in no open wave
+        """
+        rollout = await self.get_rollout(box.ptah_profile)
+        if rollout is None and open_without_rollout:
+            rollout = self.default_rollout(box.ptah_profile)
+        if rollout is None:
+            raise RolloutClosedError(
+                f"No firmware rollout for the {box.ptah_profile} profile"
+            )
+        if not in_open_wave(rollout, str(box.mac)):
+            raise RolloutClosedError(
+                f"The box is not in the open waves of the {box.ptah_profile} rollout"
+            )
+        return rollout
+
+    async def acquire(self, profile: str, kind: SlotKind, owner: str) -> RolloutSlot:
+        """
+        Lease the first free slot of a profile to a build job or a box. The
+        holder is per call: concurrent downloads of a box each take a slot.
+
+        Raises:
+            RolloutCapacityError: if every slot is held
+        """
+        now = _now()
+        holder = f"{owner}/{uuid.uuid4().hex}"
+        slot = await self.slots.find_one_and_update(
+            {
+                "profile": profile,
+                "kind": kind,
+                "$or": [{"holder": None}, {"expires_at": {"$lt": now}}],
+            },
+            {"$set": {"holder": holder, "expires_at": now + self.lease}},
+            projection={"_id": 1},
+            sort=[("n", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if slot is None and await self._create_missing_slots(profile, kind):
+            return await self.acquire(profile, kind, owner)
+        if slot is None:
+            raise RolloutCapacityError(f"Every {kind} slot of {profile} is taken")
+        return RolloutSlot(slot["_id"], holder)
+
+    async def _create_missing_slots(self, profile: str, kind: SlotKind) -> bool:
+        """Create the slots of a profile which has none, tell if any was"""
+        if await self.slots.count_documents(
+            {"profile": profile, "kind": kind}, limit=1
+        ):
+            return False
+        rollout = await self.rollouts.find_one({"_id": profile})
+        if rollout is None:
+            rollout = self.default_rollout(profile)
+        count = rollout["max_builds" if kind == "build" else "max_downloads"]
+        await self.ensure_slots(profile, kind, count)
+        return count > 0
+
+    async def release(self, slot: RolloutSlot):
+        await self.slots.update_one(
+            {"_id": slot.id, "holder": slot.holder}, {"$set": {"holder": None}}
+        )
+
+    async def release_quietly(self, slot: RolloutSlot):
+        """Release a slot, leaving it to its lease if Mongo fails"""
+        try:
+            await self.release(slot)
+        except PyMongoError as e:
+            logging.warning("Rollout slot %s not released: %s", slot.id, str(e))
+
+    def releasing(self, response: Response, slot: RolloutSlot) -> Response:
+        """The response, releasing the slot once sent or when the box went away"""
+        return SlotResponse(response, self, slot)
+
+    @asynccontextmanager
+    async def slot(
+        self, profile: str, kind: SlotKind, owner: str
+    ) -> AsyncIterator[RolloutSlot]:
+        """
+        Hold a slot for the duration of the with block
+
+        Raises:
+            RolloutCapacityError: if every slot is held
+        """
+        slot = await self.acquire(profile, kind, owner)
+        try:
+            yield slot
+        finally:
+            await self.release(slot)
+
+    async def ensure_slots(self, profile: str, kind: SlotKind, count: int):
+        """Create the slots of a profile up to count, delete those above"""
+        if count > 0:
+            await self.slots.bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": f"{profile}:{kind}:{n}"},
+                        {
+                            "$setOnInsert": {
+                                "profile": profile,
+                                "kind": kind,
+                                "n": n,
+                                "holder": None,
+                            }
+                        },
+                        upsert=True,
+                    )
+                    for n in range(count)
+                ]
+            )
+        await self.slots.delete_many(
+            {"profile": profile, "kind": kind, "n": {"$gte": count}}
+        )
+
+    async def ensure_default_slots(self):
+        """Create the slots of the default profiles without a rollout"""
+        for profile in self.default_profiles:
+            if profile == "*":
+                continue
+            if await self.rollouts.find_one({"_id": profile}, {"_id": 1}) is None:
+                await self.ensure_slots(profile, "build", self.max_builds)
+                await self.ensure_slots(profile, "download", self.max_downloads)
+
+    def start(self):
+        # In the background, the worker starts even when Mongo is unreachable
+        self._startup = asyncio.create_task(self._ensure_default_slots())
+
+    async def stop(self):
+        if self._startup is not None:
+            self._startup.cancel()
+            try:
+                await self._startup
+            except asyncio.CancelledError:
+                pass
+            self._startup = None
+
+    async def _ensure_default_slots(self):
+        try:
+            await self.ensure_default_slots()
+        except PyMongoError as e:
+            logging.error("Cannot create the default rollout slots: %s", str(e))
+
+    async def save_rollout(
+        self,
+        profile: str,
+        waves: list[dict],
+        max_builds: int,
+        max_downloads: int,
+        current_wave: int = 0,
+    ) -> dict:
+        """Create or replace the rollout of a profile"""
+        rollout = {
+            "_id": profile,
+            "waves": waves,
+            "current_wave": min(current_wave, len(waves) - 1),
+            "max_builds": max_builds,
+            "max_downloads": max_downloads,
+            "updated_at": _now(),
+        }
+        await self.rollouts.replace_one({"_id": profile}, rollout, upsert=True)
+        await self.ensure_slots(profile, "build", max_builds)
+        await self.ensure_slots(profile, "download", max_downloads)
+        logging.info(
+            "Rollout of %s saved, wave %d open", profile, rollout["current_wave"]
+        )
+        return rollout
+
+    async def advance(self, profile: str) -> Optional[dict]:
+        """
+        Open the next wave of a rollout, None if there is no rollout. The
+        connected boxes of the open waves are told a firmware is available,
+        the version of the profile when its boxes share it.
+        """
+        rollout = await self.rollouts.find_one({"_id": profile})
+        if rollout is None:
+            return None
+        current_wave = min(rollout["current_wave"] + 1, len(rollout["waves"]) - 1)
+        rollout = await self.rollouts.find_one_and_update(
+            {"_id": profile},
+            {"$set": {"current_wave": current_wave, "updated_at": _now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if rollout is not None:
+            version = (
+                None if self.versions is None else self.versions.shared_version(profile)
+            )
+            await announce_firmware(version, profile=profile, rollout=rollout)
+        return rollout
+
+    async def delete(self, profile: str) -> bool:
+        """Delete a rollout, its profile goes back to the defaults"""
+        result = await self.rollouts.delete_one({"_id": profile})
+        if self.is_default(profile):
+            await self.ensure_slots(profile, "build", self.max_builds)
+            await self.ensure_slots(profile, "download", self.max_downloads)
+        else:
+            await self.slots.delete_many({"profile": profile})
+        return result.deleted_count > 0
+
+    async def status(self) -> list[dict]:
+        """The rollouts, default ones included, with their slots in use"""
+        rollouts = {rollout["_id"]: rollout async for rollout in self.rollouts.find({})}
+        for profile in self.default_profiles:
+            if profile == "*":
+                continue
+            rollouts.setdefault(profile, self.default_rollout(profile))
+
+        now = _now()
+        held = self.slots.aggregate(
+            [
+                {"$match": {"holder": {"$ne": None}, "expires_at": {"$gte": now}}},
+                {
+                    "$group": {
+                        "_id": {"profile": "$profile", "kind": "$kind"},
+                        "n": {"$sum": 1},
+                    }
+                },
+            ]
+        )
+        in_use = {
+            (group["_id"]["profile"], group["_id"]["kind"]): group["n"]
+            async for group in held
+        }
+        return [
+            {
+                **rollout,
+                "profile": profile,
+                "builds": in_use.get((profile, "build"), 0),
+                "downloads": in_use.get((profile, "download"), 0),
+            }
+            for profile, rollout in rollouts.items()
+        ]
+
+
+class SlotResponse(Response):
+    """
+    A response releasing a slot in a finally around its body, rather than a
+    background task, which Starlette skips when the client disconnects
+    """
+
+    def __init__(
+        self,
+        response: Response,
+        scheduler: RolloutScheduler,
+        slot: RolloutSlot,
+    ):
+        # pylint: disable=super-init-not-called
+        self.response = response
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+        self.scheduler = scheduler
+        self.slot = slot
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            # Shielded, the release outlives a cancelled request
+            await asyncio.shield(self.scheduler.release_quietly(self.slot))
+        if self.background is not None:
+            await self.background()
+
+
+rollout_scheduler: Optional[RolloutScheduler] = None
+
+
+def get_rollout_scheduler() -> Optional[RolloutScheduler]:
+    return rollout_scheduler
+
+
+def init_rollout_scheduler(
+    db: AsyncIOMotorDatabase,
+    default_profiles: tuple[str, ...],
+    max_builds: int,
+    max_downloads: int,
+    lease: float,
+    versions: Optional[FirmwareVersions] = None,
+) -> RolloutScheduler:
+    global rollout_scheduler
+    rollout_scheduler = RolloutScheduler(
+        db, default_profiles, max_builds, max_downloads, lease, versions
+    )
+    rollout_scheduler.start()
+    return rollout_scheduler
+
+
+async def close_rollout_scheduler():
+    global rollout_scheduler
+    if rollout_scheduler is not None:
+        await rollout_scheduler.stop()
+        rollout_scheduler = None
@@ -0,0 +1,73 @@
+"""
+Content-addressed firmware URLs, signed for a short time.
+
+Authorized boxes are redirected from their per-MAC download to
+`/v2/firmware/<name>?profile=..&expires=..&token=..`, where the name is the
+ETag of the image or delta (its version hash), the profile the one whose
+download slots the URL holds while Hermes sends it, and the token an HMAC
+of the three. Expiries are rounded up to `ttl` seconds, so every box of a
+profile getting the same image in the meantime gets the very same URL:
+reverse proxies and caches serve it from their copy, the content of a name
+never changes.
+"""
+
+import hashlib
+import hmac
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+
+class FirmwareUrlSigner:
+    """Sign and check the content-addressed firmware URLs"""
+
+    ttl: int
+
+    def __init__(self, secret: str, ttl: int):
+        """
+        Args:
+            secret (str): HMAC key, the same for every worker and replica
+            ttl (int): Seconds a URL is valid at least, at most twice that
+        """
+        self._key = secret.encode()
+        self.ttl = ttl
+
+    def _token(self, name: str, profile: str, expires: int) -> str:
+        return hmac.new(
+            self._key, f"{name}:{profile}:{expires}".encode(), hashlib.sha256
+        ).hexdigest()
+
+    def url(self, name: str, profile: str) -> str:
+        expires = (int(time.time()) // self.ttl + 2) * self.ttl
+        query = urlencode(
+            {
+                "profile": profile,
+                "expires": expires,
+                "token": self._token(name, profile, expires),
+            }
+        )
+        return f"/v2/firmware/{name}?{query}"
+
+    def verify(
+        self, name: str, profile: str, expires: int, token: str
+    ) -> Optional[int]:
+        """The seconds the URL is still valid for, None if expired or forged"""
+        remaining = expires - int(time.time())
+        if remaining <= 0 or not hmac.compare_digest(
+            token, self._token(name, profile, expires)
+        ):
+            return None
+        return remaining
+
+
+firmware_url_signer: Optional[FirmwareUrlSigner] = None
+
+
+def get_firmware_url_signer() -> Optional[FirmwareUrlSigner]:
+    return firmware_url_signer
+
+
+def init_firmware_url_signer(secret: str, ttl: int) -> FirmwareUrlSigner:
+    global firmware_url_signer
+    firmware_url_signer = FirmwareUrlSigner(secret, ttl)
+    return firmware_url_signer
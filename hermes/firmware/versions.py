@@ -0,0 +1,131 @@
+"""
+Firmware versions of the boxes, and their sharing by the boxes of a profile.
+
+Ptah builds per MAC, but only from the ptah profile of the box, so the
+boxes of a profile usually get the same version hash. The version of each
+box is kept in the `firmware_versions` collection. Once two boxes of a
+profile got the same version, it is the version of the whole profile:
+served to its other boxes for `ttl` seconds without asking Ptah, then
+refreshed by a single build.
+
+A box getting a version of its own (per-box customization) takes its
+profile back to per-MAC builds and downloads, until two boxes agree again.
+
+Each worker records the versions it got from Ptah, and refreshes those
+recorded by the others from the collection.
+"""
+
+import datetime
+import logging
+import time
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import PyMongoError
+
+
+class FirmwareVersions:
+    """The version hash of each box, and of the profiles sharing one"""
+
+    ttl: float
+    sharing: bool
+
+    def __init__(self, db: AsyncIOMotorDatabase, ttl: float, sharing: bool = True):
+        """
+        Args:
+            db (AsyncIOMotorDatabase): Database of the versions
+            ttl (float): Seconds the version of a profile is served without Ptah
+            sharing (bool): Share the versions by profile, else always per MAC
+        """
+        self.versions = db.firmware_versions
+        self.ttl = ttl
+        self.sharing = sharing
+        self._profiles: dict[str, tuple[float, str]] = {}
+
+    def is_shared(self, profile: str) -> bool:
+        """Tell whether the boxes of a profile share their version, even an expired one"""
+        return profile in self._profiles
+
+    def shared_version(self, profile: str) -> Optional[str]:
+        """The version of a profile if its boxes share a fresh one"""
+        shared = self._profiles.get(profile)
+        if shared is not None and shared[0] > time.monotonic():
+            return shared[1]
+        return None
+
+    async def record(self, mac: str, profile: str, version: str):
+        """Record the version Ptah gave to a box"""
+        try:
+            await self.versions.update_one(
+                {"_id": mac},
+                {
+                    "$set": {
+                        "profile": profile,
+                        "version": version,
+                        "updated_at": datetime.datetime.now(datetime.timezone.utc),
+                    }
+                },
+                upsert=True,
+            )
+            shared = self.sharing and (
+                await self.versions.count_documents(
+                    {"profile": profile, "version": version}, limit=2
+                )
+                >= 2
+            )
+        except PyMongoError as e:
+            logging.warning("Firmware version of %s not recorded: %s", mac, str(e))
+            return
+
+        if shared:
+            self._profiles[profile] = (time.monotonic() + self.ttl, version)
+        elif self._profiles.pop(profile, None) is not None:
+            logging.info("Firmware of %s no longer shared, built per box", profile)
+
+    async def refresh(self) -> dict[str, tuple[str, str]]:
+        """
+        Load the fresh versions shared by the boxes of each profile, recorded
+        by any worker: their version and the MAC of a box which got it
+        """
+        if not self.sharing:
+            return {}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        latest = self.versions.aggregate(
+            [
+                {
+                    "$match": {
+                        "updated_at": {
+                            "$gte": now - datetime.timedelta(seconds=self.ttl)
+                        }
+                    }
+                },
+                {"$sort": {"updated_at": -1}},
+                {
+                    "$group": {
+                        "_id": "$profile",
+                        "version": {"$first": "$version"},
+                        "mac": {"$first": "$_id"},
+                        "updated_at": {"$first": "$updated_at"},
+                    }
+                },
+            ]
+        )
+        shared = {}
+        async for profile in latest:
+            if (
+                await self.versions.count_documents(
+                    {"profile": profile["_id"], "version": profile["version"]},
+                    limit=2,
+                )
+                < 2
+            ):
+                continue
+            updated_at = profile["updated_at"]
+            if updated_at.tzinfo is None:
+                updated_at = updated_at.replace(tzinfo=datetime.timezone.utc)
+            expires = time.monotonic() + self.ttl - (now - updated_at).total_seconds()
+            cached = self._profiles.get(profile["_id"])
+            if cached is None or cached[0] < expires:
+                self._profiles[profile["_id"]] = (expires, profile["version"])
+            shared[profile["_id"]] = (profile["version"], profile["mac"])
+        return shared
@@ -0,0 +1,4 @@
+"""
+Fleet-wide tools working on box documents read from files or straight from
+Mongo, without the API: no hermes.env, so they run anywhere (CI, laptop).
+"""
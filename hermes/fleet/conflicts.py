@@ -0,0 +1,221 @@
+"""
+Address and VLAN conflicts between boxes.
+
+Addresses and prefixes are indexed as integer ranges. CIDR blocks are either
+nested or disjoint, so the blocks overlapping a query are its supernets,
+found with one hash lookup per indexed prefix length, and its subnets, found
+by bisecting the ranges sorted by their first address. A query is thus
+O(log n + matches), and a full fleet scan O(n log n).
+
+Conflicts checked:
+    wan_ipv4: the same WAN IPv4 address on two unets
+    wan_ipv6: the same WAN IPv6 address on two unets
+    ipv6_prefix: overlapping delegated IPv6 prefixes
+    lan_vlan: two unets of a box with the same LAN VLAN (so the same route
+        table 6<vlan>), or a LAN VLAN equal to one of the box WAN VLANs
+"""
+
+import bisect
+import ipaddress
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from typing import Iterable, Iterator, Literal, Optional
+
+IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+ConflictKind = Literal["wan_ipv4", "wan_ipv6", "ipv6_prefix", "lan_vlan"]
+
+# The management VLAN is always on the switch of the box
+MANAGEMENT_VLAN = 65
+
+# Projection of the box documents on the fields read by the index
+INDEXED_FIELDS = {"mac": 1, "unets.unet_id": 1, "unets.network": 1, "wan_vlan": 1}
+
+
+@dataclass(frozen=True)
+class Owner:
+    mac: str
+    unet_id: Optional[str]
+
+
+@dataclass
+class Conflict:
+    kind: ConflictKind
+    value: str
+    owner: Owner
+    other_value: str
+    other_owner: Owner
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "a": {**asdict(self.owner), "value": self.value},
+            "b": {**asdict(self.other_owner), "value": self.other_value},
+        }
+
+
+class PrefixIndex:
+    """CIDR blocks of one address family and their owners"""
+
+    def __init__(self, entries: Iterable[tuple[IPNetwork, Owner]]):
+        self.entries = sorted(
+            entries,
+            key=lambda entry: (int(entry[0].network_address), entry[0].prefixlen),
+        )
+        self._firsts = [int(network.network_address) for network, _ in self.entries]
+        self._by_length: dict[int, dict[int, list[int]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        for position, (network, _) in enumerate(self.entries):
+            self._by_length[network.prefixlen][int(network.network_address)].append(
+                position
+            )
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def supernets(self, network: IPNetwork) -> Iterator[int]:
+        """Positions of the indexed blocks containing or equal to `network`"""
+        address = int(network.network_address)
+        for length, blocks in self._by_length.items():
+            if length > network.prefixlen:
+                continue
+            host_bits = network.max_prefixlen - length
+            yield from blocks.get(address >> host_bits << host_bits, ())
+
+    def subnets(self, network: IPNetwork) -> Iterator[int]:
+        """Positions of the indexed blocks strictly inside `network`"""
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        position = bisect.bisect_left(self._firsts, first)
+        while position < len(self.entries) and self._firsts[position] <= last:
+            if self.entries[position][0].prefixlen > network.prefixlen:
+                yield position
+            position += 1
+
+    def overlapping(self, network: IPNetwork) -> list[tuple[IPNetwork, Owner]]:
+        """Indexed blocks overlapping `network`"""
+        positions = [*self.supernets(network), *self.subnets(network)]
+        return [self.entries[position] for position in sorted(set(positions))]
+
+    def overlaps(self) -> Iterator[tuple[int, int]]:
+        """Every pair of overlapping blocks, each pair once"""
+        for position, (network, _) in enumerate(self.entries):
+            # Seen from the more specific block, the other one is a supernet
+            for other in self.supernets(network):
+                if other == position:
+                    continue
+                other_network = self.entries[other][0]
+                if other_network.prefixlen == network.prefixlen and other < position:
+                    continue
+                yield position, other
+
+
+def _host(address: str) -> IPNetwork:
+    return ipaddress.ip_network(ipaddress.ip_interface(address).ip)
+
+
+def _document_unets(document: dict) -> Iterator[tuple[Owner, dict]]:
+    for unet in document.get("unets") or []:
+        yield Owner(document.get("mac"), unet.get("unet_id")), unet.get("network") or {}
+
+
+class FleetIndex:
+    """Address indexes over the unets of every box"""
+
+    def __init__(self, documents: Iterable[dict]):
+        """
+        Args:
+            documents (Iterable[dict]): Box documents, only their mac, unets
+                and wan_vlan are read. Invalid values are skipped: they are
+                reported by the fleet validation.
+        """
+        entries: dict[ConflictKind, list[tuple[IPNetwork, Owner]]] = defaultdict(list)
+        self.documents: dict[str, dict] = {}
+        for document in documents:
+            self.documents[document.get("mac")] = document
+            for kind, network, owner in self.document_entries(document):
+                entries[kind].append((network, owner))
+        self.indexes = {
+            kind: PrefixIndex(entries[kind])
+            for kind in ("wan_ipv4", "wan_ipv6", "ipv6_prefix")
+        }
+
+    @staticmethod
+    def document_entries(
+        document: dict,
+    ) -> Iterator[tuple[ConflictKind, IPNetwork, Owner]]:
+        for owner, network in _document_unets(document):
+            values = [
+                ("wan_ipv4", (network.get("wan_ipv4") or {}).get("ip"), _host),
+                ("wan_ipv6", (network.get("wan_ipv6") or {}).get("ip"), _host),
+                ("ipv6_prefix", network.get("ipv6_prefix"), ipaddress.ip_network),
+            ]
+            for kind, value, parse in values:
+                if value is None:
+                    continue
+                try:
+                    yield kind, parse(str(value)), owner
+                except ValueError:
+                    continue
+
+    def conflicts(self) -> list[Conflict]:
+        """Full fleet scan"""
+        conflicts = []
+        for kind, index in self.indexes.items():
+            for position, other in index.overlaps():
+                network, owner = index.entries[position]
+                other_network, other_owner = index.entries[other]
+                conflicts.append(
+                    Conflict(kind, str(network), owner, str(other_network), other_owner)
+                )
+        for document in self.documents.values():
+            conflicts.extend(vlan_conflicts(document))
+        return conflicts
+
+    def box_conflicts(self, document: dict) -> list[Conflict]:
+        """Conflicts of a box, new or indexed, with the other boxes and itself"""
+        mac = document.get("mac")
+        conflicts = []
+        for kind, network, owner in self.document_entries(document):
+            for other_network, other_owner in self.indexes[kind].overlapping(network):
+                if other_owner.mac == mac:
+                    continue
+                conflicts.append(
+                    Conflict(kind, str(network), owner, str(other_network), other_owner)
+                )
+
+        # Within the box, the index may hold an older version of it
+        own = list(self.document_entries(document))
+        for position, (kind, network, owner) in enumerate(own):
+            for other_kind, other_network, other_owner in own[position + 1 :]:
+                if other_kind == kind and network.overlaps(other_network):
+                    conflicts.append(
+                        Conflict(
+                            kind, str(network), owner, str(other_network), other_owner
+                        )
+                    )
+        conflicts.extend(vlan_conflicts(document))
+        return conflicts
+
+
+def vlan_conflicts(document: dict) -> list[Conflict]:
+    """LAN VLANs of a box used twice, or also used as WAN or management VLAN"""
+    mac = document.get("mac")
+    reserved = {MANAGEMENT_VLAN: Owner(mac, None)}
+    for wan_vlan in document.get("wan_vlan") or []:
+        reserved.setdefault(wan_vlan.get("vlan_id"), Owner(mac, None))
+
+    conflicts = []
+    lan_vlans: dict[int, Owner] = {}
+    for owner, network in _document_unets(document):
+        lan_vlan = (network.get("lan_ipv4") or {}).get("vlan")
+        if lan_vlan is None:
+            continue
+        other_owner = lan_vlans.get(lan_vlan) or reserved.get(lan_vlan)
+        if other_owner is not None:
+            conflicts.append(
+                Conflict("lan_vlan", str(lan_vlan), owner, str(lan_vlan), other_owner)
+            )
+        lan_vlans.setdefault(lan_vlan, owner)
+    return conflicts
@@ -0,0 +1,89 @@
+"""Box documents sources and process-parallel map over them."""
+
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+import pymongo
+from common_models.hermes_models import Box
+
+T = TypeVar("T")
+
+# Items sent to the worker processes per round trip
+_CHUNK_SIZE = 32
+
+
+def load_box(document: dict) -> Box:
+    """Validate a box document, as stored in Mongo or exported with its $oid"""
+    if "_id" in document:
+        object_id = document["_id"]
+        if isinstance(object_id, dict) and "$oid" in object_id:
+            object_id = object_id["$oid"]
+        document["_id"] = str(object_id)
+    return Box.model_validate(document)
+
+
+def _read_ndjson(lines: Iterable[str]) -> Iterator[dict]:
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_documents(paths: list[str]) -> Iterator[dict]:
+    """
+    Box documents of .json files (one document or a list, as exported by
+    mongoexport --jsonArray), .ndjson files and directories of those,
+    or NDJSON on stdin for '-'
+    """
+    for path in paths or ["-"]:
+        if path == "-":
+            yield from _read_ndjson(sys.stdin)
+            continue
+        path = Path(path)
+        files = sorted(path.rglob("*.*json")) if path.is_dir() else [path]
+        for file in files:
+            with open(file, encoding="utf-8") as f:
+                if file.suffix == ".ndjson":
+                    yield from _read_ndjson(f)
+                    continue
+                content = json.load(f)
+            yield from content if isinstance(content, list) else [content]
+
+
+def mongo_documents(
+    uri: str,
+    db_name: str,
+    collection: str = "boxes",
+    query: Optional[dict] = None,
+    batch_size: int = 1000,
+    projection: Optional[dict] = None,
+) -> Iterator[dict]:
+    """Box documents of a collection, fetched `batch_size` at a time"""
+    client = pymongo.MongoClient(uri)
+    try:
+        cursor = client[db_name][collection].find(
+            query or {}, projection, batch_size=batch_size
+        )
+        yield from cursor
+    finally:
+        client.close()
+
+
+def process_map(
+    function: Callable[[dict], T], documents: Iterable[dict], jobs: int
+) -> Iterator[T]:
+    """
+    Map `function` over the documents in `jobs` processes, in order.
+    Documents are read chunk by chunk, so memory does not grow with the input.
+    """
+    if jobs <= 1:
+        yield from map(function, documents)
+        return
+
+    documents = iter(documents)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while chunk := list(islice(documents, jobs * _CHUNK_SIZE)):
+            yield from executor.map(function, chunk, chunksize=_CHUNK_SIZE)
@@ -0,0 +1,116 @@
+"""
+Fleet validation: check that every box document matches the Box model and
+that its config can be rendered, and group the failures by kind.
+"""
+
+import re
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Literal, Optional
+
+from pydantic import ValidationError
+
+from hermes.fleet.documents import load_box
+from hermes.rendering.configs import get_renderer
+
+Stage = Literal["schema", "render"]
+
+# Failing MACs kept per kind in the summary, the report has all of them
+_SAMPLE_SIZE = 5
+
+
+@dataclass
+class BoxFailure:
+    mac: Optional[str]
+    stage: Stage
+    kind: str
+    message: str
+
+
+def _error_kind(error: dict) -> str:
+    """Pydantic error without its list indexes, e.g. unets.*.wifi.ssid: missing"""
+    location = ".".join(
+        "*" if isinstance(part, int) else str(part) for part in error["loc"]
+    )
+    return f"{location}: {error['type']}"
+
+
+def _render_error_kind(message: str) -> str:
+    """Message with its numbers masked, so that every VLAN id shares a kind"""
+    return re.sub(r"\d+", "N", message)
+
+
+def validate_document(document: dict, render: bool = True) -> list[BoxFailure]:
+    """Failures of a box document, empty if it is valid"""
+    mac = document.get("mac")
+    try:
+        box = load_box(document)
+    except ValidationError as e:
+        return [
+            BoxFailure(mac, "schema", _error_kind(error), error["msg"])
+            for error in e.errors(include_url=False)
+        ]
+    if not render:
+        return []
+
+    render_configfile = get_renderer(box.type)
+    if render_configfile is None:
+        return [BoxFailure(mac, "render", "unsupported box type", box.type)]
+    try:
+        render_configfile(box)
+    except ValueError as e:
+        return [BoxFailure(mac, "render", _render_error_kind(str(e)), str(e))]
+    return []
+
+
+@dataclass
+class FleetReport:
+    total: int = 0
+    invalid: int = 0
+    failures: list[BoxFailure] = field(default_factory=list)
+
+    def add(self, failures: list[BoxFailure]):
+        self.total += 1
+        if failures:
+            self.invalid += 1
+            self.failures.extend(failures)
+
+    def by_kind(self) -> dict[tuple[Stage, str], list[Optional[str]]]:
+        """Failing MACs per (stage, kind), the most frequent kinds first"""
+        kinds: dict[tuple[Stage, str], list[Optional[str]]] = defaultdict(list)
+        for failure in self.failures:
+            macs = kinds[(failure.stage, failure.kind)]
+            if failure.mac not in macs:
+                macs.append(failure.mac)
+        return dict(sorted(kinds.items(), key=lambda item: -len(item[1])))
+
+    def summary(self) -> str:
+        lines = [f"{self.total - self.invalid} boxes out of {self.total} are valid."]
+        for (stage, kind), macs in self.by_kind().items():
+            sample = ", ".join(str(mac) for mac in macs[:_SAMPLE_SIZE])
+            more = (
+                f", ... (+{len(macs) - _SAMPLE_SIZE})"
+                if len(macs) > _SAMPLE_SIZE
+                else ""
+            )
+            lines.append(f"  [{stage}] {kind}: {len(macs)} boxes ({sample}{more})")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "valid": self.total - self.invalid,
+            "invalid": self.invalid,
+            "kinds": [
+                {"stage": stage, "kind": kind, "count": len(macs), "macs": macs}
+                for (stage, kind), macs in self.by_kind().items()
+            ],
+            "failures": [asdict(failure) for failure in self.failures],
+        }
+
+
+def build_report(results: Iterable[list[BoxFailure]]) -> FleetReport:
+    report = FleetReport()
+    for failures in results:
+        report.add(failures)
+    return report
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings for the multi-worker mode:
+
+    gunicorn -c hermes/gunicorn_conf.py hermes.main:app
+
+The app is imported once in the master (preload_app) so that the immutable
+default renders are shared copy-on-write by the forked workers. Configs
+rendered by any worker go to the render cache shared through /dev/shm.
+"""
+
+import gc
+import os
+
+from hermes.rendering.pool import cpu_limit
+
+bind = os.getenv("BIND", "[::]:8000")
+workers = int(os.getenv("WEB_CONCURRENCY") or cpu_limit())
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# Each worker already runs on its own core: one render process per worker
+# keeps its event loop free without oversubscribing the CPU limit
+os.environ.setdefault("RENDER_POOL_WORKERS", "1")
+
+
+def pre_fork(server, worker):
+    # Objects created by the preload are never collected, keep the garbage
+    # collector from writing to (and so copying) their memory pages
+    gc.freeze()
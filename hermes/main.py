@@ -3,20 +3,144 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from hermes.api.dependencies import issue_box_credentials
 from hermes.env import ENV
-from hermes.mongodb.db import close_db, init_db
+from hermes.firmware.artifacts import ArtifactStore
+from hermes.firmware.deltas import close_delta_builder, init_delta_builder
+from hermes.firmware.jobs import close_build_jobs, init_build_jobs
+from hermes.firmware.prebuild import close_firmware_prebuilder, init_firmware_prebuilder
+from hermes.firmware.ptah import init_ptah_client
+from hermes.firmware.rollout import close_rollout_scheduler, init_rollout_scheduler
+from hermes.firmware.urls import init_firmware_url_signer
+from hermes.firmware.versions import FirmwareVersions
+from hermes.mongodb.db import close_db, get_db, init_db
+from hermes.mongodb.watcher import close_box_watcher, init_box_watcher
 from hermes.api.routes import router as api_router
+from hermes.rendering.ac2350 import render_default_configfile
+from hermes.rendering.ac2350_templates import compiled_templates
+from hermes.rendering.cache import init_render_cache
+from hermes.rendering.configs import (
+    close_prerender_lease,
+    init_prerender_lease,
+    notify_config_change,
+    prerender_changed_box,
+)
+from hermes.rendering.pool import (
+    close_render_pool,
+    init_render_pool,
+    render_pool_pressure,
+)
+from hermes.utils.admission import (
+    AdmissionControlMiddleware,
+    ConcurrencyLimiter,
+    TokenBuckets,
+)
+from hermes.utils.events import (
+    close_event_hub,
+    deliver_announcement,
+    init_event_hub,
+)
+from hermes.utils.poll_hints import PollHintMiddleware, init_poll_advisor
+from hermes.utils.profiling import ProfilingMiddleware
+from hermes.utils.server_timing import ServerTimingMiddleware
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     init_db()
+    ptah_client = init_ptah_client(
+        ENV.ptah_base_url,
+        ENV.ptah_version_ttl,
+        FirmwareVersions(
+            get_db(), ENV.ptah_version_ttl, sharing=ENV.firmware_share_profiles
+        ),
+    )
+    artifact_store = ArtifactStore(
+        ENV.firmware_cache_dir, ENV.firmware_cache_max_artifacts
+    )
+    build_jobs = init_build_jobs(
+        get_db(),
+        ptah_client,
+        artifact_store,
+        issue_box_credentials,
+        retry_after=ENV.firmware_job_retry_after,
+        job_ttl=ENV.firmware_job_ttl,
+        lease=ENV.firmware_job_lease,
+    )
+    if ENV.firmware_deltas_enabled:
+        init_delta_builder(
+            artifact_store,
+            ENV.firmware_delta_max_percent / 100,
+            ENV.firmware_delta_max_image_bytes,
+        )
+    if ENV.firmware_redirect_enabled:
+        init_firmware_url_signer(ENV.firmware_url_secret, ENV.firmware_url_ttl)
+    rollout_scheduler = init_rollout_scheduler(
+        get_db(),
+        ENV.rollout_default_profiles,
+        max_builds=ENV.rollout_max_builds,
+        max_downloads=ENV.rollout_max_downloads,
+        lease=ENV.rollout_slot_lease,
+        versions=ptah_client.versions,
+    )
+    if ENV.firmware_prebuild_enabled:
+        init_firmware_prebuilder(
+            get_db(),
+            build_jobs,
+            rollout_scheduler,
+            issue_box_credentials,
+            interval=ENV.firmware_prebuild_interval,
+            fetch_interval=ENV.firmware_fetch_interval,
+        )
+    if ENV.render_cache_enabled:
+        init_render_cache(
+            ENV.render_cache_backend,
+            ENV.render_cache_dir,
+            ENV.render_cache_max_bytes,
+            db=get_db(),
+        )
+    if ENV.render_pool_enabled:
+        init_render_pool(
+            workers=ENV.render_pool_workers,
+            max_queue=ENV.render_pool_max_queue,
+            inline_max_ms=ENV.render_inline_max_ms,
+        )
+    box_watcher = init_box_watcher(get_db(), watch=ENV.box_watch_enabled)
+    init_prerender_lease(get_db(), ENV.prerender_lease)
+    box_watcher.subscribe(prerender_changed_box)
+    box_watcher.subscribe(poll_advisor.box_changed)
+    if ENV.events_enabled:
+        init_event_hub(ENV.events_heartbeat, ENV.events_max_connections)
+        box_watcher.subscribe(notify_config_change)
+        box_watcher.subscribe_events(deliver_announcement)
     try:
         yield
     finally:
+        await close_box_watcher()
+        await close_prerender_lease()
+        await close_event_hub()
+        await close_rollout_scheduler()
+        await close_firmware_prebuilder()
+        await close_build_jobs()
+        await close_delta_builder()
+        close_render_pool()
         close_db()
 
 
+# Rendered at import so that preloaded workers share them copy-on-write
+render_default_configfile()
+compiled_templates()
+
+poll_advisor = init_poll_advisor(
+    base_interval=ENV.sync_poll_interval,
+    min_interval=ENV.poll_min_interval,
+    max_interval=ENV.poll_max_interval,
+    target_rate=ENV.poll_target_rate,
+    jitter=ENV.poll_jitter_percent / 100,
+    recent_change_window=ENV.poll_recent_change_window,
+    pressure_sources=(render_pool_pressure,),
+)
+
 app = FastAPI(lifespan=lifespan)
 
 # Enable CORS (for swagger)
@@ -27,6 +151,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(ProfilingMiddleware)
+
+if ENV.server_timing_enabled:
+    app.add_middleware(
+        ServerTimingMiddleware,
+        path_prefixes=("/v1/sysupgrade", "/v2/config", "/v2/ptah", "/v2/sync"),
+    )
+
+app.add_middleware(
+    PollHintMiddleware,
+    advisor=poll_advisor,
+    path_prefixes=("/v2/config", "/v2/ptah", "/v2/sync"),
+    unpolled_prefixes=("/v2/ptah/download", "/v2/ptah/jobs"),
+)
+
+# Outermost, so that refused requests cost nothing else
+if ENV.admission_enabled:
+    app.add_middleware(
+        AdmissionControlMiddleware,
+        route_classes={
+            "render": (
+                ("/v2/config", "/v2/sync", "/v1/config"),
+                ConcurrencyLimiter(
+                    ENV.admission_render_limit,
+                    ENV.admission_max_queue,
+                    ENV.admission_queue_timeout,
+                ),
+            ),
+            "firmware": (
+                ("/v2/ptah/download", "/v2/firmware", "/v1/sysupgrade"),
+                ConcurrencyLimiter(
+                    ENV.admission_firmware_limit,
+                    ENV.admission_max_queue,
+                    ENV.admission_queue_timeout,
+                ),
+            ),
+            "long_poll": (
+                (),
+                ConcurrencyLimiter(ENV.admission_long_poll_limit, 0, 0),
+            ),
+        },
+        long_poll_class="long_poll",
+        mac_buckets=(
+            TokenBuckets(
+                ENV.admission_mac_rate_per_minute / 60, ENV.admission_mac_burst
+            )
+            if ENV.admission_mac_rate_per_minute > 0
+            else None
+        ),
+        retry_after=ENV.admission_retry_after,
+        retry_jitter=ENV.admission_retry_jitter,
+    )
+
 app.include_router(api_router)
 
 
@@ -7,6 +7,7 @@ from netaddr import EUI
 from common_models.hermes_models import Box
 
 from hermes.env import ENV
+from hermes.utils.server_timing import timed
 
 database: Optional[AsyncIOMotorDatabase] = None
 db_client: Optional[AsyncIOMotorClient] = None
@@ -37,9 +38,16 @@ def close_db():
 
 async def get_box_by_mac(db: AsyncIOMotorDatabase, mac: EUI) -> Box:
     """Get a box by its MAC address."""
-    res = await db.boxes.find_one({"mac": str(mac)})
+    with timed("db"):
+        res = await db.boxes.find_one({"mac": str(mac)})
     if res is None:
         raise ValueError(f"Box with MAC address {str(mac)} not found")
-    res["_id"] = str(res["_id"])
-    box = Box.model_validate(res)
+    with timed("validate"):
+        box = parse_box(res)
     return box
+
+
+def parse_box(document: dict) -> Box:
+    """Validate a box document as read from the boxes collection."""
+    document["_id"] = str(document["_id"])
+    return Box.model_validate(document)
@@ -0,0 +1,104 @@
+"""
+Leases held in the `leases` collection, so that a periodic task runs on
+one worker of one replica at a time.
+
+The holder renews its lease before it expires; a lease whose holder died
+expires and is taken by another worker.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import socket
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+
+def worker_id() -> str:
+    """Identifier of this worker, unique across the replicas"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class MongoLease:
+    """A named lease, taken or renewed for `duration` seconds"""
+
+    name: str
+    duration: datetime.timedelta
+
+    def __init__(self, db: AsyncIOMotorDatabase, name: str, duration: float):
+        """
+        Args:
+            db (AsyncIOMotorDatabase): Database of the leases
+            name (str): Name of the lease
+            duration (float): Seconds the lease is held without a renewal
+        """
+        self.leases = db.leases
+        self.name = name
+        self.duration = datetime.timedelta(seconds=duration)
+        self.holder = worker_id()
+
+    async def acquire(self) -> bool:
+        """Take or renew the lease, False if another worker holds it"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            lease = await self.leases.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"holder": self.holder}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {"holder": self.holder, "expires_at": now + self.duration}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by another worker, the upsert collided with its lease
+            return False
+        return lease["holder"] == self.holder
+
+    async def release(self):
+        await self.leases.delete_one({"_id": self.name, "holder": self.holder})
+
+
+class HeldLease:
+    """
+    A lease kept renewed in the background, for the tasks triggered by
+    events every worker receives (change streams) rather than by a timer:
+    `held` tells without a round trip whether this worker should run them.
+    """
+
+    def __init__(self, lease: MongoLease):
+        self.lease = lease
+        self.held = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._renew())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if self.held:
+                self.held = False
+                try:
+                    await self.lease.release()
+                except PyMongoError:
+                    pass
+
+    async def _renew(self):
+        while True:
+            try:
+                self.held = await self.lease.acquire()
+            except PyMongoError as e:
+                logging.warning("Lease %s not renewed: %s", self.lease.name, str(e))
+                self.held = False
+            # Renewed well before it expires
+            await asyncio.sleep(self.lease.duration.total_seconds() / 3)
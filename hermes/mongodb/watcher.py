@@ -0,0 +1,263 @@
+"""
+Notifications of box document changes.
+
+A single change stream on the boxes collection is shared by every
+subscriber of the worker. Changes can also be published explicitly, by the
+box-management webhook or when the database is not a replica set (change
+streams are not available on a standalone mongod).
+
+Deleted boxes are published with None, their MAC read from the pre-image
+of the document: enable `changeStreamPreAndPostImages` on the boxes
+collection, deletes are otherwise not seen by the stream subscribers.
+
+Requests waiting for the change of one box (long-polls) register a
+BoxChangeWaiter, woken after the subscribers by the changes of that box.
+
+The same stream carries the announcements inserted in `box_events`
+(firmware events of the admin API): a worker receiving an announcement
+inserts it, and every worker of every replica delivers it to its own
+connections. Without a change stream, announcements stay in the worker.
+"""
+
+import asyncio
+import datetime
+import logging
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo.errors import OperationFailure, PyMongoError
+from common_models.hermes_models import Box
+
+from hermes.mongodb.db import parse_box
+
+BoxChangeCallback = Callable[[str, Optional[Box]], Awaitable[None]]
+BoxEventCallback = Callable[[dict], Awaitable[None]]
+
+# Announcements fanned out to every worker by the change stream
+EVENTS_COLLECTION = "box_events"
+# Seconds the announcements are kept, only the stream reads them
+_EVENTS_TTL = 3600
+
+# Returned by mongod when change streams are used outside of a replica set
+_CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+_RETRY_DELAY = 5
+
+
+class BoxChangeWaiter:
+    """The changes of one box since the waiter was registered"""
+
+    def __init__(self):
+        self._changed = asyncio.Event()
+        self._box: Optional[Box] = None
+
+    def notify(self, box: Optional[Box]):
+        self._box = box
+        self._changed.set()
+
+    async def next_change(self, timeout: float) -> Optional[Box]:
+        """
+        Wait for the next change of the box, or return the pending one
+
+        Returns:
+            Optional[Box]: The latest box, None if its document is invalid
+        Raises:
+            asyncio.TimeoutError: if the box did not change within timeout seconds
+        """
+        await asyncio.wait_for(self._changed.wait(), timeout=max(0, timeout))
+        self._changed.clear()
+        return self._box
+
+
+class BoxChangeWatcher:
+    """Dispatch box changes to the subscribers, with the new box (None if deleted)"""
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.db = db
+        self.subscribers: list[BoxChangeCallback] = []
+        self.event_subscribers: list[BoxEventCallback] = []
+        self.waiters: dict[str, set[BoxChangeWaiter]] = {}
+        # Whether the change stream is open, announcements go through it
+        self.streaming = False
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, callback: BoxChangeCallback):
+        self.subscribers.append(callback)
+
+    def subscribe_events(self, callback: BoxEventCallback):
+        self.event_subscribers.append(callback)
+
+    def unsubscribe(self, callback: BoxChangeCallback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    @contextmanager
+    def wait_for_changes(self, mac: str) -> Iterator[BoxChangeWaiter]:
+        """
+        Register a waiter for the changes of a box, for the duration of the
+        with block. Register it before reading the box so no change is missed.
+
+        Args:
+            mac (str): MAC address of the box, as stored in its document
+        """
+        waiter = BoxChangeWaiter()
+        self.waiters.setdefault(mac, set()).add(waiter)
+        try:
+            yield waiter
+        finally:
+            waiters = self.waiters.get(mac)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.waiters[mac]
+
+    async def publish(self, mac: str, box: Optional[Box]):
+        """Notify the subscribers, then the waiters of the box, of a box change"""
+        for callback in list(self.subscribers):
+            try:
+                await callback(mac, box)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Box change subscriber failed for %s", mac)
+        # Subscribers first, so that the waiters find the prerendered config
+        for waiter in list(self.waiters.get(mac, ())):
+            waiter.notify(box)
+
+    async def publish_event(self, event: dict):
+        """Notify the event subscribers of this worker of an announcement"""
+        for callback in list(self.event_subscribers):
+            try:
+                await callback(event)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Box event subscriber failed")
+
+    async def announce(self, event: dict) -> bool:
+        """
+        Deliver an announcement to every worker through the change stream,
+        or only to this one when the stream is not open
+
+        Returns:
+            bool: True if every worker receives it
+        """
+        if self.streaming:
+            try:
+                await self.db[EVENTS_COLLECTION].insert_one(
+                    {
+                        **event,
+                        "created_at": datetime.datetime.now(datetime.timezone.utc),
+                    }
+                )
+                return True
+            except PyMongoError as e:
+                logging.warning("Announcement not fanned out: %s", str(e))
+        await self.publish_event(event)
+        return False
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.streaming = False
+
+    async def _watch(self):
+        try:
+            await self.db[EVENTS_COLLECTION].create_index(
+                "created_at", expireAfterSeconds=_EVENTS_TTL
+            )
+        except PyMongoError as e:
+            logging.warning("No TTL index on %s: %s", EVENTS_COLLECTION, str(e))
+        resume_token = None
+        while True:
+            try:
+                async with self.db.watch(
+                    [{"$match": {"ns.coll": {"$in": ["boxes", EVENTS_COLLECTION]}}}],
+                    full_document="updateLookup",
+                    full_document_before_change="whenAvailable",
+                    resume_after=resume_token,
+                ) as stream:
+                    logging.info("Watching box changes and events.")
+                    self.streaming = True
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        await self._dispatch(change)
+            except OperationFailure as e:
+                self.streaming = False
+                if e.code == _CHANGE_STREAM_NOT_SUPPORTED:
+                    logging.warning(
+                        "Mongo is not a replica set, box changes are only "
+                        "received through the webhook."
+                    )
+                    return
+                logging.exception("Box change stream failed, retrying")
+            except PyMongoError:
+                self.streaming = False
+                logging.exception("Box change stream failed, retrying")
+            await asyncio.sleep(_RETRY_DELAY)
+
+    async def _dispatch(self, change: dict):
+        if change.get("ns", {}).get("coll") == EVENTS_COLLECTION:
+            if change.get("operationType") == "insert":
+                event = dict(change["fullDocument"])
+                event.pop("_id", None)
+                event.pop("created_at", None)
+                await self.publish_event(event)
+            return
+        if change.get("operationType") == "delete":
+            await self._dispatch_delete(change)
+            return
+        document = change.get("fullDocument")
+        if document is None:
+            # Deleted before the update could be looked up, the delete follows
+            return
+        mac = document.get("mac")
+        try:
+            box = parse_box(document)
+        except ValidationError as e:
+            logging.warning("Invalid box document for %s: %s", mac, str(e))
+            box = None
+        await self.publish(mac, box)
+
+    async def _dispatch_delete(self, change: dict):
+        previous = change.get("fullDocumentBeforeChange")
+        if previous is None:
+            logging.debug(
+                "Box %s deleted without pre-image, not published",
+                change.get("documentKey", {}).get("_id"),
+            )
+            return
+        await self.publish(previous.get("mac"), None)
+
+
+box_watcher: Optional[BoxChangeWatcher] = None
+
+
+def get_box_watcher() -> Optional[BoxChangeWatcher]:
+    return box_watcher
+
+
+def init_box_watcher(db: AsyncIOMotorDatabase, watch: bool) -> BoxChangeWatcher:
+    """
+    Args:
+        db (AsyncIOMotorDatabase): Database holding the boxes collection
+        watch (bool): Open the change stream, False to rely on the webhook only
+    """
+    global box_watcher
+    box_watcher = BoxChangeWatcher(db)
+    if watch:
+        box_watcher.start()
+    return box_watcher
+
+
+async def close_box_watcher():
+    global box_watcher
+    if box_watcher is not None:
+        await box_watcher.stop()
+        box_watcher = None
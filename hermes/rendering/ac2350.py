@@ -0,0 +1,507 @@
+import functools
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from ipaddress import IPv4Address, IPv6Address
+from typing import Callable, Collection, Iterator, Optional
+
+from common_models.hermes_models import Box, UnetProfile
+
+from hermes.hermes_command_building import ac2350
+from hermes.hermes_command_building import common_command_builder as ccb
+from hermes.hermes_command_building import uci_common as UCI
+from hermes.utils.server_timing import timed
+
+# Unet fragments kept per process, a few hundred bytes to a few KB each
+FRAGMENT_CACHE_MAX_ENTRIES = 4096
+
+# Config blocks of the configuration file, in file order
+SUBSYSTEMS = ("network", "firewall", "dhcp", "wireless", "dropbear")
+
+_SEPARATOR = re.compile(r"^/-- SEPARATOR (\w+) --/\n", re.MULTILINE)
+
+
+class DefaultConfigRender:
+    """
+    The HermesDefaultConfig and its config blocks, which are the same for
+    every box. Built once per process, before fork when the app is preloaded.
+    """
+
+    config: ac2350.HermesDefaultConfig
+    network: str
+    firewall: str
+    dhcp: str
+    wireless: str
+    dropbear: str
+
+    def __init__(self):
+        self.config = ac2350.HermesDefaultConfig()
+        self.network = self.config.build_network(ccb.UCINetworkConfig()).commands
+        self.firewall = self.config.build_firewall(ccb.UCIFirewallConfig()).commands
+        self.dhcp = self.config.build_dhcp(ccb.UCIDHCPConfig()).commands
+        self.wireless = self.config.build_wireless(ccb.UCIWirelessConfig()).commands
+        self.dropbear = self.config.build_dropbear(ccb.UCIDropbearConfig()).commands
+
+    def config_blocks(
+        self,
+    ) -> tuple[
+        ccb.UCINetworkConfig,
+        ccb.UCIFirewallConfig,
+        ccb.UCIDHCPConfig,
+        ccb.UCIWirelessConfig,
+        ccb.UCIDropbearConfig,
+    ]:
+        """New config blocks already containing the default commands"""
+        Netconf = ccb.UCINetworkConfig()
+        Fireconf = ccb.UCIFirewallConfig()
+        Dhcpconf = ccb.UCIDHCPConfig()
+        Wirelessconf = ccb.UCIWirelessConfig()
+        Dropbearconf = ccb.UCIDropbearConfig()
+
+        Netconf.commands = self.network
+        Fireconf.commands = self.firewall
+        Dhcpconf.commands = self.dhcp
+        Wirelessconf.commands = self.wireless
+        Dropbearconf.commands = self.dropbear
+        return Netconf, Fireconf, Dhcpconf, Wirelessconf, Dropbearconf
+
+
+@functools.cache
+def default_config_render() -> DefaultConfigRender:
+    return DefaultConfigRender()
+
+
+def assemble_configfile(
+    Netconf: ccb.UCINetworkConfig,
+    Fireconf: ccb.UCIFirewallConfig,
+    Dhcpconf: ccb.UCIDHCPConfig,
+    Wirelessconf: ccb.UCIWirelessConfig,
+    Dropbearconf: ccb.UCIDropbearConfig,
+) -> str:
+    """
+    Concatenate the config blocks with the separators expected by the box
+
+    Returns:
+        str: The content of the configuration file
+    """
+    return (
+        "/-- SEPARATOR network --/\n"
+        + Netconf.build()
+        + "/-- SEPARATOR firewall --/\n"
+        + Fireconf.build()
+        + "/-- SEPARATOR dhcp --/\n"
+        + Dhcpconf.build()
+        + "/-- SEPARATOR wireless --/\n"
+        + Wirelessconf.build()
+        + "/-- SEPARATOR dropbear --/\n"
+        + Dropbearconf.build()
+    )
+
+
+@dataclass(frozen=True)
+class UnetFragments:
+    """The commands of one unet in each config block"""
+
+    network: str
+    firewall: str
+    dhcp: str
+    wireless: str
+
+
+class FragmentCache:
+    """
+    LRU of the unet fragments, keyed by a hash of everything a fragment
+    depends on: the unet, the gateways of its WAN VLANs and, for a secondary
+    unet, the id of the main unet (its WAN zone is referenced by name).
+    After an edit, only the fragments of the changed unets are built again.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[bytes, UnetFragments] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[UnetFragments]:
+        fragments = self.entries.get(key)
+        if fragments is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return fragments
+
+    def put(self, key: bytes, fragments: UnetFragments):
+        self.entries[key] = fragments
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_MAX_ENTRIES)
+
+
+def _fragments_key(
+    unet: UnetProfile,
+    main_unet_id: Optional[str],
+    default_router_v4: Optional[IPv4Address],
+    default_router_v6: IPv6Address,
+) -> bytes:
+    digest = hashlib.blake2b(unet.model_dump_json().encode(), digest_size=16)
+    digest.update(f"|{main_unet_id}|{default_router_v4}|{default_router_v6}".encode())
+    return digest.digest()
+
+
+def _wan_gateways(
+    box: Box, unet: UnetProfile, is_main: bool
+) -> tuple[Optional[IPv4Address], IPv6Address]:
+    """
+    Gateways of the WAN VLANs of a unet, the IPv4 one only for the main unet
+    (secondary users share it)
+
+    Raises:
+        ValueError: if a WAN VLAN of the unet has no gateway
+    """
+    default_router_v6: Optional[IPv6Address] = None
+    for wan_vlan in box.wan_vlan:
+        if wan_vlan.vlan_id == unet.network.wan_ipv6.vlan:
+            default_router_v6 = wan_vlan.ipv6_gateway
+            break
+    if default_router_v6 is None:
+        raise ValueError(
+            f"Error: No matching VLAN found for {unet.network.wan_ipv6.vlan}"
+        )
+    if not is_main:
+        return None, default_router_v6
+
+    default_router_v4: Optional[IPv4Address] = None
+    for wan_vlan in box.wan_vlan:
+        if wan_vlan.vlan_id == unet.network.wan_ipv4.vlan:
+            default_router_v4 = wan_vlan.ipv4_gateway
+            break
+    if default_router_v4 is None:
+        raise ValueError(
+            f"Error: No matching VLAN found for {unet.network.wan_ipv4.vlan}"
+        )
+    return default_router_v4, default_router_v6
+
+
+def _main_user(
+    unet: UnetProfile,
+    defconf: ac2350.HermesDefaultConfig,
+    default_router_v4: IPv4Address,
+    default_router_v6: IPv6Address,
+) -> ac2350.HermesMainUser:
+    return ac2350.HermesMainUser(
+        unetid=UCI.UNetId(unet.unet_id),
+        ssid=UCI.SSID(unet.wifi.ssid),
+        wan_address=unet.network.wan_ipv4.ip,
+        lan_address=unet.network.lan_ipv4.address,
+        wifi_passphrase=UCI.WifiPassphrase(unet.wifi.psk),
+        dns_servers_v4=UCI.DnsServers(unet.dhcp.dns_servers.ipv4),
+        dns_servers_v6=UCI.DnsServers(unet.dhcp.dns_servers.ipv6),
+        wan_vlan=unet.network.wan_ipv4.vlan,
+        lan_vlan=unet.network.lan_ipv4.vlan,
+        default_config=defconf,
+        default_router=default_router_v4,
+        wan6_address=unet.network.wan_ipv6.ip,
+        unet6_prefix=unet.network.ipv6_prefix,
+        wan6_vlan=unet.network.wan_ipv6.vlan,
+        default_router6=default_router_v6,
+    )
+
+
+def _secondary_user(
+    unet: UnetProfile,
+    defconf: ac2350.HermesDefaultConfig,
+    default_router_v6: IPv6Address,
+    main_user: ac2350.HermesMainUser,
+) -> ac2350.HermesSecondaryUser:
+    return ac2350.HermesSecondaryUser(
+        unetid=UCI.UNetId(unet.unet_id),
+        ssid=UCI.SSID(unet.wifi.ssid),
+        wan_address=unet.network.wan_ipv4.ip,
+        lan_address=unet.network.lan_ipv4.address,
+        lan_vlan=unet.network.lan_ipv4.vlan,
+        wifi_passphrase=UCI.WifiPassphrase(unet.wifi.psk),
+        dns_servers_v4=UCI.DnsServers(unet.dhcp.dns_servers.ipv4),
+        dns_servers_v6=UCI.DnsServers(unet.dhcp.dns_servers.ipv6),
+        wan_vlan=unet.network.wan_ipv4.vlan,
+        default_config=defconf,
+        wan6_address=unet.network.wan_ipv6.ip,
+        unet6_prefix=unet.network.ipv6_prefix,
+        wan6_vlan=unet.network.wan_ipv6.vlan,
+        default_router6=default_router_v6,
+        hermes_primary_user=main_user,
+    )
+
+
+def _build_fragments(user: ac2350.HermesUser, unet: UnetProfile) -> UnetFragments:
+    """Build the commands of a user, its port forwardings and port openings"""
+    Netconf = user.build_network(ccb.UCINetworkConfig())
+    Fireconf = user.build_firewall(ccb.UCIFirewallConfig())
+    Dhcpconf = user.build_dhcp(ccb.UCIDHCPConfig())
+    Wirelessconf = user.build_wireless(ccb.UCIWirelessConfig())
+
+    # Create port forwardings
+    for port_forwarding in unet.firewall.ipv4_port_forwarding:
+        user_port_forwarding = ac2350.HermesPortForwarding(
+            unetid=UCI.UNetId(unet.unet_id),
+            name=UCI.UCISectionName(
+                f"port_forwarding_dport_{port_forwarding.wan_port}_{port_forwarding.protocol}"
+            ),
+            src=user.wan_zone,
+            src_dport=UCI.TCPUDPPort(port_forwarding.wan_port),
+            dest=user.lan_zone,
+            dest_ip=port_forwarding.lan_ip,
+            dest_port=UCI.TCPUDPPort(port_forwarding.lan_port),
+            proto=UCI.Protocol(port_forwarding.protocol),
+        )
+        user_port_forwarding.build_firewall(Fireconf)
+
+    # BOUCLE POUR L'OUVERTURE DES PORTS IPV6
+    for ipv6_rule in unet.firewall.ipv6_port_opening:
+        user_ipv6_opening = ac2350.HermesIPv6PortOpening(
+            unetid=UCI.UNetId(unet.unet_id),
+            name=UCI.UCISectionName(
+                f"ipv6_open_dport_{ipv6_rule.port}_{ipv6_rule.protocol}"
+            ),
+            src=user.wan6_zone,
+            dest=user.lan_zone,
+            dest_ip=ipv6_rule.ip,
+            dest_port=UCI.TCPUDPPort(ipv6_rule.port),
+            proto=UCI.Protocol(ipv6_rule.protocol),
+        )
+        user_ipv6_opening.build_firewall(Fireconf)
+
+    return UnetFragments(
+        network=Netconf.commands,
+        firewall=Fireconf.commands,
+        dhcp=Dhcpconf.commands,
+        wireless=Wirelessconf.commands,
+    )
+
+
+def _identity(unet_fragments: UnetFragments) -> UnetFragments:
+    return unet_fragments
+
+
+def _prepare_fragments(
+    box: Box, use_templates: bool
+) -> list[Callable[[], UnetFragments]]:
+    """
+    Validate every unet of a box and return, in config order, the functions
+    giving their fragments: from the fragment cache, from the templates, or
+    built right away by the builders (which validate while building).
+
+    Raises:
+        ValueError: if a unet has no matching WAN VLAN or an invalid value
+    """
+    defconf = default_config_render().config
+
+    # Get the main unet id
+    main_user_unetid = box.main_unet_id
+
+    main_unet: Optional[UnetProfile] = None
+    unets: list[UnetProfile] = []
+
+    for unet in box.unets:
+        if unet.unet_id == main_user_unetid:
+            main_unet = unet
+            unets.insert(0, unet)
+        else:
+            unets.append(unet)
+
+    if main_unet is None and unets:
+        raise ValueError(f"Error: No unet found for {main_user_unetid}")
+
+    templates = None
+    if use_templates:
+        from hermes.rendering.ac2350_templates import compiled_templates
+
+        templates = compiled_templates()
+
+    # The main user is only built when a fragment of the box is missing
+    main_user: Optional[ac2350.HermesMainUser] = None
+
+    def get_main_user() -> ac2350.HermesMainUser:
+        nonlocal main_user
+        if main_user is None:
+            main_user = _main_user(
+                main_unet, defconf, *_wan_gateways(box, main_unet, is_main=True)
+            )
+        return main_user
+
+    def cached(key: bytes, render: Callable[[], UnetFragments]) -> UnetFragments:
+        unet_fragments = render()
+        fragment_cache.put(key, unet_fragments)
+        return unet_fragments
+
+    sources: list[Callable[[], UnetFragments]] = []
+    for unet in unets:
+        is_main = unet is main_unet
+        default_router_v4, default_router_v6 = _wan_gateways(box, unet, is_main)
+        key = _fragments_key(
+            unet,
+            None if is_main else main_user_unetid,
+            default_router_v4,
+            default_router_v6,
+        )
+        unet_fragments = fragment_cache.get(key)
+        if unet_fragments is not None:
+            sources.append(functools.partial(_identity, unet_fragments))
+        elif templates is not None:
+            render = templates.prepare_unet(
+                unet, main_user_unetid, is_main, default_router_v4, default_router_v6
+            )
+            sources.append(functools.partial(cached, key, render))
+        else:
+            user: ac2350.HermesUser
+            if is_main:
+                user = get_main_user()
+            else:
+                user = _secondary_user(
+                    unet, defconf, default_router_v6, get_main_user()
+                )
+            unet_fragments = cached(
+                key, functools.partial(_build_fragments, user, unet)
+            )
+            sources.append(functools.partial(_identity, unet_fragments))
+    return sources
+
+
+def render_configfile(box: Box, use_templates: bool = True) -> str:
+    """
+    Function to render the configuration file for all users of a box.
+    The fragments of unchanged unets come from the fragment cache, the
+    others are rendered with the compiled templates (or the builders).
+
+    Args:
+        box (Box): the box to render
+        use_templates (bool): False to always render with the builders
+    return:
+        str: the content of the configuration file
+    Raises:
+        ValueError: if a unet has no matching WAN VLAN
+    """
+
+    with timed("render"):
+        # Start from the default configuration shared by all boxes
+        Netconf, Fireconf, Dhcpconf, Wirelessconf, Dropbearconf = (
+            default_config_render().config_blocks()
+        )
+        fragments = [source() for source in _prepare_fragments(box, use_templates)]
+
+        Netconf.commands += "".join(fragment.network for fragment in fragments)
+        Fireconf.commands += "".join(fragment.firewall for fragment in fragments)
+        Dhcpconf.commands += "".join(fragment.dhcp for fragment in fragments)
+        Wirelessconf.commands += "".join(fragment.wireless for fragment in fragments)
+
+    with timed("serialize"):
+        return assemble_configfile(
+            Netconf, Fireconf, Dhcpconf, Wirelessconf, Dropbearconf
+        )
+
+
+def iter_configfile(box: Box, use_templates: bool = True) -> Iterator[str]:
+    """
+    Streaming version of render_configfile: every unet is validated
+    before returning, then the configuration file is yielded chunk by chunk
+    (a unet fragment at a time), the fragments being rendered on the way.
+    The concatenated chunks are the output of render_configfile.
+
+    Raises:
+        ValueError: if a unet has no matching WAN VLAN
+    """
+    return _iter_configfile(_prepare_fragments(box, use_templates))
+
+
+def _iter_configfile(
+    sources: list[Callable[[], UnetFragments]],
+) -> Iterator[str]:
+    default_render = default_config_render()
+    fragments: list[UnetFragments] = []
+
+    # The unet fragments are rendered while the network block is streamed
+    yield "/-- SEPARATOR network --/\n" + default_render.network
+    for source in sources:
+        fragments.append(source())
+        yield fragments[-1].network
+    # Built empty, a config block is only its reload commands
+    yield ccb.UCINetworkConfig().build()
+
+    blocks = [
+        ("firewall", default_render.firewall, ccb.UCIFirewallConfig),
+        ("dhcp", default_render.dhcp, ccb.UCIDHCPConfig),
+        ("wireless", default_render.wireless, ccb.UCIWirelessConfig),
+    ]
+    for name, default_commands, config_block in blocks:
+        yield f"/-- SEPARATOR {name} --/\n" + default_commands
+        for fragment in fragments:
+            yield getattr(fragment, name)
+        yield config_block().build()
+
+    yield "/-- SEPARATOR dropbear --/\n" + default_render.dropbear
+    yield ccb.UCIDropbearConfig().build()
+
+
+def render_subsystems(
+    box: Box, subsystems: Collection[str], use_templates: bool = True
+) -> str:
+    """
+    Render only some config blocks of a box, in file order and with their
+    separators: the blocks of render_configfile for these subsystems.
+    The unets are not rendered at all when only dropbear is requested.
+
+    Args:
+        box (Box): the box to render
+        subsystems (Collection[str]): names of the blocks, from SUBSYSTEMS
+        use_templates (bool): False to always render with the builders
+    Raises:
+        ValueError: if a unet has no matching WAN VLAN
+    """
+    with timed("render"):
+        default_render = default_config_render()
+        fragments: list[UnetFragments] = []
+        if any(subsystem != "dropbear" for subsystem in subsystems):
+            fragments = [source() for source in _prepare_fragments(box, use_templates)]
+
+        config_blocks = zip(SUBSYSTEMS, default_render.config_blocks())
+        blocks = []
+        for subsystem, config_block in config_blocks:
+            if subsystem not in subsystems:
+                continue
+            if subsystem != "dropbear":
+                config_block.commands += "".join(
+                    getattr(fragment, subsystem) for fragment in fragments
+                )
+            blocks.append(f"/-- SEPARATOR {subsystem} --/\n" + config_block.build())
+
+    return "".join(blocks)
+
+
+def split_configfile(configfile: str) -> dict[str, str]:
+    """
+    Split a configuration file in its config blocks
+
+    Returns:
+        dict[str, str]: Each block with its separator, by subsystem
+    """
+    separators = list(_SEPARATOR.finditer(configfile))
+    ends = [separator.start() for separator in separators[1:]] + [len(configfile)]
+    return {
+        separator.group(1): configfile[separator.start() : end]
+        for separator, end in zip(separators, ends)
+    }
+
+
+@functools.cache
+def render_default_configfile() -> str:
+    """
+    Function to render the default configuration file.
+    Its content never changes so it is rendered once per process.
+
+    return:
+        str: the content of the default configuration file
+    """
+    return assemble_configfile(*default_config_render().config_blocks())
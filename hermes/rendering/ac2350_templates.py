@@ -0,0 +1,501 @@
+"""
+Ahead-of-time compiled templates of the ac2350 unet fragments.
+
+The commands of a unet always have the same shape: only the addresses,
+VLANs, names and keys change. compile_templates() renders the builders of
+ac2350.py once per role (main or secondary unet) with sentinel values, and
+turns every sentinel in the output into a format slot. A unet is then
+rendered by validating its values and filling the templates, without
+building the UCI object graph.
+
+Templates are compiled from the builder code loaded in the process, so they
+can never be out of date. After compiling, they are checked against the
+builders on sample unets; if the output differs (e.g. a builder now uses a
+value the slots do not cover), the templates are discarded with a warning
+and the builders are used.
+"""
+
+import functools
+import logging
+import re
+import typing
+from dataclasses import dataclass
+from ipaddress import (
+    IPv4Address,
+    IPv4Interface,
+    IPv6Address,
+    IPv6Interface,
+    IPv6Network,
+)
+from typing import Callable, Optional
+
+from common_models.hermes_models import UnetProfile
+from pydantic import BaseModel
+
+from hermes.hermes_command_building import uci_common as UCI
+from hermes.rendering.ac2350 import (
+    UnetFragments,
+    _build_fragments,
+    _main_user,
+    _secondary_user,
+    default_config_render,
+)
+from hermes.rendering.cache import RENDERER_VERSION
+
+
+def _field_model(model: type[BaseModel], field: str) -> type[BaseModel]:
+    """Model class of a field, through list[...] and Optional[...]"""
+    annotation = model.model_fields[field].annotation
+    while typing.get_args(annotation):
+        annotation = next(
+            arg for arg in typing.get_args(annotation) if arg is not type(None)
+        )
+    return annotation
+
+
+def _make_unet(
+    unet_id: str,
+    ssid: str,
+    psk: str,
+    wan_ip: str,
+    wan_vlan: int,
+    wan6_ip: str,
+    wan6_vlan: int,
+    ipv6_prefix: str,
+    lan_ip: str,
+    lan_vlan: int,
+    dns4: list[str],
+    dns6: list[str],
+    port_forwardings: list[tuple[int, str, int, str]],
+    port_openings: list[tuple[str, int, str]],
+) -> UnetProfile:
+    """A UnetProfile with only the fields read by the builders"""
+    network_model = _field_model(UnetProfile, "network")
+    firewall_model = _field_model(UnetProfile, "firewall")
+    dhcp_model = _field_model(UnetProfile, "dhcp")
+    dns_model = _field_model(dhcp_model, "dns_servers")
+    port_forwarding_model = _field_model(firewall_model, "ipv4_port_forwarding")
+    port_opening_model = _field_model(firewall_model, "ipv6_port_opening")
+    return UnetProfile.model_construct(
+        unet_id=unet_id,
+        wifi=_field_model(UnetProfile, "wifi").model_construct(ssid=ssid, psk=psk),
+        network=network_model.model_construct(
+            wan_ipv4=_field_model(network_model, "wan_ipv4").model_construct(
+                ip=IPv4Interface(wan_ip), vlan=wan_vlan
+            ),
+            wan_ipv6=_field_model(network_model, "wan_ipv6").model_construct(
+                ip=IPv6Interface(wan6_ip), vlan=wan6_vlan
+            ),
+            ipv6_prefix=IPv6Network(ipv6_prefix),
+            lan_ipv4=_field_model(network_model, "lan_ipv4").model_construct(
+                address=IPv4Interface(lan_ip), vlan=lan_vlan
+            ),
+        ),
+        dhcp=dhcp_model.model_construct(
+            dns_servers=dns_model.model_construct(
+                ipv4=[IPv4Address(dns) for dns in dns4],
+                ipv6=[IPv6Address(dns) for dns in dns6],
+            )
+        ),
+        firewall=firewall_model.model_construct(
+            ipv4_port_forwarding=[
+                port_forwarding_model.model_construct(
+                    wan_port=wan_port,
+                    lan_ip=IPv4Address(lan_ip),
+                    lan_port=lan_port,
+                    protocol=protocol,
+                )
+                for wan_port, lan_ip, lan_port, protocol in port_forwardings
+            ],
+            ipv6_port_opening=[
+                port_opening_model.model_construct(
+                    ip=IPv6Address(ip), port=port, protocol=protocol
+                )
+                for ip, port, protocol in port_openings
+            ],
+        ),
+    )
+
+
+def unet_values(
+    unet: UnetProfile,
+    main_unet_id: Optional[str],
+    default_router_v4: Optional[IPv4Address],
+    default_router_v6: IPv6Address,
+) -> dict[str, str]:
+    """
+    Values of the slots of a unet, validated as the builders do
+
+    Raises:
+        ValueError: if a value is rejected by the UCI types
+    """
+    network = unet.network
+    UCI.UNetId(unet.unet_id)
+    UCI.SSID(unet.wifi.ssid)
+    UCI.WifiPassphrase(unet.wifi.psk)
+    UCI.UCISimpleDevice(f"eth0.{network.wan_ipv4.vlan}")
+    UCI.UCISimpleDevice(f"eth0.{network.wan_ipv6.vlan}")
+    UCI.UCINetworkPorts(f"eth0.{network.lan_ipv4.vlan}")
+
+    values = {
+        "unet_id": unet.unet_id,
+        "ssid": unet.wifi.ssid,
+        "psk": unet.wifi.psk,
+        "wan_ip": str(network.wan_ipv4.ip.ip),
+        "wan_netmask": str(network.wan_ipv4.ip.netmask),
+        "wan_vlan": str(network.wan_ipv4.vlan),
+        "wan6_ip": str(network.wan_ipv6.ip),
+        "wan6_vlan": str(network.wan_ipv6.vlan),
+        "ipv6_prefix": str(network.ipv6_prefix),
+        "lan_ip": str(network.lan_ipv4.address.ip),
+        "lan_netmask": str(network.lan_ipv4.address.netmask),
+        "lan_network": str(network.lan_ipv4.address.network),
+        "lan_vlan": str(network.lan_ipv4.vlan),
+        "table": str(int(f"6{str(network.lan_ipv4.vlan).zfill(2)}")),
+        "default_router6": str(default_router_v6),
+        "dns4": ",".join(str(dns) for dns in unet.dhcp.dns_servers.ipv4),
+    }
+    if main_unet_id is not None:
+        values["main_unet_id"] = main_unet_id
+    if default_router_v4 is not None:
+        values["default_router"] = str(default_router_v4)
+    return values
+
+
+def _port_forwarding_values(port_forwarding) -> dict[str, str]:
+    UCI.UCISectionName(
+        f"port_forwarding_dport_{port_forwarding.wan_port}_{port_forwarding.protocol}"
+    )
+    return {
+        "wan_port": str(UCI.TCPUDPPort(port_forwarding.wan_port)),
+        "dest_ip": str(port_forwarding.lan_ip),
+        "lan_port": str(UCI.TCPUDPPort(port_forwarding.lan_port)),
+        "protocol": str(UCI.Protocol(port_forwarding.protocol)),
+    }
+
+
+def _port_opening_values(port_opening) -> dict[str, str]:
+    UCI.UCISectionName(f"ipv6_open_dport_{port_opening.port}_{port_opening.protocol}")
+    return {
+        "dest_ip": str(port_opening.ip),
+        "port": str(UCI.TCPUDPPort(port_opening.port)),
+        "protocol": str(UCI.Protocol(port_opening.protocol)),
+    }
+
+
+def _to_template(text: str, slots: dict[str, str]) -> str:
+    """
+    Replace the sample value of each slot by {slot} and escape the rest.
+    Longer values are matched first, so a value containing another one
+    (e.g. the route table 6<vlan> and the vlan) is a slot of its own.
+    """
+    by_value = {value: slot for slot, value in slots.items()}
+    if len(by_value) != len(slots):
+        raise ValueError("Two slots have the same sample value")
+    pattern = re.compile(
+        "("
+        + "|".join(
+            re.escape(value) for value in sorted(by_value, key=len, reverse=True)
+        )
+        + ")"
+    )
+    parts = pattern.split(text)
+    return "".join(
+        (
+            "{" + by_value[part] + "}"
+            if position % 2
+            else part.replace("{", "{{").replace("}", "}}")
+        )
+        for position, part in enumerate(parts)
+    )
+
+
+# Sentinel unets: every value renders as a text found nowhere else
+_MAIN_ID = "zmainzzz"
+_SENTINEL = dict(
+    unet_id="zslotzzz",
+    ssid="ZZSSIDSLOT",
+    psk="ZZPSKSLOT",
+    wan_ip="203.0.113.77/27",
+    wan_vlan=3911,
+    wan6_ip="2001:db8:aaaa::3/64",
+    wan6_vlan=3922,
+    ipv6_prefix="2001:db8:bbbb::/48",
+    lan_ip="10.213.57.129/26",
+    lan_vlan=3933,
+    dns4=["192.0.2.53", "192.0.2.54"],
+    dns6=["2001:db8:cccc::53"],
+)
+_SENTINEL_ROUTER_V4 = IPv4Address("203.0.113.65")
+_SENTINEL_ROUTER_V6 = IPv6Address("2001:db8:aaaa::1")
+_SENTINEL_PORT_FORWARDING = (45671, "10.213.57.140", 45682, "udplite")
+_SENTINEL_PORT_OPENING = ("2001:db8:dddd::77", 45693, "sctp")
+
+
+@dataclass(frozen=True)
+class UnetTemplates:
+    """Templates of the fragments of a main or secondary unet"""
+
+    network: str
+    firewall: str
+    dhcp: str
+    wireless: str
+    dns6_line: str
+    port_forwarding: str
+    port_opening: str
+
+    def prepare(
+        self, unet: UnetProfile, values: dict[str, str]
+    ) -> Callable[[], UnetFragments]:
+        """
+        Validate the port forwardings and openings of a unet and return
+        the function filling its templates
+
+        Raises:
+            ValueError: if a value is rejected by the UCI types
+        """
+        port_forwardings = [
+            {**values, **_port_forwarding_values(port_forwarding)}
+            for port_forwarding in unet.firewall.ipv4_port_forwarding
+        ]
+        port_openings = [
+            {**values, **_port_opening_values(port_opening)}
+            for port_opening in unet.firewall.ipv6_port_opening
+        ]
+        dns6_servers = [str(dns) for dns in unet.dhcp.dns_servers.ipv6]
+        return functools.partial(
+            self._fill, values, port_forwardings, port_openings, dns6_servers
+        )
+
+    def _fill(
+        self,
+        values: dict[str, str],
+        port_forwardings: list[dict[str, str]],
+        port_openings: list[dict[str, str]],
+        dns6_servers: list[str],
+    ) -> UnetFragments:
+        firewall = [self.firewall.format_map(values)]
+        firewall.extend(
+            self.port_forwarding.format_map(port_forwarding)
+            for port_forwarding in port_forwardings
+        )
+        firewall.extend(
+            self.port_opening.format_map(port_opening) for port_opening in port_openings
+        )
+        dns6_lines = "".join(
+            self.dns6_line.format_map({**values, "dns6": dns}) for dns in dns6_servers
+        )
+        return UnetFragments(
+            network=self.network.format_map(values),
+            firewall="".join(firewall),
+            dhcp=self.dhcp.format_map({**values, "dns6_lines": dns6_lines}),
+            wireless=self.wireless.format_map(values),
+        )
+
+
+def _builder_fragments(
+    unet: UnetProfile, is_main: bool, main_unet: UnetProfile
+) -> UnetFragments:
+    """Fragments of a unet rendered by the builders"""
+    defconf = default_config_render().config
+    main_user = _main_user(main_unet, defconf, _SENTINEL_ROUTER_V4, _SENTINEL_ROUTER_V6)
+    if is_main:
+        return _build_fragments(main_user, unet)
+    user = _secondary_user(unet, defconf, _SENTINEL_ROUTER_V6, main_user)
+    return _build_fragments(user, unet)
+
+
+def _compile_role(is_main: bool) -> UnetTemplates:
+    main_unet = _make_unet(
+        **{**_SENTINEL, "unet_id": _MAIN_ID},
+        port_forwardings=[],
+        port_openings=[],
+    )
+    bare = _make_unet(**_SENTINEL, port_forwardings=[], port_openings=[])
+    if is_main:
+        main_unet = bare
+    full = _make_unet(
+        **_SENTINEL,
+        port_forwardings=[_SENTINEL_PORT_FORWARDING],
+        port_openings=[_SENTINEL_PORT_OPENING],
+    )
+    with_port_forwarding = _make_unet(
+        **_SENTINEL,
+        port_forwardings=[_SENTINEL_PORT_FORWARDING],
+        port_openings=[],
+    )
+
+    bare_fragments = _builder_fragments(bare, is_main, main_unet)
+    firewall_with_port_forwarding = _builder_fragments(
+        with_port_forwarding, is_main, main_unet
+    ).firewall
+    full_firewall = _builder_fragments(full, is_main, main_unet).firewall
+    if not full_firewall.startswith(firewall_with_port_forwarding):
+        raise ValueError("Port openings are not appended to the firewall commands")
+    if not firewall_with_port_forwarding.startswith(bare_fragments.firewall):
+        raise ValueError("Port forwardings are not appended to the firewall commands")
+    port_forwarding = firewall_with_port_forwarding[len(bare_fragments.firewall) :]
+    port_opening = full_firewall[len(firewall_with_port_forwarding) :]
+
+    slots = unet_values(
+        bare,
+        None if is_main else _MAIN_ID,
+        _SENTINEL_ROUTER_V4 if is_main else None,
+        _SENTINEL_ROUTER_V6,
+    )
+
+    # The DNS6 servers are one line each, the line becomes a template itself
+    dns6_sample = _SENTINEL["dns6"][0]
+    dhcp_lines = bare_fragments.dhcp.splitlines(keepends=True)
+    dns6_lines = [line for line in dhcp_lines if dns6_sample in line]
+    if len(dns6_lines) != 1:
+        raise ValueError("The DNS6 servers are not one line each")
+    dhcp = bare_fragments.dhcp.replace(dns6_lines[0], "\0")
+    dhcp_template = _to_template(dhcp, slots).replace("\0", "{dns6_lines}")
+
+    port_forwarding_slots = dict(
+        zip(
+            ("wan_port", "dest_ip", "lan_port", "protocol"),
+            map(str, _SENTINEL_PORT_FORWARDING),
+        )
+    )
+    port_opening_slots = dict(
+        zip(("dest_ip", "port", "protocol"), map(str, _SENTINEL_PORT_OPENING))
+    )
+    return UnetTemplates(
+        network=_to_template(bare_fragments.network, slots),
+        firewall=_to_template(bare_fragments.firewall, slots),
+        dhcp=dhcp_template,
+        wireless=_to_template(bare_fragments.wireless, slots),
+        dns6_line=_to_template(dns6_lines[0], {**slots, "dns6": dns6_sample}),
+        port_forwarding=_to_template(
+            port_forwarding, {**slots, **port_forwarding_slots}
+        ),
+        port_opening=_to_template(port_opening, {**slots, **port_opening_slots}),
+    )
+
+
+# Unets checked against the builders after compiling: list lengths, equal
+# netmasks and VLANs, multi-digit values all differ from the sentinels
+_CHECK_UNETS = [
+    dict(
+        unet_id="ac2350a1",
+        ssid="Rezel-main",
+        psk="password",
+        wan_ip="137.194.8.3/24",
+        wan_vlan=101,
+        wan6_ip="2a09:6847:ffff::803/64",
+        wan6_vlan=103,
+        ipv6_prefix="2a09:6847:803::/48",
+        lan_ip="192.168.1.1/24",
+        lan_vlan=1,
+        dns4=["8.8.8.8", "137.194.15.132"],
+        dns6=["2001:4860:4860::8888", "2001:4860:4860::8844"],
+        port_forwardings=[
+            (80, "192.168.1.3", 80, "tcp"),
+            (443, "192.168.1.3", 8443, "udp"),
+        ],
+        port_openings=[("2a09:6847:803:0:ee2:7ff:fe59:0", 80, "tcp")],
+    ),
+    dict(
+        unet_id="0000a2b3",
+        ssid="x",
+        psk="{braces}'quote",
+        wan_ip="10.0.0.2/8",
+        wan_vlan=102,
+        wan6_ip="2a09::2/64",
+        wan6_vlan=102,
+        ipv6_prefix="2a09:1::/56",
+        lan_ip="10.0.0.1/8",
+        lan_vlan=102,
+        dns4=[],
+        dns6=[],
+        port_forwardings=[],
+        port_openings=[
+            ("2a09:1::1", 1, "tcp"),
+            ("2a09:1::2", 65535, "udp"),
+        ],
+    ),
+]
+
+
+@dataclass(frozen=True)
+class CompiledTemplates:
+    version: str
+    main: UnetTemplates
+    secondary: UnetTemplates
+
+    def prepare_unet(
+        self,
+        unet: UnetProfile,
+        main_unet_id: str,
+        is_main: bool,
+        default_router_v4: Optional[IPv4Address],
+        default_router_v6: IPv6Address,
+    ) -> Callable[[], UnetFragments]:
+        """
+        Validate the values of a unet and return the function rendering
+        its fragments
+
+        Raises:
+            ValueError: if a value is rejected by the UCI types
+        """
+        values = unet_values(
+            unet,
+            None if is_main else main_unet_id,
+            default_router_v4,
+            default_router_v6,
+        )
+        return (self.main if is_main else self.secondary).prepare(unet, values)
+
+    def render_unet(
+        self,
+        unet: UnetProfile,
+        main_unet_id: str,
+        is_main: bool,
+        default_router_v4: Optional[IPv4Address],
+        default_router_v6: IPv6Address,
+    ) -> UnetFragments:
+        return self.prepare_unet(
+            unet, main_unet_id, is_main, default_router_v4, default_router_v6
+        )()
+
+
+def compile_templates() -> CompiledTemplates:
+    """
+    Raises:
+        ValueError: if the builders output does not fit the templates
+    """
+    templates = CompiledTemplates(
+        version=RENDERER_VERSION,
+        main=_compile_role(is_main=True),
+        secondary=_compile_role(is_main=False),
+    )
+
+    main_unet = _make_unet(**_CHECK_UNETS[0])
+    for check in _CHECK_UNETS:
+        unet = _make_unet(**check)
+        for is_main in (True, False):
+            expected = _builder_fragments(unet, is_main, unet if is_main else main_unet)
+            rendered = templates.render_unet(
+                unet,
+                main_unet.unet_id,
+                is_main,
+                _SENTINEL_ROUTER_V4 if is_main else None,
+                _SENTINEL_ROUTER_V6,
+            )
+            if rendered != expected:
+                raise ValueError(
+                    f"Templates differ from the builders for unet {unet.unet_id}"
+                )
+    return templates
+
+
+@functools.cache
+def compiled_templates() -> Optional[CompiledTemplates]:
+    """The templates of this process, None if they could not be compiled"""
+    try:
+        return compile_templates()
+    except ValueError as e:
+        logging.warning("ac2350 templates disabled, using the builders: %s", str(e))
+        return None
@@ -0,0 +1,92 @@
+"""
+Render many boxes at once, yielding the configs as they complete.
+
+At most `concurrency` renders are in flight, and boxes are only pulled from
+the source when a slot is free, so memory stays bounded by the concurrency
+and not by the size of the fleet. All the batches of a worker share
+RENDER_BATCH_MAX_IN_FLIGHT renders, well under the render pool queue, so
+the polls always find room in it. Cached configs are used, but the renders
+do not fill the cache: the whole fleet would evict the configs of the boxes
+actually polling.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+from common_models.hermes_models import Box
+
+from hermes.env import ENV
+from hermes.rendering.configs import get_renderer, render_box
+from hermes.rendering.pool import RenderQueueFullError
+
+# Wait before retrying a render refused by a full pool, and how many times
+_QUEUE_FULL_DELAY = 0.05
+_QUEUE_FULL_RETRIES = 100
+
+# Renders in flight across the batches of the worker
+_in_flight: Optional[asyncio.Semaphore] = None
+
+
+def _batch_slots() -> asyncio.Semaphore:
+    global _in_flight
+    if _in_flight is None:
+        _in_flight = asyncio.Semaphore(ENV.render_batch_max_in_flight)
+    return _in_flight
+
+
+@dataclass
+class BatchResult:
+    mac: str
+    configfile: Optional[str] = None
+    error: Optional[str] = None
+
+
+async def _render_one(box: Box) -> BatchResult:
+    render = get_renderer(box.type)
+    if render is None:
+        return BatchResult(box.mac, error=f"Box type {box.type} not supported")
+    async with _batch_slots():
+        for _ in range(_QUEUE_FULL_RETRIES):
+            try:
+                return BatchResult(
+                    box.mac, configfile=await render_box(render, box, fill_cache=False)
+                )
+            except RenderQueueFullError:
+                # The pool is shared with the polls, leave them room
+                await asyncio.sleep(_QUEUE_FULL_DELAY)
+            except ValueError as e:
+                return BatchResult(box.mac, error=str(e))
+    return BatchResult(box.mac, error="Render pool busy")
+
+
+async def render_boxes(
+    boxes: AsyncIterator[Box | BatchResult], concurrency: int
+) -> AsyncIterator[BatchResult]:
+    """
+    Args:
+        boxes (AsyncIterator): Boxes to render, BatchResult items
+            (e.g. invalid documents) are passed through as they are
+        concurrency (int): Maximum number of renders in flight, at most
+            RENDER_BATCH_MAX_IN_FLIGHT
+    """
+    concurrency = min(concurrency, ENV.render_batch_max_in_flight)
+    in_flight: set[asyncio.Task] = set()
+    try:
+        async for box in boxes:
+            if isinstance(box, BatchResult):
+                yield box
+                continue
+            if len(in_flight) >= concurrency:
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+            in_flight.add(asyncio.create_task(_render_one(box)))
+
+        for task in asyncio.as_completed(in_flight):
+            yield await task
+    finally:
+        for task in in_flight:
+            task.cancel()
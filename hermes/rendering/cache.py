@@ -0,0 +1,243 @@
+"""
+Caches of rendered box configs, keyed by the box MAC and a hash of the box
+document.
+
+The hash also covers the source of the renderer and of the command
+builders, so that a deploy changing the generated commands never serves
+configs rendered by the previous code.
+
+Backends:
+    shm: files in a tmpfs directory, shared by the workers of a pod
+    mongo: the shm cache in front of a Mongo collection shared by all replicas
+    memory: a dict local to the process, for tests and development
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Literal, Optional, Protocol
+
+from common_models.hermes_models import Box
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from starlette.concurrency import run_in_threadpool
+
+RenderCacheBackend = Literal["shm", "mongo", "memory"]
+
+_RENDERER_SOURCES = [
+    Path(__file__).parent,
+    Path(__file__).parent.parent / "hermes_command_building",
+]
+
+
+def _renderer_fingerprint() -> str:
+    digest = hashlib.sha256()
+    for source_dir in _RENDERER_SOURCES:
+        for source in sorted(source_dir.rglob("*.py")):
+            digest.update(source.name.encode())
+            digest.update(source.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+RENDERER_VERSION = _renderer_fingerprint()
+
+
+def box_hash(box: Box) -> str:
+    """Hash of everything a rendered config depends on: the box and the renderer"""
+    digest = hashlib.sha256(RENDERER_VERSION.encode())
+    digest.update(box.model_dump_json().encode())
+    return digest.hexdigest()
+
+
+class RenderCache(Protocol):
+    """A store of rendered configs, `key` being the box_hash of the box"""
+
+    async def get(self, mac: str, key: str) -> Optional[str]: ...
+
+    async def put(self, mac: str, key: str, configfile: str): ...
+
+
+class InMemoryRenderCache:
+    """Process-local stand-in for the shared caches, keeps the last render per MAC"""
+
+    def __init__(self):
+        self.entries: dict[str, tuple[str, str]] = {}
+
+    async def get(self, mac: str, key: str) -> Optional[str]:
+        entry = self.entries.get(mac)
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    async def put(self, mac: str, key: str, configfile: str):
+        self.entries[mac] = (key, configfile)
+
+
+class SharedMemoryRenderCache:
+    """
+    Rendered configs stored as one file per box hash in a tmpfs directory
+    (/dev/shm by default). All the workers of a pod read and write the same
+    directory, so a config rendered by one worker is a hit in all of them,
+    and reads are served from memory shared by the page cache.
+
+    The tmpfs pages count against the memory limit of the pod, so the cache
+    is bounded by bytes, and the files are read and written in the threadpool.
+    """
+
+    directory: Path
+    max_bytes: int
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        Args:
+            directory (str): Directory where the entries are stored
+            max_bytes (int): Oldest entries are evicted above this total size
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._bytes_since_eviction = 0
+
+    def _read(self, key: str) -> Optional[str]:
+        # The box hash covers the MAC, it is enough to name the entry
+        try:
+            return (self.directory / key).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    async def get(self, mac: str, key: str) -> Optional[str]:
+        return await run_in_threadpool(self._read, key)
+
+    def _write(self, key: str, configfile: str):
+        # Write then rename so that other workers never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(configfile)
+            os.replace(tmp_path, self.directory / key)
+        except OSError as e:
+            # Typically a full tmpfs: make room for the next ones
+            logging.warning("Could not write render cache entry %s: %s", key, e)
+            Path(tmp_path).unlink(missing_ok=True)
+            self.evict()
+            return
+
+        self._bytes_since_eviction += len(configfile)
+        if self._bytes_since_eviction * 10 >= self.max_bytes:
+            self._bytes_since_eviction = 0
+            self.evict()
+
+    async def put(self, mac: str, key: str, configfile: str):
+        await run_in_threadpool(self._write, key, configfile)
+
+    def evict(self):
+        """Remove the least recently written entries above max_bytes, blocking"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        # Down to 90%, so that a full cache is not swept on every write
+        target = self.max_bytes * 9 // 10
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+
+
+class MongoRenderCache:
+    """
+    Last render of each box in the `rendered_configs` collection, so that
+    any replica can serve a config rendered by another one.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.collection = db.rendered_configs
+
+    async def get(self, mac: str, key: str) -> Optional[str]:
+        document = await self.collection.find_one(
+            {"_id": mac, "box_hash": key}, {"configfile": 1}
+        )
+        if document is None:
+            return None
+        return document["configfile"]
+
+    async def put(self, mac: str, key: str, configfile: str):
+        await self.collection.replace_one(
+            {"_id": mac},
+            {
+                "box_hash": key,
+                "configfile": configfile,
+                "rendered_at": datetime.datetime.now(datetime.timezone.utc),
+            },
+            upsert=True,
+        )
+
+
+class TieredRenderCache:
+    """A local cache in front of a shared one, filled on shared hits"""
+
+    def __init__(self, local: RenderCache, shared: RenderCache):
+        self.local = local
+        self.shared = shared
+
+    async def get(self, mac: str, key: str) -> Optional[str]:
+        configfile = await self.local.get(mac, key)
+        if configfile is None:
+            configfile = await self.shared.get(mac, key)
+            if configfile is not None:
+                await self.local.put(mac, key, configfile)
+        return configfile
+
+    async def put(self, mac: str, key: str, configfile: str):
+        await self.local.put(mac, key, configfile)
+        await self.shared.put(mac, key, configfile)
+
+
+render_cache: Optional[RenderCache] = None
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    return render_cache
+
+
+def init_render_cache(
+    backend: RenderCacheBackend,
+    directory: str,
+    max_bytes: int,
+    db: Optional[AsyncIOMotorDatabase] = None,
+):
+    """
+    Args:
+        backend (RenderCacheBackend): "shm", "mongo" or "memory"
+        directory (str): Directory of the shm cache (shm and mongo backends)
+        max_bytes (int): Size of the shm cache
+        db (AsyncIOMotorDatabase, optional): Database of the mongo backend
+    """
+    global render_cache
+    match backend:
+        case "memory":
+            render_cache = InMemoryRenderCache()
+        case "shm":
+            render_cache = SharedMemoryRenderCache(directory, max_bytes)
+        case "mongo":
+            if db is None:
+                raise ValueError("The mongo render cache needs a database")
+            render_cache = TieredRenderCache(
+                SharedMemoryRenderCache(directory, max_bytes),
+                MongoRenderCache(db),
+            )
+        case _:
+            raise ValueError(f"Unknown render cache backend {backend}")
+    logging.info("Render cache started with the %s backend.", backend)
@@ -0,0 +1,233 @@
+"""Box config renders going through the render cache and the render pool."""
+
+import functools
+import logging
+from typing import AsyncIterator, Callable, Iterator, NamedTuple, Optional
+
+from common_models.hermes_models import Box
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from hermes.mongodb.lease import HeldLease, MongoLease
+from hermes.rendering.cache import box_hash, get_render_cache
+from hermes.rendering.pool import RenderFunction, RenderQueueFullError, render_in_pool
+from hermes.utils.etag import strong_etag
+from hermes.utils.events import get_event_hub
+from hermes.utils.server_timing import timed
+
+StreamingRenderFunction = Callable[[Box], Iterator[str]]
+
+
+def get_renderer(box_type: str) -> Optional[RenderFunction]:
+    """Render function of a box type, None if the type is not supported"""
+    match box_type:
+        case "ac2350":
+            from hermes.rendering.ac2350 import render_configfile
+
+            return render_configfile
+        case _:
+            return None
+
+
+def get_streaming_renderer(box_type: str) -> Optional[StreamingRenderFunction]:
+    """Streaming render function of a box type, None if it has none"""
+    match box_type:
+        case "ac2350":
+            from hermes.rendering.ac2350 import iter_configfile
+
+            return iter_configfile
+        case _:
+            return None
+
+
+class SubsystemRenderer(NamedTuple):
+    """Functions rendering the config blocks of a box type separately"""
+
+    # Names of the config blocks, in file order
+    subsystems: tuple[str, ...]
+    # Renders the blocks of the given subsystems, called as render(box, subsystems)
+    render: Callable[..., str]
+    # Splits a configuration file in its blocks, by subsystem
+    split: Callable[[str], dict[str, str]]
+
+
+def get_subsystem_renderer(box_type: str) -> Optional[SubsystemRenderer]:
+    """Subsystem renderer of a box type, None if the type is not supported"""
+    match box_type:
+        case "ac2350":
+            from hermes.rendering.ac2350 import (
+                SUBSYSTEMS,
+                render_subsystems,
+                split_configfile,
+            )
+
+            return SubsystemRenderer(SUBSYSTEMS, render_subsystems, split_configfile)
+        case _:
+            return None
+
+
+async def render_box(render: RenderFunction, box: Box, fill_cache: bool = True) -> str:
+    """
+    Get the config of a box from the render cache, render it on a miss,
+    cached unless fill_cache is False (batch renders)
+
+    Raises:
+        RenderQueueFullError: if the render pool is full
+        ValueError: if the box cannot be rendered
+    """
+    render_cache = get_render_cache()
+    key = box_hash(box)
+    if render_cache is not None:
+        with timed("cache"):
+            configfile = await render_cache.get(box.mac, key)
+        if configfile is not None:
+            return configfile
+
+    configfile = await render_in_pool(render, box)
+    if render_cache is not None and fill_cache:
+        with timed("cache"):
+            await render_cache.put(box.mac, key, configfile)
+    return configfile
+
+
+async def render_box_subsystems(
+    renderer: SubsystemRenderer, box: Box, subsystems: tuple[str, ...]
+) -> str:
+    """
+    Get some config blocks of a box, in file order: split from the cached
+    config on a hit, else only these blocks are rendered (and not cached,
+    the cache holding complete configs).
+
+    Raises:
+        RenderQueueFullError: if the render pool is full
+        ValueError: if the box cannot be rendered
+    """
+    subsystems = tuple(
+        subsystem for subsystem in renderer.subsystems if subsystem in subsystems
+    )
+    render_cache = get_render_cache()
+    if render_cache is not None:
+        with timed("cache"):
+            configfile = await render_cache.get(box.mac, box_hash(box))
+        if configfile is not None:
+            blocks = renderer.split(configfile)
+            return "".join(blocks[subsystem] for subsystem in subsystems)
+
+    return await render_in_pool(
+        functools.partial(renderer.render, subsystems=subsystems), box
+    )
+
+
+async def stream_box(render: StreamingRenderFunction, box: Box) -> AsyncIterator[str]:
+    """
+    Get the config of a box as chunks to stream in the response: the cached
+    config in one chunk on a hit, else the chunks of the streaming render,
+    which runs inline a fragment at a time and fills the cache once complete.
+    The box is validated before returning, so errors come before any chunk.
+
+    Raises:
+        ValueError: if the box cannot be rendered
+    """
+    render_cache = get_render_cache()
+    key = box_hash(box)
+    configfile = None
+    if render_cache is not None:
+        with timed("cache"):
+            configfile = await render_cache.get(box.mac, key)
+    if configfile is not None:
+        return _single_chunk(configfile)
+
+    with timed("render"):
+        chunks = render(box)
+    return _render_chunks(chunks, box.mac, key)
+
+
+async def _single_chunk(configfile: str) -> AsyncIterator[str]:
+    yield configfile
+
+
+async def _render_chunks(
+    chunks: Iterator[str], mac: str, key: str
+) -> AsyncIterator[str]:
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    render_cache = get_render_cache()
+    if render_cache is not None:
+        await render_cache.put(mac, key, "".join(rendered))
+
+
+async def prerender_box(mac: str, box: Optional[Box]):
+    """
+    Render a box config ahead of its next poll, so that the first poll after
+    an edit is a cache hit. Errors are logged: the poll will report them.
+    """
+    if box is None or get_render_cache() is None:
+        return
+    render = get_renderer(box.type)
+    if render is None:
+        return
+    try:
+        await render_box(render, box)
+    except RenderQueueFullError:
+        logging.warning("Render pool full, %s will be rendered on its next poll", mac)
+    except ValueError as e:
+        logging.warning("Could not prerender %s: %s", mac, str(e))
+
+
+prerender_lease: Optional[HeldLease] = None
+
+
+async def prerender_changed_box(mac: str, box: Optional[Box]):
+    """
+    Box watcher subscriber prerendering the changed boxes. Every worker of
+    every replica receives the changes: only the holder of the prerender
+    lease renders them, into the cache shared with the others.
+    """
+    if prerender_lease is not None and not prerender_lease.held:
+        return
+    await prerender_box(mac, box)
+
+
+def init_prerender_lease(db: AsyncIOMotorDatabase, duration: float) -> HeldLease:
+    global prerender_lease
+    prerender_lease = HeldLease(MongoLease(db, "prerender", duration))
+    prerender_lease.start()
+    return prerender_lease
+
+
+async def close_prerender_lease():
+    global prerender_lease
+    if prerender_lease is not None:
+        await prerender_lease.stop()
+        prerender_lease = None
+
+
+async def config_hash(box: Box) -> Optional[str]:
+    """
+    ETag of the config of a box without its quotes, as sent in config events
+
+    Raises:
+        RenderQueueFullError: if the render pool is full
+        ValueError: if the box cannot be rendered
+    """
+    render = get_renderer(box.type)
+    if render is None:
+        raise ValueError(f"Box type {box.type} not supported")
+    return strong_etag(await render_box(render, box)).strip('"')
+
+
+async def notify_config_change(mac: str, box: Optional[Box]):
+    """
+    Push the new config hash of a box to its event connections. When the
+    render pool is full the event has no hash: the box pulls its config.
+    """
+    event_hub = get_event_hub()
+    if box is None or event_hub is None or not event_hub.is_connected(mac):
+        return
+    try:
+        event_hub.publish(mac, "config", {"hash": await config_hash(box)})
+    except RenderQueueFullError:
+        event_hub.publish(mac, "config", {"hash": None})
+    except ValueError as e:
+        logging.warning("No config event for %s: %s", mac, str(e))
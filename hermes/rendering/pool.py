@@ -0,0 +1,183 @@
+"""
+Process pool running the CPU-bound config renders out of the event loop.
+
+The pool is bounded: at most `max_queue` renders may be pending (running or
+waiting for a worker), further renders are refused with RenderQueueFullError.
+Renders estimated to be cheaper than `inline_max_ms` run inline, the estimate
+being a moving average of the render time per box item measured in the pool.
+Inline renders are not measured: they mostly hit the fragment cache, and
+would drag the estimate down until large boxes run on the event loop too.
+Disabled by default.
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from common_models.hermes_models import Box
+
+from hermes.utils.server_timing import timed
+
+RenderFunction = Callable[[Box], str]
+
+# Weight of the latest measure in the moving average of the render cost
+_COST_SMOOTHING = 0.2
+
+
+class RenderQueueFullError(RuntimeError):
+    """Too many renders are already pending."""
+
+
+def cpu_limit() -> int:
+    """
+    Number of CPUs available to this process,
+    taking the cgroup (v2 or v1) CPU quota of the pod into account
+    """
+    available = len(os.sched_getaffinity(0))
+    quota_files = [
+        ("/sys/fs/cgroup/cpu.max", None),
+        (
+            "/sys/fs/cgroup/cpu/cpu.cfs_quota_us",
+            "/sys/fs/cgroup/cpu/cpu.cfs_period_us",
+        ),
+    ]
+    for quota_file, period_file in quota_files:
+        try:
+            with open(quota_file, encoding="utf-8") as f:
+                values = f.read().split()
+            if period_file is not None:
+                with open(period_file, encoding="utf-8") as f:
+                    values.append(f.read().strip())
+        except OSError:
+            continue
+        quota, period = values[0], values[1]
+        if quota in ("max", "-1"):
+            break
+        return max(1, min(available, math.ceil(int(quota) / int(period))))
+    return available
+
+
+def box_items(box: Box) -> int:
+    """Rough size of a render: one item per unet and per firewall rule"""
+    return 1 + sum(
+        1
+        + len(unet.firewall.ipv4_port_forwarding)
+        + len(unet.firewall.ipv6_port_opening)
+        for unet in box.unets
+    )
+
+
+def _timed_render(render: RenderFunction, box: Box) -> tuple[str, float]:
+    start = time.perf_counter()
+    configfile = render(box)
+    return configfile, time.perf_counter() - start
+
+
+class RenderPool:
+    """Bounded process pool for config renders"""
+
+    workers: int
+    max_queue: int
+    inline_max_ms: float
+
+    def __init__(self, workers: int, max_queue: int, inline_max_ms: float = 0):
+        """
+        Args:
+            workers (int): Number of worker processes, 0 to size it to the CPU limit
+            max_queue (int): Maximum number of pending renders
+            inline_max_ms (float): Renders estimated below this run inline, 0 to disable
+        """
+        self.workers = workers or cpu_limit()
+        self.max_queue = max_queue
+        self.inline_max_ms = inline_max_ms
+        self.pending = 0
+        self.seconds_per_item: Optional[float] = None
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        """Renders waiting for a worker"""
+        return max(0, self.pending - self.workers)
+
+    def _record_cost(self, items: int, seconds: float):
+        cost = seconds / items
+        if self.seconds_per_item is None:
+            self.seconds_per_item = cost
+        else:
+            self.seconds_per_item += _COST_SMOOTHING * (cost - self.seconds_per_item)
+
+    def _should_inline(self, items: int) -> bool:
+        if self.inline_max_ms <= 0 or self.seconds_per_item is None:
+            return False
+        return self.seconds_per_item * items * 1000 < self.inline_max_ms
+
+    async def render(self, render: RenderFunction, box: Box) -> str:
+        """
+        Render a box config in the pool, or inline if it is cheap enough
+
+        Args:
+            render (RenderFunction): module-level render function (must be picklable)
+            box (Box): the box to render
+        Raises:
+            RenderQueueFullError: if max_queue renders are already pending
+        """
+        items = box_items(box)
+        if self._should_inline(items):
+            return render(box)
+
+        if self.pending >= self.max_queue:
+            raise RenderQueueFullError(
+                f"{self.pending} renders are already pending, try again later"
+            )
+        self.pending += 1
+        try:
+            with timed("render"):
+                configfile, seconds = await asyncio.wrap_future(
+                    self.executor.submit(_timed_render, render, box)
+                )
+        finally:
+            self.pending -= 1
+        self._record_cost(items, seconds)
+        return configfile
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+render_pool: Optional[RenderPool] = None
+
+
+async def render_in_pool(render: RenderFunction, box: Box) -> str:
+    """Render a box config in the pool if it is started, inline otherwise"""
+    if render_pool is None:
+        return render(box)
+
+    return await render_pool.render(render, box)
+
+
+def render_pool_pressure() -> float:
+    """Pending renders over the maximum, 0 when the pool is not started"""
+    if render_pool is None or render_pool.max_queue <= 0:
+        return 0.0
+    return render_pool.pending / render_pool.max_queue
+
+
+def init_render_pool(workers: int, max_queue: int, inline_max_ms: float):
+    global render_pool
+    render_pool = RenderPool(workers, max_queue, inline_max_ms)
+    logging.info("Render pool started with %d workers.", render_pool.workers)
+
+
+def close_render_pool():
+    global render_pool
+    if render_pool is not None:
+        render_pool.close()
+        render_pool = None
@@ -0,0 +1,264 @@
+"""
+Admission control: bounded concurrency per route class, and load shedding.
+
+Each route class admits `limit` requests at a time and queues at most
+`max_queue` more, for at most `queue_timeout` seconds. Requests beyond that
+are refused right away with a 503 and a jittered Retry-After, so that a
+reboot storm is spread over time instead of timing out in an unbounded
+queue. Queued requests expected to be cheap (conditional requests, which
+are answered with a 304 when nothing changed) are admitted first.
+
+Routes outside of every class (health, versions, admin, events...) are
+never held. Long-polls, idle most of the time, have a class of their own.
+
+Optionally, each box MAC found in a request path gets a token bucket, so
+that one misbehaving daemon cannot monopolize a worker: it gets 429s.
+"""
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Optional
+from urllib.parse import parse_qs
+
+from netaddr import EUI, AddrFormatError, mac_unix_expanded
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Queue priorities, the lowest is admitted first
+PRIORITY_CHEAP = 0
+PRIORITY_DEFAULT = 1
+
+
+class OverloadedError(RuntimeError):
+    """The route class is saturated and its wait queue is full or too slow."""
+
+
+def jittered_retry_after(base: int, jitter: int) -> str:
+    """A Retry-After value between base and base + jitter seconds"""
+    return str(base + random.randint(0, max(0, jitter)))
+
+
+class ConcurrencyLimiter:
+    """At most `limit` holders, and a bounded priority queue of waiters"""
+
+    limit: int
+    max_queue: int
+    queue_timeout: float
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        """
+        Args:
+            limit (int): Number of requests admitted at the same time
+            max_queue (int): Number of requests waiting for admission
+            queue_timeout (float): Seconds a request may wait for admission
+        """
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.shed = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = PRIORITY_DEFAULT):
+        """
+        Raises:
+            OverloadedError: if the queue is full or the wait too long
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            raise OverloadedError(f"{len(self._waiters)} requests already waiting")
+
+        admitted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), admitted))
+        try:
+            await asyncio.wait_for(asyncio.shield(admitted), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if admitted.done():
+                # Admitted while timing out: hand the slot over
+                self.release()
+            else:
+                admitted.cancel()
+                self._waiters.remove(
+                    next(waiter for waiter in self._waiters if waiter[2] is admitted)
+                )
+                heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.shed += 1
+            raise OverloadedError(
+                f"Not admitted within {self.queue_timeout} s"
+            ) from None
+
+    def release(self):
+        # The slot goes straight to the next waiter, if any
+        while self._waiters:
+            _, _, admitted = heapq.heappop(self._waiters)
+            if not admitted.done():
+                admitted.set_result(None)
+                return
+        self.active -= 1
+
+
+class TokenBuckets:
+    """A token bucket per key, refilled at `rate` tokens per second"""
+
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: dict[str, tuple[float, float]] = {}
+
+    def take(self, key: str) -> Optional[float]:
+        """Take a token, or return the seconds until the next one"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        if len(self.buckets) > self.max_keys:
+            self._prune(now)
+        return None
+
+    def _prune(self, now: float):
+        # Buckets refilled since are the same as no bucket
+        full_after = self.burst / self.rate
+        self.buckets = {
+            key: bucket
+            for key, bucket in self.buckets.items()
+            if now - bucket[1] < full_after
+        }
+
+
+def path_mac(path: str) -> Optional[str]:
+    """The first MAC address in a request path, formatted as in the box documents"""
+    for segment in path.split("/"):
+        if segment.count(":") == 5 or segment.count("-") == 5:
+            try:
+                return str(EUI(segment, dialect=mac_unix_expanded))
+            except (AddrFormatError, ValueError, TypeError):
+                continue
+    return None
+
+
+# Only config downloads long-poll, and only for a box sending its config hash
+_LONG_POLL_PREFIX = "/v2/config/"
+
+
+def is_long_poll(scope: Scope) -> bool:
+    """
+    Tell whether a request waits for a change: a config download with a
+    `wait` and the hash of the config of the box (If-None-Match or `hash`),
+    as the route holds it
+    """
+    if not scope["path"].startswith(_LONG_POLL_PREFIX):
+        return False
+    query = parse_qs(scope["query_string"].decode("latin-1"))
+    if "hash" not in query and not any(
+        name == b"if-none-match" for name, _ in scope["headers"]
+    ):
+        return False
+    for wait in query.get("wait", []):
+        try:
+            return float(wait) > 0
+        except ValueError:
+            return False
+    return False
+
+
+class AdmissionControlMiddleware:
+    """Admit the requests of each route class through its limiter"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        route_classes: dict[str, tuple[tuple[str, ...], ConcurrencyLimiter]],
+        long_poll_class: Optional[str] = None,
+        mac_buckets: Optional[TokenBuckets] = None,
+        retry_after: int = 5,
+        retry_jitter: int = 25,
+    ):
+        """
+        Args:
+            app (ASGIApp): The application
+            route_classes (dict): Path prefixes and limiter of each route class
+            long_poll_class (str, optional): Class of the config long-polls,
+                which are mostly idle and must not hold a render slot
+            mac_buckets (TokenBuckets, optional): Rate limit per box MAC
+            retry_after (int): Minimum Retry-After of the 503s, in seconds
+            retry_jitter (int): Random seconds added to it
+        """
+        self.app = app
+        self.route_classes = route_classes
+        self.long_poll_class = long_poll_class
+        self.mac_buckets = mac_buckets
+        self.retry_after = retry_after
+        self.retry_jitter = retry_jitter
+
+    def route_class(self, scope: Scope) -> Optional[str]:
+        path: str = scope["path"]
+        for route_class, (prefixes, _) in self.route_classes.items():
+            if path.startswith(prefixes):
+                if self.long_poll_class is not None and is_long_poll(scope):
+                    return self.long_poll_class
+                return route_class
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route_class = self.route_class(scope)
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if self.mac_buckets is not None:
+            mac = path_mac(scope["path"])
+            wait = None if mac is None else self.mac_buckets.take(mac)
+            if wait is not None:
+                response = JSONResponse(
+                    {"detail": {"Erreur": "Too many requests for this box"}},
+                    status_code=429,
+                    headers={"Retry-After": str(max(1, round(wait)))},
+                )
+                await response(scope, receive, send)
+                return
+
+        _, limiter = self.route_classes[route_class]
+        conditional = any(
+            name in (b"if-none-match", b"if-range") for name, _ in scope["headers"]
+        )
+        try:
+            await limiter.acquire(PRIORITY_CHEAP if conditional else PRIORITY_DEFAULT)
+        except OverloadedError as e:
+            response = JSONResponse(
+                {"detail": {"Erreur": f"Server overloaded: {e}"}},
+                status_code=503,
+                headers={
+                    "Retry-After": jittered_retry_after(
+                        self.retry_after, self.retry_jitter
+                    )
+                },
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,23 @@
+"""Strong entity tags for conditional GETs."""
+
+import hashlib
+from typing import Optional
+
+
+def strong_etag(content: str | bytes) -> str:
+    """Quoted strong ETag of a response body"""
+    if isinstance(content, str):
+        content = content.encode()
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Tell whether an If-None-Match header matches an ETag (weak comparison)"""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(","))
+    return etag.removeprefix("W/") in (
+        candidate.removeprefix("W/") for candidate in candidates
+    )
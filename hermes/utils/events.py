@@ -0,0 +1,273 @@
+"""
+Server-sent events pushed to the boxes holding a connection open.
+
+Each connection owns an EventSlot which only keeps the latest event of
+each type: a burst of changes is sent as one event, and a slow box never
+accumulates a backlog. A single ticker task wakes every slot for the
+heartbeats, instead of a timer per connection.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from hermes.mongodb.watcher import get_box_watcher
+
+
+class EventHubFullError(RuntimeError):
+    """The worker already holds its maximum number of event connections."""
+
+
+class EventSlot:
+    """The pending events of one connection, by event type"""
+
+    __slots__ = ("mac", "profile", "pending", "heartbeat_due", "wake")
+
+    def __init__(self, mac: str, profile: Optional[str]):
+        self.mac = mac
+        self.profile = profile
+        self.pending: dict[str, str] = {}
+        self.heartbeat_due = False
+        self.wake = asyncio.Event()
+
+    def push(self, event: str, data: dict):
+        """Replace the pending event of this type"""
+        self.pending[event] = json.dumps(data)
+        self.wake.set()
+
+    def take(self) -> bytes:
+        """The pending events and heartbeat, formatted for the event stream"""
+        chunks = [
+            f"event: {event}\ndata: {data}\n\n" for event, data in self.pending.items()
+        ]
+        if self.heartbeat_due and not chunks:
+            chunks.append(": heartbeat\n\n")
+        self.pending.clear()
+        self.heartbeat_due = False
+        self.wake.clear()
+        return "".join(chunks).encode()
+
+
+class EventHub:
+    """The event connections of the worker, by box MAC"""
+
+    heartbeat: float
+    max_connections: int
+
+    def __init__(self, heartbeat: float, max_connections: int):
+        """
+        Args:
+            heartbeat (float): Seconds between two heartbeats of a connection
+            max_connections (int): Connections are refused above this count
+        """
+        self.heartbeat = heartbeat
+        self.max_connections = max_connections
+        self.slots: dict[str, set[EventSlot]] = {}
+        self.connections = 0
+        self._ticker: Optional[asyncio.Task] = None
+
+    def connect(self, mac: str, profile: Optional[str] = None) -> EventSlot:
+        """
+        Raises:
+            EventHubFullError: if max_connections connections are open
+        """
+        if self.connections >= self.max_connections:
+            raise EventHubFullError(
+                f"{self.connections} event connections are already open"
+            )
+        slot = EventSlot(mac, profile)
+        self.slots.setdefault(mac, set()).add(slot)
+        self.connections += 1
+        return slot
+
+    def disconnect(self, slot: EventSlot):
+        slots = self.slots.get(slot.mac)
+        if slots is None or slot not in slots:
+            return
+        slots.discard(slot)
+        if not slots:
+            del self.slots[slot.mac]
+        self.connections -= 1
+
+    def is_connected(self, mac: str) -> bool:
+        return mac in self.slots
+
+    def publish(self, mac: str, event: str, data: dict) -> int:
+        """Push an event to the connections of a box, return their number"""
+        slots = self.slots.get(mac, ())
+        for slot in slots:
+            slot.push(event, data)
+        return len(slots)
+
+    def publish_profile(
+        self, profile: str, event: str, data: dict, rollout: Optional[dict] = None
+    ) -> int:
+        """
+        Push an event to the connected boxes of a ptah profile, only to those
+        in the open waves of the rollout when one is given
+        """
+        from hermes.firmware.rollout import in_open_wave
+
+        notified = 0
+        for mac, slots in self.slots.items():
+            if rollout is not None and not in_open_wave(rollout, mac):
+                continue
+            for slot in slots:
+                if slot.profile == profile:
+                    slot.push(event, data)
+                    notified += 1
+        return notified
+
+    def publish_announcement(self, announcement: dict) -> int:
+        """
+        Push an announcement to its boxes: {"event", "data", "macs",
+        "profile", "rollout"}, by MAC and/or by ptah profile, the boxes of a
+        profile being limited to the open waves of the rollout if any
+        """
+        notified = 0
+        for mac in announcement.get("macs") or ():
+            notified += self.publish(mac, announcement["event"], announcement["data"])
+        if announcement.get("profile") is not None:
+            notified += self.publish_profile(
+                announcement["profile"],
+                announcement["event"],
+                announcement["data"],
+                announcement.get("rollout"),
+            )
+        return notified
+
+    def start(self):
+        self._ticker = asyncio.create_task(self._tick())
+
+    async def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            try:
+                await self._ticker
+            except asyncio.CancelledError:
+                pass
+            self._ticker = None
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for slots in list(self.slots.values()):
+                for slot in slots:
+                    slot.heartbeat_due = True
+                    slot.wake.set()
+
+
+async def _wait_disconnect(receive: Receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class EventStreamResponse(Response):
+    """
+    A text/event-stream response sending the events of a slot until the
+    client disconnects. The slot is removed from the hub on disconnection.
+    """
+
+    media_type = "text/event-stream"
+
+    def __init__(self, hub: EventHub, slot: EventSlot):
+        # No body, which would set a Content-Length
+        self.status_code = 200
+        self.background = None
+        self.init_headers({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        self.hub = hub
+        self.slot = slot
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            while not disconnected.done():
+                body = self.slot.take()
+                if body:
+                    await send(
+                        {"type": "http.response.body", "body": body, "more_body": True}
+                    )
+                    continue
+                woken = asyncio.ensure_future(self.slot.wake.wait())
+                await asyncio.wait(
+                    {disconnected, woken}, return_when=asyncio.FIRST_COMPLETED
+                )
+                woken.cancel()
+        except OSError:
+            logging.debug("Event stream of %s closed", self.slot.mac)
+        finally:
+            disconnected.cancel()
+            self.hub.disconnect(self.slot)
+
+
+event_hub: Optional[EventHub] = None
+
+
+def get_event_hub() -> Optional[EventHub]:
+    return event_hub
+
+
+def init_event_hub(heartbeat: float, max_connections: int) -> EventHub:
+    global event_hub
+    event_hub = EventHub(heartbeat, max_connections)
+    event_hub.start()
+    logging.info("Event hub started, heartbeat every %s s.", heartbeat)
+    return event_hub
+
+
+async def deliver_announcement(announcement: dict):
+    """Box watcher event subscriber, for the connections of this worker"""
+    if event_hub is not None:
+        event_hub.publish_announcement(announcement)
+
+
+async def announce_firmware(
+    version: Optional[str],
+    macs: Optional[list[str]] = None,
+    profile: Optional[str] = None,
+    rollout: Optional[dict] = None,
+) -> bool:
+    """
+    Tell the connected boxes, by MAC or by ptah profile, that a firmware
+    version is available, through the box watcher to every worker
+
+    Args:
+        version (str): Firmware version hash, None when it is per box
+        macs (list): MAC addresses of the boxes, as stored in their documents
+        profile (str): Ptah profile of the boxes
+        rollout (dict): Rollout of the profile, only its open waves are told
+    Returns:
+        bool: True if every worker receives it
+    """
+    box_watcher = get_box_watcher()
+    if box_watcher is None:
+        return False
+    announcement = {
+        "event": "firmware",
+        "data": {"version": version},
+        "macs": macs,
+        "profile": profile,
+    }
+    if rollout is not None:
+        announcement["rollout"] = {
+            key: rollout[key] for key in ("_id", "waves", "current_wave")
+        }
+    return await box_watcher.announce(announcement)
+
+
+async def close_event_hub():
+    global event_hub
+    if event_hub is not None:
+        await event_hub.stop()
+        event_hub = None
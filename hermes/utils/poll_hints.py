@@ -0,0 +1,286 @@
+"""
+Poll intervals advertised to the boxes, adapted to the load of the worker.
+
+Responses to the boxes carry an X-Poll-After header: the seconds to wait
+before the next poll. It grows with the request rate and the pressure on
+the render pool (above `target_rate`, the fleet slows down until it
+matches it), shrinks when the worker is quiet or the config of the box
+changed recently, and is jittered so that the polls stay spread.
+
+The interval observed between two polls of a box is compared with the one
+it was advertised, to check that the daemons follow the hints. Polls are
+told apart by route template; long-polls and downloads get a hint but are
+not polls. The figures only cover the polls received by this worker.
+"""
+
+import random
+import time
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from hermes.utils.admission import is_long_poll, path_mac
+
+_current_hint: ContextVar[Optional[int]] = ContextVar("poll_hint", default=None)
+
+# Quiet workers advertise down to this fraction of the base interval
+_QUIET_FACTOR = 0.5
+# Boxes whose config changed recently poll this much more often
+_RECENT_CHANGE_FACTOR = 0.5
+# Seconds of requests the rate is averaged over
+_RATE_WINDOW = 10
+# Boxes remembered for the observed intervals and the recent changes
+_MAX_BOXES = 100000
+# Upper bounds of the observed / advertised ratio buckets
+_RATIO_BUCKETS = (0.5, 0.9, 1.1, 2.0)
+
+
+def current_poll_hint() -> Optional[int]:
+    """The interval advertised in the response to the current request, if any"""
+    return _current_hint.get()
+
+
+class RateMeter:
+    """Requests per second over the last `window` seconds"""
+
+    def __init__(self, window: int = _RATE_WINDOW):
+        self.window = window
+        self.counts = [0] * window
+        self.second = int(time.monotonic())
+
+    def _advance(self, now: int):
+        elapsed = now - self.second
+        if elapsed <= 0:
+            return
+        for second in range(
+            self.second + 1, self.second + min(elapsed, self.window) + 1
+        ):
+            self.counts[second % self.window] = 0
+        self.second = now
+
+    def add(self):
+        now = int(time.monotonic())
+        self._advance(now)
+        self.counts[now % self.window] += 1
+
+    @property
+    def rate(self) -> float:
+        self._advance(int(time.monotonic()))
+        return sum(self.counts) / self.window
+
+
+class IntervalStats:
+    """Observed intervals between the polls of a route, against the advertised ones"""
+
+    def __init__(self):
+        self.count = 0
+        self.advertised = 0.0
+        self.observed = 0.0
+        self.ratios = [0] * (len(_RATIO_BUCKETS) + 1)
+
+    def add(self, advertised: int, observed: float):
+        self.count += 1
+        self.advertised += advertised
+        self.observed += observed
+        ratio = observed / advertised
+        bucket = next(
+            (i for i, bound in enumerate(_RATIO_BUCKETS) if ratio < bound),
+            len(_RATIO_BUCKETS),
+        )
+        self.ratios[bucket] += 1
+
+    def to_dict(self) -> dict:
+        bounds = ("0", *map(str, _RATIO_BUCKETS), "inf")
+        return {
+            "polls": self.count,
+            "mean_advertised": self.advertised / self.count if self.count else None,
+            "mean_observed": self.observed / self.count if self.count else None,
+            "observed_over_advertised": {
+                f"{low}-{high}": count
+                for low, high, count in zip(bounds, bounds[1:], self.ratios)
+            },
+        }
+
+
+class PollAdvisor:
+    """Compute the poll hints and track how the boxes follow them"""
+
+    base_interval: int
+    min_interval: int
+    max_interval: int
+    target_rate: float
+    jitter: float
+    recent_change_window: int
+
+    def __init__(
+        self,
+        base_interval: int,
+        min_interval: int,
+        max_interval: int,
+        target_rate: float,
+        jitter: float,
+        recent_change_window: int,
+        pressure_sources: tuple[Callable[[], float], ...] = (),
+    ):
+        """
+        Args:
+            base_interval (int): Interval at the target rate, in seconds
+            min_interval (int): Shortest interval advertised
+            max_interval (int): Longest interval advertised
+            target_rate (float): Requests per second the worker should receive
+            jitter (float): Relative jitter of the hints, e.g. 0.2 for +-20%
+            recent_change_window (int): Seconds a config change is recent
+            pressure_sources (tuple): Loads of the worker resources, 1 when full
+        """
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rate = target_rate
+        self.jitter = jitter
+        self.recent_change_window = recent_change_window
+        self.pressure_sources = pressure_sources
+
+        self.rate_meter = RateMeter()
+        self.changed_at: dict[str, float] = {}
+        self.last_polls: dict[tuple[str, str], tuple[float, int]] = {}
+        self.stats: dict[str, IntervalStats] = {}
+
+    def pressure(self) -> float:
+        """Load of the worker, 1 at the target rate or with a full resource"""
+        return max(
+            [
+                self.rate_meter.rate / self.target_rate,
+                *(source() for source in self.pressure_sources),
+            ]
+        )
+
+    def recently_changed(self, mac: str) -> bool:
+        changed_at = self.changed_at.get(mac)
+        return (
+            changed_at is not None
+            and time.monotonic() - changed_at < self.recent_change_window
+        )
+
+    def hint(self, mac: Optional[str]) -> int:
+        """Seconds before the next poll of a box"""
+        factor = max(_QUIET_FACTOR, self.pressure())
+        if mac is not None and self.recently_changed(mac):
+            factor *= _RECENT_CHANGE_FACTOR
+        interval = self.base_interval * factor
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return round(min(self.max_interval, max(self.min_interval, interval)))
+
+    def record_poll(self, route: str, mac: str, advertised: int):
+        """
+        Record a poll, and the interval since the previous one of the box
+
+        Args:
+            route (str): Path template of the route, e.g. /config/{mac}
+        """
+        now = time.monotonic()
+        previous = self.last_polls.pop((route, mac), None)
+        if previous is not None:
+            self.stats.setdefault(route, IntervalStats()).add(
+                previous[1], now - previous[0]
+            )
+        self.last_polls[(route, mac)] = (now, advertised)
+        if len(self.last_polls) > _MAX_BOXES:
+            del self.last_polls[next(iter(self.last_polls))]
+
+    async def box_changed(self, mac: str, _box):
+        """Box watcher subscriber recording the config changes"""
+        self.changed_at.pop(mac, None)
+        self.changed_at[mac] = time.monotonic()
+        if len(self.changed_at) > _MAX_BOXES:
+            del self.changed_at[next(iter(self.changed_at))]
+
+    def to_dict(self) -> dict:
+        return {
+            "request_rate": self.rate_meter.rate,
+            "pressure": self.pressure(),
+            "base_interval": self.base_interval,
+            "routes": {route: stats.to_dict() for route, stats in self.stats.items()},
+        }
+
+
+class PollHintMiddleware:
+    """
+    Add an X-Poll-After hint to the responses under `path_prefixes`, and
+    record the polls by route, except long-polls and `unpolled_prefixes`
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        advisor: PollAdvisor,
+        path_prefixes: tuple[str, ...],
+        unpolled_prefixes: tuple[str, ...] = (),
+    ):
+        self.app = app
+        self.advisor = advisor
+        self.path_prefixes = path_prefixes
+        self.unpolled_prefixes = unpolled_prefixes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        mac = path_mac(scope["path"])
+        self.advisor.rate_meter.add()
+        hint = self.advisor.hint(mac)
+        polled = (
+            mac is not None
+            and not (
+                self.unpolled_prefixes
+                and scope["path"].startswith(self.unpolled_prefixes)
+            )
+            and not is_long_poll(scope)
+        )
+        token = _current_hint.set(hint)
+
+        async def send_with_hint(message: Message):
+            if message["type"] == "http.response.start":
+                # Set by the router once the request is routed
+                route = scope.get("route")
+                if polled and route is not None:
+                    self.advisor.record_poll(route.path, mac, hint)
+                headers = list(message.get("headers", []))
+                headers.append((b"x-poll-after", str(hint).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_hint)
+        finally:
+            _current_hint.reset(token)
+
+
+poll_advisor: Optional[PollAdvisor] = None
+
+
+def get_poll_advisor() -> Optional[PollAdvisor]:
+    return poll_advisor
+
+
+def init_poll_advisor(
+    base_interval: int,
+    min_interval: int,
+    max_interval: int,
+    target_rate: float,
+    jitter: float,
+    recent_change_window: int,
+    pressure_sources: tuple[Callable[[], float], ...] = (),
+) -> PollAdvisor:
+    global poll_advisor
+    poll_advisor = PollAdvisor(
+        base_interval,
+        min_interval,
+        max_interval,
+        target_rate,
+        jitter,
+        recent_change_window,
+        pressure_sources,
+    )
+    return poll_advisor
@@ -0,0 +1,305 @@
+"""
+On-demand profiling of the running worker.
+
+A ProfileSession matches the next requests (by route prefix and/or MAC)
+and, while one of them is in flight, either samples the Python stacks of
+every thread (cpu mode) or diffs tracemalloc snapshots (alloc mode).
+Results are exported as collapsed stacks or speedscope JSON.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Literal, Optional
+
+from netaddr import EUI, AddrFormatError
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+ProfileMode = Literal["cpu", "alloc"]
+
+# Stacks whose innermost frame is one of these are idle threads, not work
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+_active_session: Optional["ProfileSession"] = None
+
+
+class ProfilerBusyError(RuntimeError):
+    """A profile session is already running in this worker."""
+
+
+def _same_mac(segment: str, mac: EUI) -> bool:
+    try:
+        return EUI(segment) == mac
+    except (AddrFormatError, ValueError, TypeError):
+        return False
+
+
+def _frame_name(filename: str, lineno: int, function: str) -> str:
+    return f"{function} ({filename}:{lineno})"
+
+
+class ProfileSession:
+    """A time-bounded profile of the next matching requests"""
+
+    mode: ProfileMode
+    route: Optional[str]
+    mac: Optional[EUI]
+    max_requests: Optional[int]
+    interval: float
+    nframes: int
+
+    def __init__(
+        self,
+        mode: ProfileMode,
+        route: Optional[str] = None,
+        mac: Optional[EUI] = None,
+        max_requests: Optional[int] = None,
+        interval: float = 0.005,
+        nframes: int = 25,
+    ):
+        """
+        Args:
+            mode (ProfileMode): "cpu" for stack sampling, "alloc" for tracemalloc
+            route (str, optional): Only profile requests whose path starts with it
+            mac (EUI, optional): Only profile requests with this MAC in their path
+            max_requests (int, optional): Stop after this many matching requests
+            interval (float): Seconds between two stack samples (cpu mode)
+            nframes (int): Depth of the allocation tracebacks (alloc mode)
+        """
+        self.mode = mode
+        self.route = route
+        self.mac = mac
+        self.max_requests = max_requests
+        self.interval = interval
+        self.nframes = nframes
+
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self.started_requests = 0
+        self.completed_requests = 0
+        self.in_flight = 0
+        self.elapsed = 0.0
+
+        self._done: Optional[asyncio.Event] = None
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_tracemalloc = False
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._start_time = 0.0
+
+    # ------------------------------------------------------------------ #
+    #                              Matching                              #
+    # ------------------------------------------------------------------ #
+    def matches(self, path: str) -> bool:
+        """Tell whether a request path is part of this profile"""
+        if path.startswith("/v2/admin"):
+            return False
+        if self.max_requests is not None and self.started_requests >= (
+            self.max_requests
+        ):
+            return False
+        if self.route is not None and not path.startswith(self.route):
+            return False
+        if self.mac is not None and not any(
+            _same_mac(segment, self.mac) for segment in path.split("/") if segment
+        ):
+            return False
+        return True
+
+    def begin_request(self):
+        self.started_requests += 1
+        self.in_flight += 1
+
+    def end_request(self):
+        self.in_flight -= 1
+        self.completed_requests += 1
+        if (
+            self.max_requests is not None
+            and self.completed_requests >= self.max_requests
+            and self._done is not None
+        ):
+            self._done.set()
+
+    # ------------------------------------------------------------------ #
+    #                             Lifecycle                              #
+    # ------------------------------------------------------------------ #
+    async def run(self, duration: float):
+        """
+        Profile until `max_requests` matching requests completed
+        or `duration` seconds elapsed, whichever comes first.
+        """
+        global _active_session
+        if _active_session is not None:
+            raise ProfilerBusyError("A profile is already running in this worker")
+        _active_session = self
+
+        self._done = asyncio.Event()
+        self._start_time = time.perf_counter()
+        if self.mode == "cpu":
+            self._sampler = threading.Thread(
+                target=self._sample_loop, name="hermes-profiler", daemon=True
+            )
+            self._sampler.start()
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.nframes)
+                self._started_tracemalloc = True
+            self._baseline = tracemalloc.take_snapshot()
+
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout=duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            _active_session = None
+            self.elapsed = time.perf_counter() - self._start_time
+            if self._sampler is not None:
+                self._stop.set()
+                self._sampler.join()
+            if self.mode == "alloc":
+                self._snapshot = tracemalloc.take_snapshot()
+                if self._started_tracemalloc:
+                    tracemalloc.stop()
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        thread_names = {}
+        while not self._stop.wait(self.interval):
+            if self.in_flight <= 0:
+                continue
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                code = frame.f_code
+                if (code.co_filename.rsplit("/", 1)[-1], code.co_name) in _IDLE_FRAMES:
+                    continue
+                if ident not in thread_names:
+                    thread_names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(
+                        _frame_name(
+                            frame.f_code.co_filename,
+                            frame.f_code.co_firstlineno,
+                            frame.f_code.co_name,
+                        )
+                    )
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                self.samples[tuple(reversed(stack))] += 1
+
+    # ------------------------------------------------------------------ #
+    #                               Export                               #
+    # ------------------------------------------------------------------ #
+    def weighted_stacks(
+        self, alloc_view: Literal["diff", "held"] = "diff"
+    ) -> list[tuple[tuple[str, ...], int]]:
+        """
+        Stacks (root first) and their weight: a sample count in cpu mode,
+        a number of bytes in alloc mode.
+        """
+        if self.mode == "cpu":
+            return self.samples.most_common()
+
+        if self._snapshot is None or self._baseline is None:
+            return []
+        ignore = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        snapshot = self._snapshot.filter_traces(ignore)
+        if alloc_view == "held":
+            stats = [
+                (stat.traceback, stat.size) for stat in snapshot.statistics("traceback")
+            ]
+        else:
+            stats = [
+                (stat.traceback, stat.size_diff)
+                for stat in snapshot.compare_to(
+                    self._baseline.filter_traces(ignore), "traceback"
+                )
+            ]
+        return [
+            (
+                tuple(f"{frame.filename}:{frame.lineno}" for frame in traceback),
+                size,
+            )
+            for traceback, size in stats
+            if size > 0
+        ]
+
+    def to_collapsed(self, alloc_view: Literal["diff", "held"] = "diff") -> str:
+        """Export in the collapsed stacks format used by flamegraph.pl"""
+        return "".join(
+            f"{';'.join(stack)} {weight}\n"
+            for stack, weight in self.weighted_stacks(alloc_view)
+        )
+
+    def to_speedscope(self, alloc_view: Literal["diff", "held"] = "diff") -> dict:
+        """Export as a speedscope sampled profile"""
+        frames: list[dict] = []
+        frame_index: dict[str, int] = {}
+        samples = []
+        weights = []
+        for stack, weight in self.weighted_stacks(alloc_view):
+            indexes = []
+            for name in stack:
+                if name not in frame_index:
+                    frame_index[name] = len(frames)
+                    frames.append({"name": name})
+                indexes.append(frame_index[name])
+            samples.append(indexes)
+            if self.mode == "cpu":
+                weights.append(weight * self.interval)
+            else:
+                weights.append(weight)
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "hermes",
+            "name": f"hermes {self.mode} profile",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"{self.mode} ({self.completed_requests} requests)",
+                    "unit": "seconds" if self.mode == "cpu" else "bytes",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+
+
+class ProfilingMiddleware:
+    """Report the requests matched by the active profile session, if any"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        session = _active_session
+        if (
+            session is None
+            or scope["type"] != "http"
+            or not session.matches(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        session.begin_request()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session.end_request()
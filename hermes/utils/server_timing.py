@@ -0,0 +1,87 @@
+"""Per-request stage durations exposed through the Server-Timing header."""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+_current_timing: ContextVar[Optional["ServerTiming"]] = ContextVar(
+    "server_timing", default=None
+)
+
+
+class ServerTiming:
+    """Durations recorded during one request, by stage name (auth, db, ...)"""
+
+    durations: dict[str, float]
+
+    def __init__(self):
+        self.durations = {}
+
+    def add(self, stage: str, seconds: float):
+        """Add a duration to a stage, a stage can be timed several times"""
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def header_value(self) -> str:
+        """
+        Format the durations as a Server-Timing header value
+
+        Returns:
+            str: e.g. "auth;dur=1.20, db;dur=3.41"
+        """
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.2f}"
+            for stage, seconds in self.durations.items()
+        )
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Record the duration of the enclosed block under `stage`.
+    Does nothing when no timing context is active (disabled or untracked route).
+    """
+    timing = _current_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(stage, time.perf_counter() - start)
+
+
+class ServerTimingMiddleware:
+    """
+    Open a timing context for the requests under `path_prefixes`
+    and add the recorded stages as a Server-Timing response header.
+    """
+
+    def __init__(self, app: ASGIApp, path_prefixes: tuple[str, ...]):
+        self.app = app
+        self.path_prefixes = path_prefixes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        timing = ServerTiming()
+        token = _current_timing.set(timing)
+
+        async def send_with_timing(message: Message):
+            if message["type"] == "http.response.start" and timing.durations:
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (b"server-timing", timing.header_value().encode("latin-1"))
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timing.reset(token)
@@ -0,0 +1,19 @@
+"""Build a tar archive member by member, to stream it without a temp file."""
+
+import tarfile
+import time
+
+_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+# Two empty blocks mark the end of the archive
+TAR_END = b"\0" * (2 * _BLOCK_SIZE)
+
+
+def tar_member(name: str, data: bytes, mtime: float | None = None) -> bytes:
+    """Header, data and padding of a regular file member"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time() if mtime is None else mtime)
+    info.mode = 0o644
+    padding = -len(data) % _BLOCK_SIZE
+    return info.tobuf(format=tarfile.PAX_FORMAT) + data + b"\0" * padding
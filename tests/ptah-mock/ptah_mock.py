@@ -0,0 +1,45 @@
+"""
+Ptah stand-in for the unit tests: every box is prepared the same firmware,
+FIRMWARE_VERSION, whose image is IMAGE.
+"""
+
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIRMWARE_VERSION = os.environ.get("FIRMWARE_VERSION", "unit-tests-v1")
+IMAGE = b"hermes unit tests firmware\n" * 4096
+
+
+class PtahHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        # Hermes joins a base URL ending with / and paths starting with one
+        path = "/" + self.path.lstrip("/")
+        mac = path.rsplit("/", 1)[-1]
+        if path.startswith("/v1/build/prepare/"):
+            body = json.dumps(
+                {
+                    "message": "ok",
+                    "mac": mac,
+                    "ptah_version_hash": FIRMWARE_VERSION,
+                    "download_url": f"/v1/build/{mac}",
+                }
+            ).encode()
+            content_type = "application/json"
+        elif path.startswith("/v1/build/"):
+            body = IMAGE
+            content_type = "application/octet-stream"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PTAH_MOCK_PORT", "8081"))
+    ThreadingHTTPServer(("", port), PtahHandler).serve_forever()
@@ -141,6 +141,258 @@ else
 fi
 
 
+# ----------------------------------------
+# v2 routes: the box sends a bearer token (any in the local deploy env),
+# Ptah prepares FIRMWARE_VERSION for every box (tests/ptah-mock)
+# ----------------------------------------
+
+TOKEN=${TOKEN:-unit-tests}
+FIRMWARE_VERSION=${FIRMWARE_VERSION:-unit-tests-v1}
+HEADERS=/tmp/headers
+BODY=/tmp/body
+
+# ----------------------------------------
+# Unit tests 9: firmware build job with Prefer: respond-async
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 9: firmware build job with Prefer: respond-async${NC}"
+
+echo -e "curl on ${URL}/v2/ptah/download/${MAC}..."
+
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" -H "Prefer: respond-async" ${URL}/v2/ptah/download/${MAC})
+job_location=$(grep -i "^location:" ${HEADERS} | cut -d' ' -f2 | tr -d '\r')
+
+if [ $http_code -eq 202 ] && grep -qi "^retry-after: [0-9]" ${HEADERS} && [ -n "${job_location}" ] && jq -e '.state == "building" or .state == "downloading"' ${BODY} > /dev/null; then
+    echo -e "${GREEN}Unit test 9 passed with code ${http_code}, job ${job_location} !${NC}"
+else
+    echo -e "${RED}Unit test 9 failed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 10: firmware build job done
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 10: firmware build job done${NC}"
+
+echo -e "curl on ${URL}${job_location} until the job is done..."
+
+for i in $(seq 1 30); do
+    http_code=$(curl -s -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" ${URL}${job_location})
+    if [ $http_code -ne 200 ] || ! jq -e '.state == "building" or .state == "downloading"' ${BODY} > /dev/null; then
+        break
+    fi
+    sleep 1
+done
+
+if [ $http_code -eq 200 ] && jq -e --arg version "${FIRMWARE_VERSION}" '.state == "done" and .version == $version' ${BODY} > /dev/null; then
+    echo -e "${GREEN}Unit test 10 passed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+else
+    echo -e "${RED}Unit test 10 failed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 11: sync document of the box
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 11: sync document of the box${NC}"
+
+echo -e "curl on ${URL}/v2/sync/${MAC}..."
+
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" ${URL}/v2/sync/${MAC})
+config_hash=$(jq -r '.config' ${BODY})
+
+if [ $http_code -eq 200 ] && grep -qi "^x-poll-after: [0-9]" ${HEADERS} && jq -e --arg version "${FIRMWARE_VERSION}" '.config != null and .firmware == $version and (.poll_after | type) == "number" and (.urls.config | startswith("/v2/config/")) and (.urls.firmware | startswith("/v2/ptah/download/"))' ${BODY} > /dev/null; then
+    echo -e "${GREEN}Unit test 11 passed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+else
+    echo -e "${RED}Unit test 11 failed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 12: firmware download redirected to a signed URL
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 12: firmware download redirected to a signed URL${NC}"
+
+echo -e "curl on ${URL}/v2/ptah/download/${MAC}..."
+
+http_code=$(curl -s -D ${HEADERS} -o /dev/null -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" ${URL}/v2/ptah/download/${MAC})
+firmware_url=$(grep -i "^location:" ${HEADERS} | cut -d' ' -f2 | tr -d '\r')
+
+if [ $http_code -eq 302 ] && echo "${firmware_url}" | grep -q "^/v2/firmware/${FIRMWARE_VERSION}?profile=[^&]*&expires=[0-9]*&token=[0-9a-f]*$"; then
+    echo -e "${GREEN}Unit test 12 passed with code ${http_code}, redirected to ${firmware_url} !${NC}"
+else
+    echo -e "${RED}Unit test 12 failed with code ${http_code}, redirected to ${firmware_url} !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 13: firmware image at its signed URL
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 13: firmware image at its signed URL${NC}"
+
+echo -e "curl on ${URL}${firmware_url}..."
+
+http_code=$(curl -s -D ${HEADERS} -o /tmp/ptah.bin -w "%{http_code}" ${URL}${firmware_url})
+checksum=$(grep -i "^x-firmware-sha256:" ${HEADERS} | cut -d' ' -f2 | tr -d '\r')
+
+if [ $http_code -eq 200 ] && grep -qi "^etag: \"${FIRMWARE_VERSION}\"" ${HEADERS} && grep -qi "^cache-control: public, max-age=[0-9]*, immutable" ${HEADERS} && [ "$(sha256sum /tmp/ptah.bin | cut -d' ' -f1)" = "${checksum}" ]; then
+    echo -e "${GREEN}Unit test 13 passed with code ${http_code}, $(wc -c < /tmp/ptah.bin) bytes with checksum ${checksum} !${NC}"
+else
+    echo -e "${RED}Unit test 13 failed with code ${http_code} and headers: $(cat ${HEADERS}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 14: firmware URL with a forged token
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 14: firmware URL with a forged token${NC}"
+
+forged_url=$(echo "${firmware_url}" | sed 's/token=.*/token=0000/')
+
+echo -e "curl on ${URL}${forged_url}..."
+
+http_code=$(curl -s -o ${BODY} -w "%{http_code}" ${URL}${forged_url})
+
+if [ $http_code -eq 403 ] && jq -e '.detail.Erreur' ${BODY} > /dev/null; then
+    echo -e "${GREEN}Unit test 14 passed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+else
+    echo -e "${RED}Unit test 14 failed with code ${http_code} and body: $(cat ${BODY}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 15: firmware download resumed with Range and If-Range
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 15: firmware download resumed with Range and If-Range${NC}"
+
+echo -e "curl on ${URL}/v2/ptah/download/${MAC} from byte 100..."
+
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" -H "Range: bytes=100-" -H "If-Range: \"${FIRMWARE_VERSION}\"" ${URL}/v2/ptah/download/${MAC})
+
+if [ $http_code -eq 206 ] && grep -qi "^content-range: bytes 100-[0-9]*/$(wc -c < /tmp/ptah.bin)" ${HEADERS} && tail -c +101 /tmp/ptah.bin | cmp -s - ${BODY}; then
+    echo -e "${GREEN}Unit test 15 passed with code ${http_code}, $(wc -c < ${BODY}) bytes resumed !${NC}"
+else
+    echo -e "${RED}Unit test 15 failed with code ${http_code} and headers: $(cat ${HEADERS}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 16: firmware download with the If-Range of another version
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 16: firmware download with the If-Range of another version${NC}"
+
+echo -e "curl on ${URL}/v2/ptah/download/${MAC} with If-Range \"other\"..."
+
+http_code=$(curl -s -D ${HEADERS} -o /dev/null -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" -H "Range: bytes=100-" -H "If-Range: \"other\"" ${URL}/v2/ptah/download/${MAC})
+
+if [ $http_code -eq 302 ] && grep -qi "^location: /v2/firmware/${FIRMWARE_VERSION}?" ${HEADERS}; then
+    echo -e "${GREEN}Unit test 16 passed with code ${http_code}, not resumed !${NC}"
+else
+    echo -e "${RED}Unit test 16 failed with code ${http_code} and headers: $(cat ${HEADERS}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 17: config block of one subsystem
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 17: config block of one subsystem${NC}"
+
+echo -e "curl on ${URL}/v2/config/${MAC}/firewall..."
+
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" ${URL}/v2/config/${MAC}/firewall)
+
+if [ $http_code -eq 200 ] && grep -qi "^etag: \"[0-9a-f]*\"" ${HEADERS} && [ "$(head -n 1 ${BODY})" = "/-- SEPARATOR firewall --/" ] && ! grep -q "SEPARATOR network" ${BODY}; then
+    echo -e "${GREEN}Unit test 17 passed with code ${http_code} and $(wc -l < ${BODY}) lines !${NC}"
+else
+    echo -e "${RED}Unit test 17 failed with code ${http_code} and body: $(head -n 5 ${BODY}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 18: config blocks of several subsystems
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 18: config blocks of several subsystems${NC}"
+
+echo -e "curl on ${URL}/v2/config/${MAC}?subsystems=dhcp,firewall..."
+
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" "${URL}/v2/config/${MAC}?subsystems=dhcp,firewall")
+separators=$(grep "^/-- SEPARATOR" ${BODY} | tr '\n' ' ')
+
+if [ $http_code -eq 200 ] && grep -qi "^etag: \"[0-9a-f]*\"" ${HEADERS} && [ "${separators}" = "/-- SEPARATOR firewall --/ /-- SEPARATOR dhcp --/ " ]; then
+    echo -e "${GREEN}Unit test 18 passed with code ${http_code} and blocks: ${separators} !${NC}"
+else
+    echo -e "${RED}Unit test 18 failed with code ${http_code} and blocks: ${separators} !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 19: long-poll of an unchanged config
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 19: long-poll of an unchanged config${NC}"
+
+echo -e "curl on ${URL}/v2/config/${MAC}?hash=${config_hash}&wait=2..."
+
+rm -f ${BODY}
+http_code=$(curl -s -D ${HEADERS} -o ${BODY} -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" "${URL}/v2/config/${MAC}?hash=${config_hash}&wait=2")
+
+if [ $http_code -eq 304 ] && grep -qi "^etag: \"${config_hash}\"" ${HEADERS} && [ ! -s ${BODY} ]; then
+    echo -e "${GREEN}Unit test 19 passed with code ${http_code} !${NC}"
+else
+    echo -e "${RED}Unit test 19 failed with code ${http_code} and headers: $(cat ${HEADERS}) !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 20: streamed config, same as the buffered one
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 20: streamed config, same as the buffered one${NC}"
+
+echo -e "curl on ${URL}/v2/config/${MAC}, without then with an If-None-Match..."
+
+http_code=$(curl -s -D ${HEADERS} -o /tmp/configfile_streamed.txt -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" ${URL}/v2/config/${MAC})
+streamed_etag=$(grep -ci "^etag:" ${HEADERS})
+buffered_code=$(curl -s -D ${HEADERS} -o /tmp/configfile_buffered.txt -w "%{http_code}" -H "Authorization: Bearer ${TOKEN}" -H "If-None-Match: \"none\"" ${URL}/v2/config/${MAC})
+
+if [ $http_code -eq 200 ] && [ $buffered_code -eq 200 ] && [ $streamed_etag -eq 0 ] && grep -qi "^etag: \"${config_hash}\"" ${HEADERS} && cmp -s /tmp/configfile_streamed.txt /tmp/configfile_buffered.txt; then
+    echo -e "${GREEN}Unit test 20 passed with codes ${http_code} and ${buffered_code} !${NC}"
+else
+    echo -e "${RED}Unit test 20 failed with codes ${http_code} and ${buffered_code} !${NC}"
+    exit 1
+fi
+
+# ----------------------------------------
+# Unit tests 21: events of the box (Server-Sent Events)
+# ----------------------------------------
+
+echo -e "${YELLOW}Running unit test 21: events of the box (Server-Sent Events)${NC}"
+
+echo -e "curl on ${URL}/v2/events/${MAC} for 3 seconds, a firmware announced meanwhile..."
+
+curl -s -N --max-time 3 -D ${HEADERS} -o ${BODY} -H "Authorization: Bearer ${TOKEN}" ${URL}/v2/events/${MAC} &
+events_pid=$!
+sleep 1
+announce_code=$(curl -s -o /dev/null -w "%{http_code}" -X POST -H "Authorization: Bearer ${TOKEN}" -H "Content-Type: application/json" -d "{\"version\": \"${FIRMWARE_VERSION}\", \"macs\": [\"${MAC}\"]}" ${URL}/v2/admin/events/firmware)
+wait $events_pid
+
+if [ $announce_code -eq 202 ] && grep -qi "^content-type: text/event-stream" ${HEADERS} && grep -q "^data: {\"hash\": \"${config_hash}\"}" ${BODY} && grep -q "^event: firmware" ${BODY} && grep -q "^data: {\"version\": \"${FIRMWARE_VERSION}\"}" ${BODY}; then
+    echo -e "${GREEN}Unit test 21 passed: $(grep -c "^event:" ${BODY}) events received !${NC}"
+else
+    echo -e "${RED}Unit test 21 failed with code ${announce_code} and events: $(cat ${BODY}) !${NC}"
+    exit 1
+fi
+
+
 # ----------------------------------------
 # Unit tests : ping ipv6 of hermes 
 # ----------------------------------------